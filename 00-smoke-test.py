@@ -1,23 +1,51 @@
 import asyncio
 import logging
 
-HOST = "0.0.0.0"
-PORT = 40000
+import metrics
+import runtime
 
+# Data is received straight into a reusable buffer of CHUNK_SIZE bytes
+CHUNK_SIZE = 1 << 16
 
-async def handle(r, w):
-    w.write(await r.read())
-    await w.drain()
-    w.close()
+ECHOED = metrics.counter("echo_bytes_total", "Bytes echoed back")
+
+
+class EchoProtocol(asyncio.BufferedProtocol):
+    def __init__(self):
+        self.buffer = memoryview(bytearray(CHUNK_SIZE))
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.buffer
+
+    def buffer_updated(self, nbytes):
+        ECHOED.value += nbytes
+        self.transport.write(self.buffer[:nbytes])
+        if self.transport.get_write_buffer_size():
+            # What the socket did not take may still refer to the buffer, so
+            # receive into a new one
+            self.buffer = memoryview(bytearray(CHUNK_SIZE))
+
+    def eof_received(self):
+        # Returning False closes the transport once the echo is written out
+        return False
+
+    def pause_writing(self):
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
 
 
 async def main():
     logging.basicConfig(level=logging.DEBUG)
-    server = await asyncio.start_server(handle, HOST, PORT)
+    server = await runtime.create_server(EchoProtocol)
     logging.info("Server Ready.")
-    async with server:
-        await server.serve_forever()
+    await runtime.serve(server)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    runtime.run(main)
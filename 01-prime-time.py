@@ -1,107 +1,490 @@
 import asyncio
 import json
 import logging
-from collections import defaultdict
-from itertools import count
+import multiprocessing
+import os
+import random
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor
+from math import isqrt
+from typing import List, Optional
 
-HOST = "0.0.0.0"
-PORT = 40000
-SEED = 22801763489  # One-billionth prime number
+import metrics
+import runtime
 
+# Numbers below SIEVE_LIMIT are answered from a precomputed sieve, numbers
+# below DETERMINISTIC_LIMIT with a deterministic Miller-Rabin test, anything
+# larger with MR_ROUNDS rounds of Miller-Rabin on random bases.
+SIEVE_LIMIT = int(os.getenv("SIEVE_LIMIT", 1 << 22))
+SIEVE_SEGMENT = 1 << 16
+MR_ROUNDS = int(os.getenv("MR_ROUNDS", 16))
 
-class PrimeTest:
-    def __init__(self):
-        self.__P = {}
-        self.__gen = self.__primes()
-        self.__top = 0
-
-    @staticmethod
-    def __primes():
-        ps = defaultdict(list)
-        for i in count(2):
-            if i not in ps:
-                yield i
-                ps[i**2].append(i)
-            else:
-                for n in ps[i]:
-                    ps[i + (n if n == 2 else 2 * n)].append(n)
-                del ps[i]
+# Numbers wider than INLINE_BITS are checked on a pool of PRIME_WORKERS
+# processes, at most MAX_BATCH numbers per worker call.
+PRIME_WORKERS = int(os.getenv("PRIME_WORKERS", os.cpu_count() or 1))
+INLINE_BITS = int(os.getenv("INLINE_BITS", 256))
+MAX_BATCH = 256
 
-    def __next_prime(self) -> int:
-        i = next(self.__gen)
-        logging.debug(f"Prime found: {i}")
-        self.__P[i] = None
-        self.__top = max(self.__top, i)
-        return i
+# Streaming mode reads CHUNK_SIZE bytes at a time and answers every complete
+# line in one write, draining once HIGH_WATER bytes are waiting to be sent.
+STREAMING = os.getenv("STREAMING", "1") == "1"
+CHUNK_SIZE = 1 << 16
+LINE_LIMIT = 1 << 16
+HIGH_WATER = 1 << 18
+PIPELINE_DEPTH = 16
 
-    def is_prime(self, n: int) -> bool:
-        # Is it a known prime?
-        if n in self.__P:
-            return True
+# Answers above the sieve are kept in a CACHE_POLICY ("lru", "arc" or "none")
+# cache of CACHE_SIZE entries, persisted to CACHE_FILE across restarts if set
+# (CACHE_FILE.i for worker i).
+CACHE_POLICY = os.getenv("CACHE_POLICY", "lru")
+CACHE_SIZE = int(os.getenv("CACHE_SIZE", 1 << 16))
+CACHE_FILE = os.getenv("CACHE_FILE")
+
+DETERMINISTIC_LIMIT = 1 << 64
+DETERMINISTIC_WITNESSES = (2, 325, 9375, 28178, 450775, 9780504, 1795265022)
+SMALL_PRIMES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47)
 
-        # Is it a known composite?
-        if n <= self.__top and n not in self.__P:
+
+def segmented_sieve(limit: int, segment: int = SIEVE_SEGMENT) -> bytearray:
+    # Odd-only sieve: flags[i] tells whether 2i + 1 is prime.
+    size = (limit + 1) // 2
+    flags = bytearray(b"\x01") * size
+    if size:
+        flags[0] = 0
+    root = isqrt(limit)
+    if root < 9:
+        base = [p for p in (3, 5, 7) if p <= root]
+    else:
+        base = [2 * i + 1 for i, f in enumerate(segmented_sieve(root, segment)) if f]
+    for lo in range(0, size, segment):
+        hi = min(lo + segment, size)
+        for p in base:
+            # First odd multiple of p that is >= p^2 and falls in [lo, hi)
+            start = max(p * p // 2, lo + ((p - 1) // 2 - lo) % p)
+            if start >= hi:
+                continue
+            flags[start:hi:p] = bytes(len(range(start, hi, p)))
+    return flags
+
+
+def miller_rabin(n: int, witnesses) -> bool:
+    d = n - 1
+    s = (d & -d).bit_length() - 1
+    d >>= s
+    for a in witnesses:
+        a %= n
+        if a == 0:
+            continue
+        x = pow(a, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
             return False
+    return True
 
-        # Trial division
-        for p in self.__P:
-            if p * p > n:
-                return True
-            if n % p == 0:
-                return False
 
-        # Make new primes on the fly until sqrt
-        while True:
-            p = self.__next_prime()
-            if p * p > n:
-                return True
+class PrimeTest:
+    def __init__(self, sieve_limit: int = SIEVE_LIMIT, rounds: int = MR_ROUNDS):
+        self.sieve_limit = max(sieve_limit, SMALL_PRIMES[-1] + 1)
+        self.rounds = rounds
+        self.__sieve = segmented_sieve(self.sieve_limit)
+        self.__random = random.Random()
+
+    def is_prime(self, n: int) -> bool:
+        if n < self.sieve_limit:
+            if n < 3:
+                return n == 2
+            return n & 1 == 1 and self.__sieve[n >> 1] == 1
+
+        for p in SMALL_PRIMES:
             if n % p == 0:
                 return False
 
+        if n < DETERMINISTIC_LIMIT:
+            return miller_rabin(n, DETERMINISTIC_WITNESSES)
+
+        witnesses = [2] + [self.__random.randrange(3, n - 1) for _ in range(self.rounds)]
+        return miller_rabin(n, witnesses)
+
 
 pt = PrimeTest()
 
 
-async def handle(r: asyncio.StreamReader, w: asyncio.StreamWriter):
-    def write_json(d):
-        w.write(json.dumps(d).encode("utf8"))
-        w.write(b"\n")
+class ResultCache(ABC):
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @abstractmethod
+    def get(self, n: int) -> Optional[bool]:
+        pass
 
-    while not r.at_eof():
+    @abstractmethod
+    def put(self, n: int, prime: bool):
+        pass
+
+    @abstractmethod
+    def items(self):
+        pass
+
+    def dump(self, path: str):
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(list(self.items()), f)
+        os.replace(tmp, path)
+
+    def load(self, path: str):
         try:
-            o = json.loads((await r.readuntil(b"\n")).decode("utf8"))
-            logging.debug(f"Request: {o}")
-            method = o["method"]
-            number = o["number"]
-            if method != "isPrime":
-                raise ValueError()
-            if type(number) == int:
-                write_json({"method": method, "prime": pt.is_prime(number)})
-            elif type(number) == float:
-                write_json({"method": method, "prime": False})
+            with open(path) as f:
+                for n, prime in json.load(f):
+                    self.put(n, prime)
+        except FileNotFoundError:
+            pass
+
+    def stats(self) -> str:
+        return f"hits={self.hits} misses={self.misses} evictions={self.evictions}"
+
+
+class LRUCache(ResultCache):
+    def __init__(self, capacity: int):
+        super().__init__(capacity)
+        self.d = OrderedDict()
+
+    def get(self, n: int) -> Optional[bool]:
+        prime = self.d.get(n)
+        if prime is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.d.move_to_end(n)
+        return prime
+
+    def put(self, n: int, prime: bool):
+        self.d[n] = prime
+        self.d.move_to_end(n)
+        if len(self.d) > self.capacity:
+            self.d.popitem(last=False)
+            self.evictions += 1
+
+    def items(self):
+        return self.d.items()
+
+
+class ARCCache(ResultCache):
+    # Adaptive replacement cache: t1/t2 hold entries seen once/more than once,
+    # b1/b2 remember keys recently evicted from them, p is the target size of t1.
+    def __init__(self, capacity: int):
+        super().__init__(capacity)
+        self.p = 0
+        self.t1, self.t2 = OrderedDict(), OrderedDict()
+        self.b1, self.b2 = OrderedDict(), OrderedDict()
+
+    def get(self, n: int) -> Optional[bool]:
+        if n in self.t1:
+            prime = self.t2[n] = self.t1.pop(n)
+        elif n in self.t2:
+            prime = self.t2[n]
+            self.t2.move_to_end(n)
+        else:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return prime
+
+    def __replace(self, n: int):
+        if len(self.t1) + len(self.t2) < self.capacity:
+            return
+        if self.t1 and (not self.t2 or len(self.t1) > self.p or (n in self.b2 and len(self.t1) == self.p)):
+            k, _ = self.t1.popitem(last=False)
+            self.b1[k] = None
+        else:
+            k, _ = self.t2.popitem(last=False)
+            self.b2[k] = None
+        self.evictions += 1
+
+    def put(self, n: int, prime: bool):
+        c = self.capacity
+        if n in self.t1:
+            self.t1[n] = prime
+        elif n in self.t2:
+            self.t2[n] = prime
+        elif n in self.b1:
+            self.p = min(c, self.p + max(len(self.b2) // len(self.b1), 1))
+            self.__replace(n)
+            del self.b1[n]
+            self.t2[n] = prime
+        elif n in self.b2:
+            self.p = max(0, self.p - max(len(self.b1) // len(self.b2), 1))
+            self.__replace(n)
+            del self.b2[n]
+            self.t2[n] = prime
+        else:
+            if len(self.t1) + len(self.b1) >= c:
+                if len(self.t1) < c:
+                    self.b1.popitem(last=False)
+                    self.__replace(n)
+                else:
+                    self.t1.popitem(last=False)
+                    self.evictions += 1
+            elif len(self.t1) + len(self.t2) + len(self.b1) + len(self.b2) >= c:
+                if len(self.t1) + len(self.t2) + len(self.b1) + len(self.b2) >= 2 * c:
+                    self.b2.popitem(last=False)
+                self.__replace(n)
+            self.t1[n] = prime
+
+    def items(self):
+        yield from self.t1.items()
+        yield from self.t2.items()
+
+
+CACHES = {"lru": LRUCache, "arc": ARCCache}
+
+
+def check_batch(numbers: List[int]) -> List[bool]:
+    # Runs in the worker processes, against their own copy of `pt`.
+    return [pt.is_prime(n) for n in numbers]
+
+
+class PrimeScheduler:
+    def __init__(self, engine: PrimeTest, cache: Optional[ResultCache] = None,
+                 inline_bits: int = INLINE_BITS, max_batch: int = MAX_BATCH):
+        self.engine = engine
+        self.cache = cache
+        self.inline_bits = inline_bits
+        self.max_batch = max_batch
+        self.executor: Optional[Executor] = None
+        self.workers = 0
+        self.pending = []
+        self.inflight = 0
+        self.scheduled = False
+
+    def use_pool(self, executor: Optional[Executor], workers: int):
+        self.executor = executor
+        self.workers = workers if executor is not None else 0
+
+    def check(self, n: int) -> bool | asyncio.Future:
+        # The sieve answers faster than a cache lookup would
+        if self.cache is None or n < self.engine.sieve_limit:
+            return self.__check(n)
+        prime = self.cache.get(n)
+        if prime is None:
+            prime = self.__check(n)
+            if isinstance(prime, asyncio.Future):
+                prime.add_done_callback(lambda f: self.__remember(n, f))
             else:
-                raise ValueError()
-        except asyncio.LimitOverrunError:
-            write_json({"error": "limit_overrun"})
-            break
-        except asyncio.IncompleteReadError:
-            write_json({"error": "invalid_terminator"})
-            break
-        except (ValueError, KeyError):
-            write_json({"error": "invalid_json"})
-            break
+                self.cache.put(n, prime)
+        return prime
+
+    def __remember(self, n: int, fut: asyncio.Future):
+        if not fut.cancelled() and fut.exception() is None:
+            self.cache.put(n, fut.result())
+
+    def __check(self, n: int) -> bool | asyncio.Future:
+        if self.workers == 0 or n.bit_length() <= self.inline_bits:
+            return self.engine.is_prime(n)
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self.pending.append((n, fut))
+        # Everything submitted during this loop iteration is dispatched together
+        if not self.scheduled:
+            self.scheduled = True
+            loop.call_soon(self.__dispatch)
+        return fut
+
+    def __dispatch(self):
+        self.scheduled = False
+        loop = asyncio.get_running_loop()
+        while self.pending and self.inflight < self.workers:
+            idle = self.workers - self.inflight
+            size = min(self.max_batch, -(-len(self.pending) // idle))
+            batch, self.pending = self.pending[:size], self.pending[size:]
+            self.inflight += 1
+            job = loop.run_in_executor(self.executor, check_batch, [n for n, _ in batch])
+            job.add_done_callback(lambda j, b=batch, t=time.perf_counter_ns(): self.__complete(b, j, t))
+
+    def __complete(self, batch, job: asyncio.Future, started: int):
+        POOL_BATCH.record(time.perf_counter_ns() - started)
+        self.inflight -= 1
+        if job.cancelled() or job.exception() is not None:
+            exc = asyncio.CancelledError() if job.cancelled() else job.exception()
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(exc)
+        else:
+            for (_, fut), result in zip(batch, job.result()):
+                if not fut.done():
+                    fut.set_result(result)
+        # Numbers that piled up while the workers were busy go out now
+        self.__dispatch()
+
+
+scheduler = PrimeScheduler(pt, CACHES[CACHE_POLICY](CACHE_SIZE) if CACHE_POLICY in CACHES else None)
+
+# Numbers answered in the event loop are timed one by one, the ones sent to
+# the pool a batch at a time
+INLINE = metrics.histogram("prime_request_seconds", "Time to answer a number in the event loop")
+POOLED = metrics.counter("prime_pooled_total", "Numbers sent to the worker pool")
+INVALID = metrics.counter("prime_invalid_total", "Malformed requests")
+POOL_BATCH = metrics.histogram("prime_pool_batch_seconds", "Time for the worker pool to check a batch")
+metrics.gauge("prime_pool_pending", "Numbers waiting for a pool worker", lambda: len(scheduler.pending))
+metrics.gauge("prime_pool_inflight", "Batches being checked by the pool", lambda: scheduler.inflight)
+if scheduler.cache is not None:
+    metrics.gauge("prime_cache_hit_ratio", "Cache lookups that found an answer",
+                  lambda: scheduler.cache.hits / max(1, scheduler.cache.hits + scheduler.cache.misses))
+    metrics.gauge("prime_cache_evictions", "Answers evicted from the cache", lambda: scheduler.cache.evictions)
+
+
+def respond(o):
+    t = time.perf_counter_ns()
+    method = o["method"]
+    number = o["number"]
+    if method != "isPrime":
+        INVALID.value += 1
+        raise ValueError()
+    if type(number) == int:
+        prime = scheduler.check(number)
+        if isinstance(prime, asyncio.Future):
+            POOLED.value += 1
+            return prime
+        INLINE.record(time.perf_counter_ns() - t)
+        return {"method": method, "prime": prime}
+    elif type(number) == float:
+        return {"method": method, "prime": False}
+    else:
+        INVALID.value += 1
+        raise ValueError()
+
+
+def respond_all(lines: List[bytes]) -> tuple[list, bool]:
+    batch = []
+    for line in lines:
+        try:
+            batch.append(respond(runtime.loads(line)))
+        except (ValueError, KeyError, TypeError):
+            batch.append({"error": "invalid_json"})
+            return batch, False
+    return batch, True
+
+
+async def write_replies(w: asyncio.StreamWriter, replies: asyncio.Queue):
+    # Replies come in request order, in batches; pool results are awaited in place.
+    while (batch := await replies.get()) is not None:
+        out = []
+        for reply in batch:
+            if isinstance(reply, asyncio.Future):
+                reply = {"method": "isPrime", "prime": await reply}
+            out.append(runtime.dumps(reply))
+        out.append(b"")
+        w.write(b"\n".join(out))
+        if w.transport.get_write_buffer_size() > HIGH_WATER:
+            await w.drain()
+
+
+async def send(replies: asyncio.Queue, writer_task: asyncio.Task, batch):
+    # Queues a batch for the writer, or raises what stopped it, rather than
+    # waiting forever for room in the queue
+    if not writer_task.done() and not replies.full():
+        replies.put_nowait(batch)
+        return
+    if not writer_task.done():
+        put = asyncio.ensure_future(replies.put(batch))
+        await asyncio.wait([put, writer_task], return_when=asyncio.FIRST_COMPLETED)
+        if put.done():
+            return
+        put.cancel()
+    writer_task.result()
+    raise ConnectionError()
+
+
+async def handle_lines(r: asyncio.StreamReader, w: asyncio.StreamWriter):
+    replies = asyncio.Queue(PIPELINE_DEPTH)
+    writer_task = asyncio.create_task(write_replies(w, replies))
+    try:
+        while not r.at_eof():
+            try:
+                o = runtime.loads(await r.readuntil(b"\n"))
+                logging.debug(f"Request: {o}")
+                await send(replies, writer_task, [respond(o)])
+            except asyncio.LimitOverrunError:
+                await send(replies, writer_task, [{"error": "limit_overrun"}])
+                break
+            except asyncio.IncompleteReadError:
+                await send(replies, writer_task, [{"error": "invalid_terminator"}])
+                break
+            except (ValueError, KeyError, TypeError):
+                await send(replies, writer_task, [{"error": "invalid_json"}])
+                break
+        await send(replies, writer_task, None)
+        await writer_task
+    finally:
+        writer_task.cancel()
     await w.drain()
     w.close()
 
 
+async def handle_stream(r: asyncio.StreamReader, w: asyncio.StreamWriter):
+    replies = asyncio.Queue(PIPELINE_DEPTH)
+    writer_task = asyncio.create_task(write_replies(w, replies))
+    tail = b""
+    try:
+        while chunk := await r.read(CHUNK_SIZE):
+            lines = (tail + chunk).split(b"\n")
+            tail = lines.pop()
+            batch, ok = respond_all(lines)
+            if ok and len(tail) > LINE_LIMIT:
+                batch.append({"error": "limit_overrun"})
+                ok = False
+            await send(replies, writer_task, batch)
+            if not ok:
+                break
+        else:
+            if tail:
+                await send(replies, writer_task, [{"error": "invalid_terminator"}])
+        await send(replies, writer_task, None)
+        await writer_task
+    finally:
+        writer_task.cancel()
+    await w.drain()
+    w.close()
+
+
+handle = handle_stream if STREAMING else handle_lines
+
+
 async def main():
     logging.basicConfig(level=logging.DEBUG)
-    pt.is_prime(SEED)
-    server = await asyncio.start_server(handle, HOST, PORT)
-    logging.info("Server Ready.")
-    async with server:
-        await server.serve_forever()
+    # Not forked from here: the pool starts its workers on the first pooled
+    # test, when they would inherit the listening socket and open connections
+    executor = None
+    if PRIME_WORKERS > 0:
+        executor = ProcessPoolExecutor(PRIME_WORKERS, mp_context=multiprocessing.get_context("forkserver"))
+    scheduler.use_pool(executor, PRIME_WORKERS)
+    cache_file = CACHE_FILE
+    if cache_file and runtime.worker is not None:
+        cache_file = f"{CACHE_FILE}.{runtime.worker}"
+    if scheduler.cache is not None and cache_file:
+        scheduler.cache.load(cache_file)
+        logging.info(f"Loaded {cache_file}")
+    try:
+        server = await runtime.start_server(handle)
+        logging.info("Server Ready.")
+        await runtime.serve(server)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if scheduler.cache is not None:
+            logging.info(f"Cache: {scheduler.cache.stats()}")
+            if cache_file:
+                scheduler.cache.dump(cache_file)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    runtime.run(main)
@@ -1,61 +1,263 @@
 import asyncio
 import logging
-import statistics
+import os
 import struct
-import bisect
-from statistics import mean
-from itertools import takewhile, islice
+import time
+from array import array
+from bisect import bisect_left, bisect_right
 
-HOST = "0.0.0.0"
-PORT = 40000
+import metrics
+import runtime
+
+# Timestamps are kept in sorted blocks of BLOCK_SIZE to 2 * BLOCK_SIZE entries
+BLOCK_SIZE = 512
+
+# "eager" sorts on every insert, "lazy" buffers inserts until the next query
+PRICE_HISTORY = os.getenv("PRICE_HISTORY", "lazy")
+
+# Frames are received straight into a reusable buffer of BUFFER_SIZE bytes
+BUFFER_SIZE = 1 << 16
 
 request = struct.Struct('!cii')
 response = struct.Struct('!i')
 
 
+class Fenwick:
+    def __init__(self, values=()):
+        self.tree = array('q', [0])
+        self.tree.extend(values)
+        n = len(self.tree) - 1
+        for i in range(1, n + 1):
+            j = i + (i & -i)
+            if j <= n:
+                self.tree[j] += self.tree[i]
+
+    def add(self, i: int, delta: int):
+        i += 1
+        n = len(self.tree)
+        while i < n:
+            self.tree[i] += delta
+            i += i & -i
+
+    def append(self, value: int):
+        i = len(self.tree)
+        self.tree.append(value + self.prefix(i - 1) - self.prefix(i - (i & -i)))
+
+    def prefix(self, i: int) -> int:
+        # Sum of the first i values
+        s = 0
+        while i > 0:
+            s += self.tree[i]
+            i -= i & -i
+        return s
+
+
+def sorted_unique(times: array, prices: array):
+    # Sorts by timestamp; of several prices for one timestamp the last one wins
+    ts, ps = array('i'), array('i')
+    for i in sorted(range(len(times)), key=times.__getitem__):
+        if ts and ts[-1] == times[i]:
+            ps[-1] = prices[i]
+        else:
+            ts.append(times[i])
+            ps.append(prices[i])
+    return ts, ps
+
+
 class PriceHistory:
     def __init__(self):
         self.times = []
-        self.values = {}
+        self.prices = []
+        self.maxes = array('i')
+        self.block_sums = array('q')
+        self.sums = Fenwick()
+        self.counts = Fenwick()
+
+    def __reindex(self):
+        self.maxes = array('i', (t[-1] for t in self.times))
+        self.sums = Fenwick(self.block_sums)
+        self.counts = Fenwick(len(t) for t in self.times)
+
+    def __len__(self):
+        return self.counts.prefix(len(self.times))
+
+    def load_sorted(self, times: array, prices: array):
+        # Replaces the contents with strictly increasing timestamps
+        self.times = [times[i:i + BLOCK_SIZE] for i in range(0, len(times), BLOCK_SIZE)]
+        self.prices = [prices[i:i + BLOCK_SIZE] for i in range(0, len(prices), BLOCK_SIZE)]
+        self.block_sums = array('q', (sum(p) for p in self.prices))
+        self.__reindex()
+
+    def extend_sorted(self, times: array, prices: array):
+        # Appends strictly increasing timestamps, all later than the current ones
+        i = 0
+        if self.times:
+            b = len(self.times) - 1
+            i = min(len(times), 2 * BLOCK_SIZE - len(self.times[b]))
+            delta = sum(prices[:i])
+            self.times[b].extend(times[:i])
+            self.prices[b].extend(prices[:i])
+            self.maxes[b] = self.times[b][-1]
+            self.block_sums[b] += delta
+            self.sums.add(b, delta)
+            self.counts.add(b, i)
+        for j in range(i, len(times), BLOCK_SIZE):
+            t, p = times[j:j + BLOCK_SIZE], prices[j:j + BLOCK_SIZE]
+            self.times.append(t)
+            self.prices.append(p)
+            self.maxes.append(t[-1])
+            self.block_sums.append(sum(p))
+            self.sums.append(self.block_sums[-1])
+            self.counts.append(len(t))
 
     def insert_value(self, time, value):
-        bisect.insort_right(self.times, time)
-        self.values[time] = value
+        if not self.times:
+            self.times.append(array('i', [time]))
+            self.prices.append(array('i', [value]))
+            self.block_sums.append(value)
+            self.__reindex()
+            return
+
+        b = min(bisect_left(self.maxes, time), len(self.maxes) - 1)
+        times, prices = self.times[b], self.prices[b]
+        i = bisect_left(times, time)
+        if i < len(times) and times[i] == time:
+            # Undefined by the protocol: the latest price for a timestamp wins
+            self.block_sums[b] += value - prices[i]
+            self.sums.add(b, value - prices[i])
+            prices[i] = value
+            return
+
+        times.insert(i, time)
+        prices.insert(i, value)
+        self.maxes[b] = times[-1]
+        self.block_sums[b] += value
+        if len(times) > 2 * BLOCK_SIZE:
+            self.times[b:b + 1] = times[:BLOCK_SIZE], times[BLOCK_SIZE:]
+            self.prices[b:b + 1] = prices[:BLOCK_SIZE], prices[BLOCK_SIZE:]
+            head = sum(prices[:BLOCK_SIZE])
+            self.block_sums[b:b + 1] = array('q', [head, self.block_sums[b] - head])
+            self.__reindex()
+        else:
+            self.sums.add(b, value)
+            self.counts.add(b, 1)
 
     def mean_value_between(self, lo, hi):
-        try:
-            j = bisect.bisect_left(self.times, lo)
-            V = takewhile(lambda u: lo <= u <= hi, islice(self.times, j, None))
-            return mean(map(lambda u: self.values[u], V))
-        except statistics.StatisticsError:
+        if lo > hi or not self.times:
+            return 0
+        b1 = bisect_left(self.maxes, lo)
+        if b1 == len(self.maxes):
+            return 0
+        b2 = min(bisect_left(self.maxes, hi), len(self.maxes) - 1)
+
+        i = bisect_left(self.times[b1], lo)
+        j = bisect_right(self.times[b2], hi)
+        if b1 == b2:
+            total = sum(self.prices[b1][i:j])
+            count = max(j - i, 0)
+        else:
+            total = sum(self.prices[b1][i:]) + self.sums.prefix(b2) - self.sums.prefix(b1 + 1) + sum(self.prices[b2][:j])
+            count = len(self.times[b1]) - i + self.counts.prefix(b2) - self.counts.prefix(b1 + 1) + j
+
+        if count == 0:
             return 0
+        m = abs(total) // count
+        return m if total >= 0 else -m
 
 
-async def handle(r: asyncio.StreamReader, w: asyncio.StreamWriter):
-    H = PriceHistory()
-    while not r.at_eof():
-        try:
-            what, a, b = request.unpack(await r.readexactly(9))
-            logging.debug(f"Request: {id} - {what} {a} {b}")
+class LazyPriceHistory(PriceHistory):
+    # Inserts are appended to an unsorted tail, merged in by the next query.
+    def __init__(self):
+        super().__init__()
+        self.tail_times = array('i')
+        self.tail_prices = array('i')
+
+    def insert_value(self, time, value):
+        self.tail_times.append(time)
+        self.tail_prices.append(value)
+
+    def merge(self):
+        if not self.tail_times:
+            return
+        ts, ps = sorted_unique(self.tail_times, self.tail_prices)
+        self.tail_times, self.tail_prices = array('i'), array('i')
+        # Only the part of the tail that overlaps the sorted run needs inserting
+        k = bisect_right(ts, self.maxes[-1]) if self.times else 0
+        if 8 * k <= len(self):
+            for t, p in zip(ts[:k], ps[:k]):
+                super().insert_value(t, p)
+            self.extend_sorted(ts[k:], ps[k:])
+        else:
+            times, prices = array('i'), array('i')
+            for t, p in zip(self.times, self.prices):
+                times.extend(t)
+                prices.extend(p)
+            self.load_sorted(*sorted_unique(times + ts, prices + ps))
+
+    def mean_value_between(self, lo, hi):
+        self.merge()
+        return super().mean_value_between(lo, hi)
+
+
+HISTORIES = {"eager": PriceHistory, "lazy": LazyPriceHistory}
+
+
+# Frames are counted and timed a read at a time
+INSERTS = metrics.counter("means_frames_total", "Frames received", frame="insert")
+QUERIES = metrics.counter("means_frames_total", "Frames received", frame="query")
+BATCH = metrics.histogram("means_read_seconds", "Time to apply the frames of one read")
+
+
+class MeansProtocol(asyncio.BufferedProtocol):
+    def __init__(self):
+        self.history = HISTORIES[PRICE_HISTORY]()
+        self.buffer = memoryview(bytearray(BUFFER_SIZE))
+        self.end = 0
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.buffer[self.end:]
+
+    def buffer_updated(self, nbytes):
+        t = time.perf_counter_ns()
+        self.end += nbytes
+        n = self.end - self.end % request.size
+        insert, query = self.history.insert_value, self.history.mean_value_between
+        means = []
+        for what, a, b in request.iter_unpack(self.buffer[:n]):
             if what == b'I':
-                H.insert_value(a, b)
+                insert(a, b)
             elif what == b'Q':
-                m = int(H.mean_value_between(a, b))
-                logging.debug(f"Response: {m}")
-                w.write(response.pack(m))
-        except (ValueError, asyncio.IncompleteReadError):
-            w.write(response.pack(-1))
-    await w.drain()
-    w.close()
+                means.append(int(query(a, b)))
+        if means:
+            self.transport.write(struct.pack(f"!{len(means)}i", *means))
+        QUERIES.value += len(means)
+        INSERTS.value += n // request.size - len(means)
+        # Keep the partial frame, if any, for the next read
+        self.buffer[:self.end - n] = self.buffer[n:self.end]
+        self.end -= n
+        BATCH.record(time.perf_counter_ns() - t)
+
+    def eof_received(self):
+        if self.end:
+            self.transport.write(response.pack(-1))
+
+    def pause_writing(self):
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
 
 
 async def main():
     logging.basicConfig(level=logging.DEBUG)
-    server = await asyncio.start_server(handle, HOST, PORT)
+    server = await runtime.create_server(MeansProtocol)
     logging.info("Server Ready.")
-    async with server:
-        await server.serve_forever()
+    await runtime.serve(server)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    runtime.run(main)
\ No newline at end of file
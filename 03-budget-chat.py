@@ -1,13 +1,33 @@
 import asyncio
+import json
 import logging
+import multiprocessing
+import os
+import signal
+import socket
+import tempfile
+import zlib
+from collections import defaultdict, deque
 from dataclasses import dataclass
-from typing import Dict
+from itertools import count, islice
+from typing import Dict, List, Optional, Tuple
 
+import metrics
+import runtime
 
-HOST = "0.0.0.0"
-PORT = 40000
+# Each room keeps its last OUTBOX_SIZE frames. A member that falls further
+# behind either skips the frames it missed ("drop-oldest") or gets
+# disconnected ("disconnect"), according to SLOW_CONSUMER.
+OUTBOX_SIZE = int(os.getenv("OUTBOX_SIZE", 1024))
+SLOW_CONSUMER = os.getenv("SLOW_CONSUMER", "drop-oldest")
 
-USERS: Dict[str, asyncio.Queue] = {}
+# Everyone joins DEFAULT_ROOM, unless JOIN_ROOMS is set and they give their
+# name as "name@room". With CHAT_WORKERS > 0 that many processes share the
+# port through SO_REUSEPORT and exchange room events through a hub process.
+DEFAULT_ROOM = "lobby"
+JOIN_ROOMS = os.getenv("JOIN_ROOMS") == "1"
+ROOM_SHARDS = 16
+CHAT_WORKERS = int(os.getenv("CHAT_WORKERS", 0))
 
 WELCOME_MESSAGE = "Welcome to budgetchat! What shall I call you?\n"
 
@@ -23,87 +43,391 @@ class Message:
 @dataclass
 class ServerMessage:
     content: str
-    
+
     def __str__(self):
         return f'* {self.content}\n'
 
 
-def connect_user(username: str):
-    if username in USERS:
-        raise ValueError()
-    if len(username) < 1:
-        raise ValueError()
-    if not username.isalnum():
-        raise ValueError()
-    USERS[username] = asyncio.Queue()
-    for name, queue in USERS.items():
-        if name != username:
-            queue.put_nowait(ServerMessage(f'{username} has entered the room'))
-    logging.info(f'User connected: {username}')
+MESSAGES = metrics.counter("chat_messages_total", "Messages published to rooms")
+FAN_OUT = metrics.counter("chat_fan_out_total", "Members other than the sender that published frames were for")
+DROPPED = metrics.counter("chat_frames_dropped_total", "Frames slow members skipped")
+DISCONNECTED = metrics.counter("chat_slow_disconnects_total", "Members disconnected for falling behind")
+DELIVERY = metrics.histogram("chat_delivery_seconds", "Time from publishing a frame to writing it to a member")
 
 
-def disconnect_user(username: str):
-    if username in USERS:
-        del USERS[username]
-        for name, queue in USERS.items():
-            queue.put_nowait(ServerMessage(f'{username} has left the room'))
-        logging.info(f'User disconnected: {username}')
+class Member:
+    def __init__(self, room: "Room", name: str, w: asyncio.StreamWriter):
+        self.room = room
+        self.name = name
+        self.w = w
+        self.cursor = room.head
 
 
-def send_message(m: Message):
-    for name, queue in USERS.items():
-        if name != m.sender:
-            queue.put_nowait(m)
-    logging.info(f'Message sent: {str(m)}')
+class Room:
+    # Every frame is encoded once and appended to a shared ring. Members read
+    # it through their own cursor, so a member's outbox is the part of the
+    # ring between its cursor and the head.
+    def __init__(self, name: str, size: int = OUTBOX_SIZE):
+        self.name = name
+        self.members: Dict[str, Member] = {}
+        self.frames = deque(maxlen=size)
+        self.head = 0
+        self.changed = asyncio.Event()
 
+    @property
+    def base(self) -> int:
+        return self.head - len(self.frames)
 
-def room_membership(username: str):
-    U = ', '.join(u for u in USERS if u != username)
-    return str(ServerMessage(f"The room contains: {U}"))
+    def publish(self, sender: str, frame: bytes):
+        self.frames.append((sender, frame, asyncio.get_running_loop().time()))
+        self.head += 1
+        MESSAGES.value += 1
+        FAN_OUT.value += len(self.members) - (sender in self.members)
+        # Wake up every member waiting for frames
+        self.changed.set()
+        self.changed.clear()
 
+    def add(self, username: str, w: asyncio.StreamWriter) -> Member:
+        member = self.members[username] = Member(self, username, w)
+        logging.info(f'User connected: {username} ({self.name})')
+        return member
 
-async def handle(r: asyncio.StreamReader, w: asyncio.StreamWriter):
-    username = None
-    worker_task = None
+    def remove(self, username: str):
+        if self.members.pop(username, None) is not None:
+            logging.info(f'User disconnected: {username} ({self.name})')
 
-    async def worker_message():
+    async def deliver(self, member: Member):
+        loop = asyncio.get_running_loop()
         while True:
-            m = await USERS[username].get()
-            w.write(str(m).encode('utf8'))
-            USERS[username].task_done()
+            while member.cursor >= self.head:
+                await self.changed.wait()
+            if member.cursor < self.base:
+                if SLOW_CONSUMER == "disconnect":
+                    DISCONNECTED.value += 1
+                    member.w.close()
+                    return
+                DROPPED.value += self.base - member.cursor
+                member.cursor = self.base
+
+            batch, oldest = [], None
+            for sender, frame, published in islice(self.frames, member.cursor - self.base, None):
+                if sender != member.name:
+                    batch.append(frame)
+                    oldest = oldest or published
+            member.cursor = self.head
+            if batch:
+                member.w.writelines(batch)
+                await member.w.drain()
+                DELIVERY.record(int((loop.time() - oldest) * 1e9))
+
+
+class RoomRegistry:
+    def __init__(self, shards: int = ROOM_SHARDS):
+        self.shards = [{} for _ in range(shards)]
+
+    def __shard(self, name: str) -> Dict[str, Room]:
+        return self.shards[zlib.crc32(name.encode('utf8')) % len(self.shards)]
+
+    def __iter__(self):
+        for shard in self.shards:
+            yield from shard.values()
+
+    def find(self, name: str) -> Optional[Room]:
+        return self.__shard(name).get(name)
+
+    def get(self, name: str) -> Room:
+        shard = self.__shard(name)
+        if name not in shard:
+            shard[name] = Room(name)
+        return shard[name]
+
+    def discard(self, name: str):
+        # Rooms are dropped once their last local member has left
+        shard = self.__shard(name)
+        if name in shard and not shard[name].members:
+            del shard[name]
+
+
+ROOMS = RoomRegistry()
+
+metrics.gauge("chat_members", "Members of each room", lambda: {r.name: len(r.members) for r in ROOMS}, label="room")
+# A member's outbox is the frames between its cursor and the head of the ring
+metrics.gauge("chat_outbox_frames", "Frames waiting to be written, over the members of each room",
+              lambda: {r.name: sum(r.head - m.cursor for m in r.members.values()) for r in ROOMS}, label="room")
+
+
+def entered(username: str) -> bytes:
+    return str(ServerMessage(f'{username} has entered the room')).encode('utf8')
+
+
+def left(username: str) -> bytes:
+    return str(ServerMessage(f'{username} has left the room')).encode('utf8')
+
+
+def membership(usernames: List[str]) -> bytes:
+    U = ', '.join(usernames)
+    return str(ServerMessage(f"The room contains: {U}")).encode('utf8')
+
+
+def parse_name(line: str) -> Tuple[str, str]:
+    username, room = line, DEFAULT_ROOM
+    if JOIN_ROOMS and '@' in line:
+        username, _, room = line.partition('@')
+    for name in (username, room):
+        if len(name) < 1:
+            raise ValueError()
+        if not name.isalnum():
+            raise ValueError()
+    return room, username
+
+
+class LocalBus:
+    async def join(self, room_name: str, username: str, w: asyncio.StreamWriter) -> Tuple[Member, List[str]]:
+        room = ROOMS.get(room_name)
+        if username in room.members:
+            raise ValueError()
+        others = list(room.members)
+        member = room.add(username, w)
+        room.publish(username, entered(username))
+        return member, others
+
+    def leave(self, room_name: str, username: str):
+        room = ROOMS.find(room_name)
+        if room is not None and username in room.members:
+            room.remove(username)
+            room.publish(username, left(username))
+            ROOMS.discard(room_name)
+
+    def send(self, room_name: str, m: Message):
+        ROOMS.get(room_name).publish(m.sender, str(m).encode('utf8'))
+        logging.info(f'Message sent: {str(m)}')
+
+
+class HubBus:
+    # Worker side of the hub connection. Joins, leaves and messages go to the
+    # hub, which orders them and relays them back to every worker, the sender
+    # included, so all processes publish the same frames in the same order.
+    def __init__(self):
+        self.r, self.w = None, None
+        self.ids = count()
+        self.pending = {}
+
+    async def connect(self, path: str):
+        self.r, self.w = await asyncio.open_unix_connection(path)
+
+    def post(self, o: dict):
+        self.w.write(json.dumps(o).encode('utf8') + b'\n')
+
+    async def join(self, room_name: str, username: str, w: asyncio.StreamWriter) -> Tuple[Member, List[str]]:
+        fut = asyncio.get_running_loop().create_future()
+        i = next(self.ids)
+        self.pending[i] = fut, room_name, username, w
+        self.post({"op": "join", "id": i, "room": room_name, "name": username})
+        return await fut
+
+    def leave(self, room_name: str, username: str):
+        room = ROOMS.find(room_name)
+        if room is not None and username in room.members:
+            room.remove(username)
+            ROOMS.discard(room_name)
+            self.post({"op": "leave", "room": room_name, "name": username})
+
+    def send(self, room_name: str, m: Message):
+        self.post({"op": "say", "room": room_name, "name": m.sender, "content": m.content})
+
+    def __joined(self, o: dict):
+        fut, room_name, username, w = self.pending.pop(o["id"])
+        if not o["ok"]:
+            if not fut.done():
+                fut.set_exception(ValueError())
+        elif fut.done():
+            # The client went away while the hub was deciding
+            self.post({"op": "leave", "room": room_name, "name": username})
+        else:
+            # Register before reading on, so no frame after the join is missed
+            fut.set_result((ROOMS.get(room_name).add(username, w), o["members"]))
+
+    async def run(self):
+        while line := await self.r.readline():
+            o = json.loads(line)
+            if o["op"] == "joined":
+                self.__joined(o)
+                continue
+            room = ROOMS.find(o["room"])
+            if room is None:
+                continue
+            match o["op"]:
+                case "enter":
+                    room.publish(o["name"], entered(o["name"]))
+                case "leave":
+                    room.publish(o["name"], left(o["name"]))
+                case "say":
+                    room.publish(o["name"], str(Message(o["name"], o["content"])).encode('utf8'))
+
+
+class Hub:
+    # Runs in the parent process and keeps the membership of every room.
+    def __init__(self):
+        self.workers = set()
+        self.handlers = set()
+        self.rooms = defaultdict(dict)
+
+    def broadcast(self, o: dict):
+        data = json.dumps(o).encode('utf8') + b'\n'
+        for w in self.workers:
+            w.write(data)
+
+    def __leave(self, room_name: str, username: str, w: asyncio.StreamWriter):
+        room = self.rooms.get(room_name, {})
+        if room.get(username) is w:
+            del room[username]
+            if not room:
+                del self.rooms[room_name]
+            self.broadcast({"op": "leave", "room": room_name, "name": username})
+
+    async def handle(self, r: asyncio.StreamReader, w: asyncio.StreamWriter):
+        self.workers.add(w)
+        self.handlers.add(asyncio.current_task())
+        joined = set()
+        try:
+            while line := await r.readline():
+                o = json.loads(line)
+                room_name, username = o["room"], o["name"]
+                match o["op"]:
+                    case "join":
+                        room = self.rooms[room_name]
+                        ok = username not in room
+                        w.write(json.dumps({"op": "joined", "id": o["id"], "ok": ok,
+                                            "members": list(room)}).encode('utf8') + b'\n')
+                        if ok:
+                            room[username] = w
+                            joined.add((room_name, username))
+                            self.broadcast({"op": "enter", "room": room_name, "name": username})
+                    case "leave":
+                        joined.discard((room_name, username))
+                        self.__leave(room_name, username, w)
+                    case "say":
+                        if self.rooms.get(room_name, {}).get(username) is w:
+                            self.broadcast(o)
+                # Only the sender waits for its own worker to catch up. The
+                # others keep reading, as their workers never stop reading
+                # from the hub.
+                await w.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.workers.discard(w)
+            self.handlers.discard(asyncio.current_task())
+            for room_name, username in joined:
+                self.__leave(room_name, username, w)
+            w.close()
+
+    async def close(self):
+        # Forget the workers first, so the handlers don't broadcast the
+        # leaves of their members to connections that are closing
+        workers = list(self.workers)
+        self.workers.clear()
+        for w in workers:
+            w.close()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+
+
+BUS = LocalBus()
+
+
+async def handle(r: asyncio.StreamReader, w: asyncio.StreamWriter):
+    member = None
+    worker_task = None
 
     async def disconnect():
-        if username is not None:
-            disconnect_user(username)
+        if member is not None:
+            BUS.leave(member.room.name, member.name)
         if worker_task is not None:
             worker_task.cancel()
-            await asyncio.gather(worker_task)
-        await w.drain()
+            await asyncio.gather(worker_task, return_exceptions=True)
+        try:
+            await w.drain()
+        except ConnectionError:
+            pass
         w.close()
 
     try:
         w.write(WELCOME_MESSAGE.encode('utf8'))
-        username = (await r.readline()).decode('utf8').strip()
-        connect_user(username)
-        worker_task = asyncio.create_task(worker_message())
-        w.write(room_membership(username).encode('utf8'))
+        room_name, username = parse_name((await r.readline()).decode('utf8').strip())
+        member, others = await BUS.join(room_name, username, w)
+        w.write(membership(others))
+        worker_task = asyncio.create_task(member.room.deliver(member))
         while not r.at_eof():
             content = (await r.readline()).decode('utf8').strip()
             if content:
-                send_message(Message(username, content))
-    except ValueError:
+                BUS.send(room_name, Message(username, content))
+    except (ValueError, ConnectionError):
         pass
     finally:
         await disconnect()
 
 
-async def main():
+async def main(host: str = runtime.HOST, port: int = runtime.PORT):
     logging.basicConfig(level=logging.DEBUG)
-    server = await asyncio.start_server(handle, HOST, PORT)
+    server = await runtime.start_server(handle, host, port)
     logging.info("Server Ready.")
+    await runtime.serve(server)
+
+
+async def worker_main(index: int, path: str, host: str, port: int):
+    global BUS
+    logging.basicConfig(level=logging.DEBUG)
+    BUS = HubBus()
+    await BUS.connect(path)
+    await metrics.start(index)
+    server = await runtime.start_server(handle, host, port, reuse_port=True)
+    logging.info(f"Worker {os.getpid()} Ready.")
     async with server:
-        await server.serve_forever()
+        # Without the hub there is no consistent view of the rooms left
+        await BUS.run()
+
+
+def run_worker(index: int, path: str, host: str, port: int):
+    asyncio.run(worker_main(index, path, host, port))
+
+
+async def hub_main(sock: socket.socket):
+    logging.basicConfig(level=logging.DEBUG)
+    hub = Hub()
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    server = await asyncio.start_unix_server(hub.handle, sock=sock)
+    async with server:
+        await stop.wait()
+        server.close()
+        await hub.close()
+
+
+def serve(workers: int = CHAT_WORKERS, host: str = runtime.HOST, port: int = runtime.PORT):
+    # The rooms have their own way of spreading over processes, so only the
+    # event loop and socket options come from the runtime
+    runtime.use_loop()
+    if workers == 0:
+        asyncio.run(main(host, port))
+        return
+
+    # The hub socket is listening before the workers are forked, so they can
+    # connect to it straight away.
+    path = os.path.join(tempfile.mkdtemp(), "hub.sock")
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen()
+    ctx = multiprocessing.get_context("fork")
+    processes = [ctx.Process(target=run_worker, args=(i, path, host, port), daemon=True) for i in range(workers)]
+    for p in processes:
+        p.start()
+    try:
+        asyncio.run(hub_main(sock))
+    finally:
+        for p in processes:
+            p.terminate()
+        os.unlink(path)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    serve()
@@ -1,63 +1,579 @@
 import asyncio
-import json
+import ctypes
+import errno
 import logging
-from collections import defaultdict
+import marshal
+import mmap
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import sys
+import time
+import zlib
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Optional, Tuple
 
-HOST = "0.0.0.0"
-PORT = 40000
+import metrics
+import runtime
+
+VERSION = b'udp keystore 1.0'
+
+# With UDP_WORKERS > 0 that many processes share the port through SO_REUSEPORT,
+# each owning the keys that hash to it, and exchange packets BATCH_SIZE at a
+# time through recvmmsg/sendmmsg where available.
+UDP_WORKERS = int(os.getenv("UDP_WORKERS", 0))
+BATCH_SIZE = 64
+MAX_DATAGRAM = 1 << 11
+
+# STORE is "dict" (unbounded, in memory), "memory" (LRU bounded to
+# STORE_MAX_BYTES) or "log" (persisted to STORE_PATH.log, one file per worker).
+# Log writes reach the file at least every FLUSH_INTERVAL seconds.
+STORE = os.getenv("STORE", "dict")
+STORE_MAX_BYTES = int(os.getenv("STORE_MAX_BYTES", 1 << 28))
+STORE_PATH = os.getenv("STORE_PATH", "kv")
+FLUSH_INTERVAL = 0.1
 
-VERSION = 'udp keystore 1.0'
 
 class Store:
     def __init__(self):
-        self.d = defaultdict(str)
+        self.d = {}
 
     def get(self, key):
-        if key == 'version':
+        if key == b'version':
             return VERSION
         else:
-            return self.d[key]
+            return self.d.get(key, b'')
 
     def set(self, key, value):
-        if key == 'version':
+        if key == b'version':
             pass
         else:
             self.d[key] = value
 
-s = Store()
+    def flush(self):
+        pass
+
+    def compaction_due(self) -> bool:
+        return False
+
+    def close(self):
+        pass
+
+
+class MemoryStore(Store):
+    # Least recently used keys are evicted once keys and values take up more
+    # than max_bytes, counting the size of the bytes objects themselves.
+    def __init__(self, max_bytes: int = STORE_MAX_BYTES):
+        self.d = OrderedDict()
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.evictions = 0
+
+    def get(self, key):
+        if key == b'version':
+            return VERSION
+        value = self.d.get(key)
+        if value is None:
+            return b''
+        self.d.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        if key == b'version':
+            return
+        old = self.d.pop(key, None)
+        if old is None:
+            self.bytes += sys.getsizeof(key)
+        else:
+            self.bytes -= sys.getsizeof(old)
+        self.d[key] = value
+        self.bytes += sys.getsizeof(value)
+        while self.bytes > self.max_bytes and self.d:
+            k, v = self.d.popitem(last=False)
+            self.bytes -= sys.getsizeof(k) + sys.getsizeof(v)
+            self.evictions += 1
+
+
+class LogStore(Store):
+    # Every set is appended to `<path>.log` as a record header, key and value.
+    # Compaction rewrites the log with only the live records and writes an open
+    # addressing table of (crc32 of key, record offset + 1) slots to `<path>.idx`.
+    # Startup maps both files and only replays the records written after the
+    # table, so neither startup nor memory grows with the number of keys; the
+    # keys set since the last compaction are indexed in a dict.
+    # Both files carry the generation of the compaction that wrote them, so a
+    # crash between replacing one and the other cannot pair them up wrongly.
+    HEADER = struct.Struct('!8sQ')
+    RECORD = struct.Struct('!HI')
+    INDEX = struct.Struct('!8sQQQ')
+    SLOT = struct.Struct('!QQ')
+    MAGIC = b'KVLOG001'
+    FLUSH_BYTES = 1 << 16
+    COMPACT_MIN = 1 << 22
+
+    def __init__(self, path: str = STORE_PATH):
+        self.log_path, self.index_path = path + '.log', path + '.idx'
+        self.open()
+
+    def open(self):
+        self.fd = os.open(self.log_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        header = os.pread(self.fd, self.HEADER.size, 0)
+        if len(header) < self.HEADER.size or self.HEADER.unpack(header)[0] != self.MAGIC:
+            os.ftruncate(self.fd, 0)
+            os.write(self.fd, self.HEADER.pack(self.MAGIC, 0))
+            header = self.HEADER.pack(self.MAGIC, 0)
+        self.generation = self.HEADER.unpack(header)[1]
+        self.pending = bytearray()
+        self.recent: Dict[bytes, Tuple[int, int]] = {}
+        self.log = self.table = None
+        self.base, self.slots = self.HEADER.size, 0
+        self.open_index()
+        self.flushed = self.replay(self.base)
+        os.ftruncate(self.fd, self.flushed)
+
+    def open_index(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                table = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return
+        magic, generation, base, slots = self.INDEX.unpack_from(table)
+        if magic != self.MAGIC or generation != self.generation or base > os.fstat(self.fd).st_size:
+            table.close()
+            return
+        self.table, self.base, self.slots = table, base, slots
+        self.log = mmap.mmap(self.fd, base, access=mmap.ACCESS_READ)
+
+    def replay(self, offset: int) -> int:
+        size = os.fstat(self.fd).st_size
+        tail = os.pread(self.fd, size - offset, offset)
+        i = 0
+        while i + self.RECORD.size <= len(tail):
+            key_length, value_length = self.RECORD.unpack_from(tail, i)
+            end = i + self.RECORD.size + key_length + value_length
+            if end > len(tail):
+                break
+            key = tail[i + self.RECORD.size:i + self.RECORD.size + key_length]
+            self.recent[key] = (offset + end - value_length, value_length)
+            i = end
+        # A record cut short by a crash is dropped
+        return offset + i
+
+    def lookup(self, key: bytes) -> Optional[bytes]:
+        if not self.slots:
+            return None
+        h = zlib.crc32(key)
+        mask = self.slots - 1
+        i = h & mask
+        while True:
+            slot_hash, offset = self.SLOT.unpack_from(self.table, self.INDEX.size + i * self.SLOT.size)
+            if not offset:
+                return None
+            if slot_hash == h:
+                key_length, value_length = self.RECORD.unpack_from(self.log, offset - 1)
+                start = offset - 1 + self.RECORD.size
+                if self.log[start:start + key_length] == key:
+                    return self.log[start + key_length:start + key_length + value_length]
+            i = (i + 1) & mask
+
+    def read(self, offset: int, length: int) -> bytes:
+        if offset >= self.flushed:
+            offset -= self.flushed
+            return bytes(self.pending[offset:offset + length])
+        return os.pread(self.fd, length, offset)
+
+    def get(self, key):
+        if key == b'version':
+            return VERSION
+        location = self.recent.get(key)
+        if location is not None:
+            return self.read(*location)
+        value = self.lookup(key)
+        return b'' if value is None else value
+
+    def set(self, key, value):
+        if key == b'version':
+            return
+        offset = self.flushed + len(self.pending) + self.RECORD.size + len(key)
+        self.pending += self.RECORD.pack(len(key), len(value))
+        self.pending += key
+        self.pending += value
+        self.recent[key] = (offset, len(value))
+        if len(self.pending) >= self.FLUSH_BYTES:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.flushed += os.write(self.fd, self.pending)
+            self.pending.clear()
+
+    def compaction_due(self) -> bool:
+        return self.flushed - self.base >= max(self.COMPACT_MIN, self.base)
+
+    def items(self, recent: Optional[dict] = None):
+        if recent is None:
+            recent = self.recent
+        for i in range(self.slots):
+            _, offset = self.SLOT.unpack_from(self.table, self.INDEX.size + i * self.SLOT.size)
+            if offset:
+                key_length, value_length = self.RECORD.unpack_from(self.log, offset - 1)
+                start = offset - 1 + self.RECORD.size
+                key = self.log[start:start + key_length]
+                if key not in recent:
+                    yield key, self.log[start + key_length:start + key_length + value_length]
+        for key, location in recent.items():
+            yield key, self.read(*location)
+
+    def compact(self):
+        self.flush()
+        end = self.flushed
+        self.rewrite(self.recent)
+        self.swap(end)
+
+    async def compact_in_background(self):
+        # The rewrite only reads records from before `end`, so sets carry on
+        # meanwhile and are copied over by swap()
+        self.flush()
+        end = self.flushed
+        await asyncio.get_running_loop().run_in_executor(None, self.rewrite, dict(self.recent))
+        self.swap(end)
+
+    def rewrite(self, recent: dict):
+        # Writes the live records and their table to .tmp files, taking the
+        # keys set since the last compaction from `recent`
+        offsets = []
+        generation = self.generation + 1
+        with open(self.log_path + '.tmp', 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, generation))
+            for key, value in self.items(recent):
+                offsets.append((zlib.crc32(key), f.tell() + 1))
+                f.write(self.RECORD.pack(len(key), len(value)))
+                f.write(key)
+                f.write(value)
+            base = f.tell()
+            f.flush()
+            os.fsync(f.fileno())
+        slots = 1 << max(4, (2 * len(offsets)).bit_length())
+        table = bytearray(self.INDEX.size + slots * self.SLOT.size)
+        self.INDEX.pack_into(table, 0, self.MAGIC, generation, base, slots)
+        mask = slots - 1
+        for h, offset in offsets:
+            i = h & mask
+            while self.SLOT.unpack_from(table, self.INDEX.size + i * self.SLOT.size)[1]:
+                i = (i + 1) & mask
+            self.SLOT.pack_into(table, self.INDEX.size + i * self.SLOT.size, h, offset)
+        with open(self.index_path + '.tmp', 'wb') as f:
+            f.write(table)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def swap(self, end: int):
+        # Appends what was set since `end` to the rewritten log, where open()
+        # replays it, and puts the new files in place
+        self.flush()
+        with open(self.log_path + '.tmp', 'ab') as f:
+            f.write(os.pread(self.fd, self.flushed - end, end))
+            f.flush()
+            os.fsync(f.fileno())
+        self.close()
+        os.replace(self.log_path + '.tmp', self.log_path)
+        os.replace(self.index_path + '.tmp', self.index_path)
+        self.open()
+
+    def close(self):
+        if self.pending:
+            self.flushed += os.write(self.fd, self.pending)
+            self.pending.clear()
+        if self.log is not None:
+            self.log.close()
+        if self.table is not None:
+            self.table.close()
+        os.close(self.fd)
+
+
+STORES = {"dict": Store, "memory": MemoryStore, "log": LogStore}
+
+
+def open_store(index: Optional[int] = None) -> Store:
+    if STORE == "log":
+        return LogStore(STORE_PATH if index is None else f"{STORE_PATH}.{index}")
+    return STORES[STORE]()
+
+
+def handle_packet(store: Store, data: bytes) -> Optional[bytes]:
+    key, eq, value = data.partition(b'=')
+    if eq:
+        store.set(key, value)
+        return None
+    return key + b'=' + store.get(key)
+
+
+async def keep_flushed(store: Store):
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        store.flush()
+        if store.compaction_due():
+            await store.compact_in_background()
+
+
+async def run_until_terminated(store: Store):
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    loop.add_signal_handler(signal.SIGTERM, stop.set_result, None)
+    flusher = asyncio.create_task(keep_flushed(store))
+    try:
+        await stop
+    finally:
+        flusher.cancel()
+        store.close()
+
+
+# Workers count and time packets a batch at a time
+RECEIVED = metrics.counter("kv_packets_total", "Packets taken off the socket", path="received")
+FORWARDED = metrics.counter("kv_packets_total", "Packets taken off the socket", path="forwarded")
+BATCH = metrics.histogram("kv_batch_seconds", "Time to serve one batch of packets")
 
 
 class EchoServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, store: Store):
+        self.store = store
+
     def connection_made(self, transport):
         self.transport = transport
 
     def datagram_received(self, data, addr):
-        message = data.decode('utf8')
-        parts = message.split('=')
-        if len(parts) == 1:
-            key = parts[0]
-            value = s.get(parts[0])
-            response = f'{key}={value}'.encode('utf8')
+        RECEIVED.value += 1
+        response = handle_packet(self.store, data)
+        if response is not None:
             self.transport.sendto(response, addr)
-        else:
-            key = parts[0]
-            value = '='.join(parts[1:])
-            s.set(key, value)
 
 
-async def main():
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(iovec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+
+class PlainSocket:
+    # One syscall per datagram; addresses are the usual (host, port) tuples.
+    def __init__(self, sock: socket.socket, batch: int = BATCH_SIZE):
+        self.sock = sock
+        self.batch = batch
+        self.buffer = bytearray(MAX_DATAGRAM)
+
+    def recv_batch(self) -> List[Tuple[bytes, object]]:
+        packets = []
+        while len(packets) < self.batch:
+            try:
+                n, addr = self.sock.recvfrom_into(self.buffer)
+            except (BlockingIOError, InterruptedError):
+                break
+            packets.append((bytes(self.buffer[:n]), addr))
+        return packets
+
+    def send_batch(self, packets: List[Tuple[bytes, object]]):
+        for data, addr in packets:
+            try:
+                self.sock.sendto(data, addr)
+            except (BlockingIOError, InterruptedError):
+                # A full send buffer drops the reply, as the network might have
+                pass
+
+
+class MMsgSocket:
+    # recvmmsg/sendmmsg through libc; addresses are raw sockaddr bytes.
+    SOCKADDR_SIZE = 128
+    MSG_DONTWAIT = 0x40
+    MSG_TRUNC = 0x20
+
+    def __init__(self, sock: socket.socket, batch: int = BATCH_SIZE):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.recvmmsg, self.sendmmsg = libc.recvmmsg, libc.sendmmsg
+        self.sock = sock
+        self.batch = batch
+        self.buffers = [ctypes.create_string_buffer(MAX_DATAGRAM) for _ in range(batch)]
+        self.names = [ctypes.create_string_buffer(self.SOCKADDR_SIZE) for _ in range(batch)]
+        self.iovecs = (iovec * batch)()
+        self.msgs = (mmsghdr * batch)()
+        for i in range(batch):
+            self.iovecs[i].iov_base = ctypes.addressof(self.buffers[i])
+            self.iovecs[i].iov_len = MAX_DATAGRAM
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self.names[i])
+            hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            hdr.msg_iovlen = 1
+        self.out_iovecs = (iovec * batch)()
+        self.out_msgs = (mmsghdr * batch)()
+
+    def recv_batch(self) -> List[Tuple[bytes, bytes]]:
+        for i in range(self.batch):
+            self.msgs[i].msg_hdr.msg_namelen = self.SOCKADDR_SIZE
+        n = self.recvmmsg(self.sock.fileno(), self.msgs, self.batch, self.MSG_DONTWAIT, None)
+        if n < 0:
+            if ctypes.get_errno() in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        packets = []
+        for i in range(n):
+            msg = self.msgs[i]
+            if msg.msg_hdr.msg_flags & self.MSG_TRUNC:
+                continue
+            packets.append((ctypes.string_at(self.buffers[i], msg.msg_len),
+                            ctypes.string_at(self.names[i], msg.msg_hdr.msg_namelen)))
+        return packets
+
+    def send_batch(self, packets: List[Tuple[bytes, bytes]]):
+        for start in range(0, len(packets), self.batch):
+            chunk = packets[start:start + self.batch]
+            # Keep the payloads alive until the call returns
+            keep = []
+            for i, (data, addr) in enumerate(chunk):
+                data_buf, addr_buf = ctypes.c_char_p(data), ctypes.c_char_p(addr)
+                keep += data_buf, addr_buf
+                self.out_iovecs[i].iov_base = ctypes.cast(data_buf, ctypes.c_void_p)
+                self.out_iovecs[i].iov_len = len(data)
+                hdr = self.out_msgs[i].msg_hdr
+                hdr.msg_name = ctypes.cast(addr_buf, ctypes.c_void_p)
+                hdr.msg_namelen = len(addr)
+                hdr.msg_iov = ctypes.pointer(self.out_iovecs[i])
+                hdr.msg_iovlen = 1
+            # Whatever does not fit in the send buffer is dropped
+            self.sendmmsg(self.sock.fileno(), self.out_msgs, len(chunk), self.MSG_DONTWAIT)
+
+
+def batch_socket(sock: socket.socket):
+    try:
+        return MMsgSocket(sock)
+    except (OSError, AttributeError):
+        return PlainSocket(sock)
+
+
+def owner(key: bytes, workers: int) -> int:
+    return zlib.crc32(key) % workers
+
+
+class Worker:
+    # Serves the keys that hash to `index`. Packets for other keys are passed
+    # to their owner, which replies to the client from its own socket.
+    def __init__(self, index: int, sock: socket.socket, inboxes: List[socket.socket],
+                 outboxes: List[socket.socket]):
+        self.index = index
+        self.store = open_store(index)
+        self.sock = batch_socket(sock)
+        self.inbox = inboxes[index]
+        self.outboxes = outboxes
+        self.workers = len(outboxes)
+
+    def apply(self, packets, replies):
+        for data, addr in packets:
+            response = handle_packet(self.store, data)
+            if response is not None:
+                replies.append((response, addr))
+
+    def on_packets(self):
+        while True:
+            t = time.perf_counter_ns()
+            packets = self.sock.recv_batch()
+            mine, forward = [], defaultdict(list)
+            for data, addr in packets:
+                i = owner(data.partition(b'=')[0], self.workers)
+                if i == self.index:
+                    mine.append((data, addr))
+                else:
+                    forward[i].append((data, addr))
+            for i, batch in forward.items():
+                try:
+                    self.outboxes[i].send(marshal.dumps(batch))
+                except (BlockingIOError, InterruptedError):
+                    pass
+            replies = []
+            self.apply(mine, replies)
+            self.sock.send_batch(replies)
+            RECEIVED.value += len(packets)
+            FORWARDED.value += len(packets) - len(mine)
+            BATCH.record(time.perf_counter_ns() - t)
+            if len(packets) < self.sock.batch:
+                return
+
+    def on_forwarded(self):
+        replies = []
+        while True:
+            try:
+                self.apply(marshal.loads(self.inbox.recv(1 << 20)), replies)
+            except (BlockingIOError, InterruptedError):
+                break
+        self.sock.send_batch(replies)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.sock.sock.fileno(), self.on_packets)
+        loop.add_reader(self.inbox.fileno(), self.on_forwarded)
+        logging.info(f"Worker {self.index} Ready ({type(self.sock).__name__}, {type(self.store).__name__}).")
+        await metrics.start(self.index)
+        await run_until_terminated(self.store)
+
+
+def run_worker(index: int, host: str, port: int, inboxes, outboxes):
+    logging.basicConfig(level=logging.DEBUG)
+    sock = runtime.listen(host, port, reuse_port=True, type=socket.SOCK_DGRAM)
+    asyncio.run(Worker(index, sock, inboxes, outboxes).run())
+
+
+def serve(workers: int = UDP_WORKERS, host: str = runtime.HOST, port: int = runtime.PORT):
+    # Keys are sharded over the workers here, so only the event loop and
+    # socket options come from the runtime
+    runtime.use_loop()
+    if workers == 0:
+        asyncio.run(main(host, port))
+        return
+
+    # Worker i reads its inbox, the other workers write to outboxes[i]
+    pairs = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(workers)]
+    inboxes, outboxes = [b for _, b in pairs], [a for a, _ in pairs]
+    for sock in inboxes + outboxes:
+        sock.setblocking(False)
+    ctx = multiprocessing.get_context("fork")
+    processes = [ctx.Process(target=run_worker, args=(i, host, port, inboxes, outboxes))
+                 for i in range(workers)]
+    for p in processes:
+        p.start()
+    # Pass termination on to the workers so they can flush their stores
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit())
+    try:
+        for p in processes:
+            p.join()
+    finally:
+        for p in processes:
+            p.terminate()
+        for p in processes:
+            p.join()
+
+
+async def main(host: str = runtime.HOST, port: int = runtime.PORT):
     logging.basicConfig(level=logging.DEBUG)
     loop = asyncio.get_running_loop()
+    store = open_store()
     transport, protocol = await loop.create_datagram_endpoint(
-        lambda: EchoServerProtocol(),
-        local_addr=(HOST, PORT))
-    logging.info("Server Ready.")
+        lambda: EchoServerProtocol(store),
+        sock=runtime.listen(host, port, type=socket.SOCK_DGRAM))
+    logging.info(f"Server Ready ({type(store).__name__}).")
+    await metrics.start()
     try:
-        await asyncio.sleep(1000)
+        await run_until_terminated(store)
     finally:
         transport.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
-
+    serve()
@@ -1,66 +1,214 @@
 import asyncio
 import logging
+import os
 import re
+import socket
+import time
+from collections import deque
+from typing import Callable, Deque, List, Optional, Set, Tuple
+
+import metrics
+import runtime
+
+UPSTREAM_HOST = os.getenv("UPSTREAM_HOST", "chat.protohackers.com")
+UPSTREAM_PORT = int(os.getenv("UPSTREAM_PORT", 16963))
+
+# POOL_SIZE upstream connections are kept open ahead of the clients that will
+# use them, at most POOL_CONNECTS of them being opened at any time. Idle ones
+# are checked every HEALTH_INTERVAL seconds and replaced after POOL_MAX_IDLE
+# seconds, in case the upstream drops idle connections. The upstream's
+# addresses are looked up again every DNS_TTL seconds.
+POOL_SIZE = int(os.getenv("POOL_SIZE", 16))
+POOL_CONNECTS = int(os.getenv("POOL_CONNECTS", 8))
+POOL_MAX_IDLE = float(os.getenv("POOL_MAX_IDLE", 60))
+DNS_TTL = float(os.getenv("DNS_TTL", 300))
+HEALTH_INTERVAL = 1
+
+# Bytes are read this many at a time and forwarded as soon as they end a line
+CHUNK_SIZE = 1 << 16
+
+# An address is a whole word. Starting the pattern with the literal 7 and only
+# then looking behind it lets the regex engine skip ahead to the next 7.
+PATTERN = re.compile(rb"7(?<!\S7)[a-zA-Z0-9]{25,34}(?!\S)")
+TARGET = b"7YWHMfk9JZe0LM0g1ZauHuiSxhI"
+
+
+def replace(s: bytes) -> bytes:
+    # Every address starts with a 7, and most messages carry no 7 at all.
+    # sub hands back the same object when nothing matched.
+    if b'7' not in s:
+        return s
+    return PATTERN.sub(TARGET, s)
+
+
+TTFB = {warm: metrics.histogram("mob_first_byte_seconds", "Time to the first byte from the upstream",
+                               connection="warm" if warm else "cold") for warm in (True, False)}
+POOL_EVENTS = {event: metrics.counter("mob_pool_events_total", "Upstream pool events", event=event)
+               for event in ("warm", "cold", "connects", "failures", "discarded")}
+
+Upstream = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+
+class UpstreamPool:
+    def __init__(self, host: str, port: int, size: int = POOL_SIZE, connects: int = POOL_CONNECTS,
+                 max_idle: float = POOL_MAX_IDLE, dns_ttl: float = DNS_TTL):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.max_idle = max_idle
+        self.dns_ttl = dns_ttl
+        self.connecting = asyncio.Semaphore(connects)
+        self.idle: Deque[Tuple[float, asyncio.StreamReader, asyncio.StreamWriter]] = deque()
+        self.opening: Set[asyncio.Task] = set()
+        self.addresses: List[Tuple[int, str, int]] = []
+        self.resolved_at = 0.0
+        self.task = None
+
+    async def resolve(self) -> List[Tuple[int, str, int]]:
+        if not self.addresses or time.monotonic() - self.resolved_at > self.dns_ttl:
+            infos = await asyncio.get_running_loop().getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM)
+            self.addresses = [(family, address[0], address[1]) for family, _, _, _, address in infos]
+            self.resolved_at = time.monotonic()
+        return self.addresses
+
+    async def connect(self) -> Upstream:
+        async with self.connecting:
+            error = None
+            for family, host, port in await self.resolve():
+                try:
+                    upstream = await asyncio.open_connection(host, port, family=family)
+                    POOL_EVENTS["connects"].value += 1
+                    return upstream
+                except OSError as e:
+                    error = e
+            POOL_EVENTS["failures"].value += 1
+            # Look the name up again next time, the addresses may have moved
+            self.addresses = []
+            raise error or OSError(f"{self.host} has no addresses")
+
+    def healthy(self, opened: float, r: asyncio.StreamReader, w: asyncio.StreamWriter) -> bool:
+        return (time.monotonic() - opened < self.max_idle and not r.at_eof()
+                and r.exception() is None and not w.is_closing())
+
+    async def acquire(self) -> Tuple[Upstream, bool]:
+        # Returns a connection and whether it was opened ahead of time
+        while self.idle:
+            opened, r, w = self.idle.popleft()
+            if self.healthy(opened, r, w):
+                POOL_EVENTS["warm"].value += 1
+                self.refill()
+                return (r, w), True
+            POOL_EVENTS["discarded"].value += 1
+            w.close()
+        POOL_EVENTS["cold"].value += 1
+        self.refill()
+        return await self.connect(), False
+
+    def refill(self):
+        for _ in range(self.size - len(self.idle) - len(self.opening)):
+            task = asyncio.create_task(self.open_idle())
+            self.opening.add(task)
+            task.add_done_callback(self.opening.discard)
+
+    async def open_idle(self):
+        try:
+            r, w = await self.connect()
+            self.idle.append((time.monotonic(), r, w))
+        except OSError:
+            pass
+
+    async def maintain(self):
+        while True:
+            for _ in range(len(self.idle)):
+                opened, r, w = self.idle.popleft()
+                if self.healthy(opened, r, w):
+                    self.idle.append((opened, r, w))
+                else:
+                    POOL_EVENTS["discarded"].value += 1
+                    w.close()
+            self.refill()
+            await asyncio.sleep(HEALTH_INTERVAL)
+
+    def start(self):
+        self.task = asyncio.create_task(self.maintain())
+
+    def close(self):
+        self.task.cancel()
+        for task in self.opening:
+            task.cancel()
+        while self.idle:
+            self.idle.popleft()[2].close()
+
+
+pool: Optional[UpstreamPool] = None
+
+
+async def pump(r: asyncio.StreamReader, w: asyncio.StreamWriter, first_byte: Optional[Callable[[], None]] = None):
+    # Lines are rewritten whole, so a partial line waits for the rest of it.
+    # One longer than the reader limit ends the session, as readline() did.
+    pending = bytearray()
+    while data := await r.read(CHUNK_SIZE):
+        end = data.rfind(b'\n') + 1
+        if not end:
+            pending += data
+            if len(pending) > runtime.READ_BUFFER:
+                return
+            continue
+        if pending:
+            # Written as bytes, the transport may keep a reference to it
+            pending += data[:end]
+            w.write(replace(bytes(pending)))
+            pending.clear()
+        elif end == len(data):
+            w.write(replace(data))
+        else:
+            w.write(replace(data[:end]))
+        pending += data[end:]
+        if first_byte is not None:
+            first_byte()
+            first_byte = None
+        await w.drain()
+    if pending:
+        w.write(replace(bytes(pending)))
+        await w.drain()
 
 
-UPSTREAM_HOST = "chat.protohackers.com"
-UPSTREAM_PORT = 16963
-HOST = "0.0.0.0"
-PORT = 40000
-
-PATTERN = re.compile(r"(^|\s)(7[a-zA-Z0-9]{25,34})(?=($|\s))")
-
-
-class ConnectionDropped(Exception):
-    ...
-
-
-def replace(s: bytes):
-    def f(m):
-        TARGET_ADDR = "7YWHMfk9JZe0LM0g1ZauHuiSxhI"
-        return f"{m.group(1)}{TARGET_ADDR}"
-
-    return re.sub(PATTERN, f, s.decode('utf8')).encode('utf8')
+async def handle(r: asyncio.StreamReader, w: asyncio.StreamWriter):
+    start = time.perf_counter()
+    try:
+        (ur, uw), warm = await pool.acquire()
+    except OSError:
+        w.close()
+        return
 
+    def first_byte():
+        TTFB[warm].record(int((time.perf_counter() - start) * 1e9))
 
-async def handle(r: asyncio.StreamReader, w: asyncio.StreamWriter):
-    ur, uw = None, None
-
-    async def upstream():
-        while not r.at_eof():
-            content = await r.readline()
-            uw.write(replace(content))
-        raise ConnectionDropped()
-
-    async def downstream():
-        while not ur.at_eof():
-            content = await ur.readline()
-            w.write(replace(content))
-        raise ConnectionDropped()
-
-    async def cleanup():
-        await uw.drain()
+    pumps = [asyncio.create_task(pump(r, uw)), asyncio.create_task(pump(ur, w, first_byte))]
+    try:
+        # Either side hanging up ends the session for both
+        await asyncio.wait(pumps, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in pumps:
+            task.cancel()
+        await asyncio.gather(*pumps, return_exceptions=True)
         uw.close()
-        await uw.wait_closed()
-        await w.drain()
         w.close()
 
-    try:
-        ur, uw = await asyncio.open_connection(UPSTREAM_HOST, UPSTREAM_PORT)
-        upstream_task = asyncio.create_task(upstream())
-        downstream_task = asyncio.create_task(downstream())
-        await asyncio.gather(upstream_task, downstream_task)
-    except ConnectionDropped:
-        await cleanup()
+
+metrics.gauge("mob_pool_idle", "Upstream connections open and waiting for a client", lambda: len(pool.idle))
+metrics.gauge("mob_pool_opening", "Upstream connections being opened", lambda: len(pool.opening))
 
 
 async def main():
+    global pool
     logging.basicConfig(level=logging.DEBUG)
-    server = await asyncio.start_server(handle, HOST, PORT)
+    pool = UpstreamPool(UPSTREAM_HOST, UPSTREAM_PORT)
+    pool.start()
+    server = await runtime.start_server(handle)
     logging.info("Server Ready.")
-    async with server:
-        await server.serve_forever()
+    await runtime.serve(server)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    runtime.run(main)
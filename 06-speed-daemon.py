@@ -1,39 +1,128 @@
 import uuid
 import struct
+import time
 import asyncio
 import logging
-from collections import defaultdict
+from array import array
+from bisect import bisect_left
+from collections import defaultdict, deque
+from typing import Callable, Deque, Dict, List, Tuple
 
-HOST = "0.0.0.0"
-PORT = 40000
+import metrics
+import runtime
 
+DAY = 86400
+READ_SIZE = 1 << 16
 
-class State:
-    def __init__(self):
-        self.dispatchers = defaultdict(list)
-        self.cameras = {}
-        self.obs = defaultdict(list)
-        self.roads = {}
-
-    def add_camera(self, id):
-        ...
+# Heartbeat intervals are given in deciseconds, which is also the tick of the
+# wheel that sends them
+HEARTBEAT_TICK = 0.1
 
-    def add_dispatcher(self, id, roads):
-        ...
 
-    def register(self, cameraid, plate):
-        ...
+class State:
+    # Sightings are kept per (road, plate) as parallel arrays of timestamps and
+    # miles, sorted by timestamp. Average speed over any stretch is at most the
+    # fastest of its consecutive legs, so a new sighting only needs checking
+    # against its two neighbours.
+    def __init__(self):
+        self.dispatchers: Dict[int, Dict[object, Callable[['Ticket'], None]]] = defaultdict(dict)
+        self.cameras: Dict[object, Tuple[int, int]] = {}
+        self.obs: Dict[int, Tuple[array, array]] = {}
+        self.roads: Dict[int, int] = {}
+        self.plates: Dict[str, int] = {}
+        self.plate_names: List[str] = []
+        # (plate id << 16) | day for every day a plate has been ticketed on
+        self.ticketed = set()
+        # Tickets for roads without a dispatcher wait here until one connects
+        self.held: Dict[int, Deque['Ticket']] = defaultdict(deque)
+        self.observations = 0
+        self.tickets = 0
+
+    def add_camera(self, id, road, mile, limit):
+        self.cameras[id] = (road, mile)
+        self.roads[road] = limit
+
+    def remove_camera(self, id):
+        self.cameras.pop(id, None)
+
+    def add_dispatcher(self, id, roads, send: Callable[['Ticket'], None]):
+        for road in roads:
+            self.dispatchers[road][id] = send
+            held = self.held.pop(road, None)
+            while held:
+                send(held.popleft())
+
+    def remove_dispatcher(self, id, roads):
+        for road in roads:
+            dispatchers = self.dispatchers.get(road)
+            if dispatchers is not None:
+                dispatchers.pop(id, None)
+                if not dispatchers:
+                    del self.dispatchers[road]
+
+    def dispatch(self, ticket: 'Ticket'):
+        self.tickets += 1
+        dispatchers = self.dispatchers.get(ticket.road)
+        if dispatchers:
+            next(iter(dispatchers.values()))(ticket)
+        else:
+            self.held[ticket.road].append(ticket)
+
+    def register(self, cameraid, plate, timestamp):
+        road, mile = self.cameras[cameraid]
+        plate_id = self.plates.get(plate)
+        if plate_id is None:
+            plate_id = self.plates[plate] = len(self.plate_names)
+            self.plate_names.append(plate)
+        key = (plate_id << 16) | road
+        obs = self.obs.get(key)
+        if obs is None:
+            obs = self.obs[key] = (array('I'), array('H'))
+        times, miles = obs
+        i = bisect_left(times, timestamp)
+        if i < len(times) and times[i] == timestamp:
+            # A repeated sighting says nothing new about the speed
+            return
+        times.insert(i, timestamp)
+        miles.insert(i, mile)
+        self.observations += 1
+        if i > 0:
+            self.check(plate_id, road, miles[i - 1], times[i - 1], mile, timestamp)
+        if i + 1 < len(times):
+            self.check(plate_id, road, mile, timestamp, miles[i + 1], times[i + 1])
+
+    def check(self, plate_id, road, mile1, timestamp1, mile2, timestamp2):
+        limit = self.roads[road]
+        speed = abs(mile2 - mile1) * 3600 / (timestamp2 - timestamp1)
+        if speed < limit + 0.5:
+            return
+        days = range(timestamp1 // DAY, timestamp2 // DAY + 1)
+        keys = [(plate_id << 16) | day for day in days]
+        if any(key in self.ticketed for key in keys):
+            return
+        self.ticketed.update(keys)
+        # Speeds past what a u16 holds are reported as its maximum
+        self.dispatch(Ticket(self.plate_names[plate_id], road, mile1, timestamp1, mile2, timestamp2,
+                             min(round(speed * 100), 0xFFFF)))
+
+
+U32 = struct.Struct("!I")
+CAMERA = struct.Struct("!HHH")
+ROADS = [struct.Struct(f"!{n}H") for n in range(256)]
+
+# Type byte, string length and string, one Struct per string length
+ERRORS = [struct.Struct(f"!BB{n}s") for n in range(256)]
+TICKETS = [struct.Struct(f"!BB{n}sHHIHIH") for n in range(256)]
 
 
 class Error:
     def __init__(self, content: str):
         self.content = content.encode('utf8')
+        if len(self.content) > 255:
+            raise ValueError()
 
     def to_bytes(self):
-        content_len = len(self.content)
-        if not 0 <= content_len <= 255:
-            raise ValueError()
-        return struct.pack(f"!\x10{content_len + 1}p", self.content)
+        return ERRORS[len(self.content)].pack(0x10, len(self.content), self.content)
 
 
 class Ticket:
@@ -47,10 +136,8 @@ class Ticket:
         self.speed = speed
 
     def to_bytes(self):
-        plate_len = len(self.plate)
-        return struct.pack(f"!\x21{plate_len + 1}pHHIHIH",
-                           self.plate, self.road, self.mile1, self.timestamp1,
-                           self.mile2, self.timestamp2, self.speed)
+        return TICKETS[len(self.plate)].pack(0x21, len(self.plate), self.plate, self.road, self.mile1,
+                                             self.timestamp1, self.mile2, self.timestamp2, self.speed)
 
 
 class Heartbeat:
@@ -58,62 +145,16 @@ class Heartbeat:
         return b"\x41"
 
 
-class ByteBuffer:
-    def __init__(self, b: bytes):
-        self.b = b
-
-    def consume(self, n):
-        if len(self.b) < n:
-            raise ValueError()
-        sl, self.b = self.b[:n], self.b[n:]
-        return sl
-
-    def get_u8(self):
-        return int(self.consume(1)[0])
-
-    def get_u16(self):
-        u16, = struct.unpack(f"!H", self.consume(2))
-        return u16
-
-    def get_u32(self):
-        u32, = struct.unpack(f"!I", self.consume(4))
-        return u32
-
-    def get_pascal_str(self):
-        length = int(self.b[0])
-        if not 0 <= length <= 256:
-            raise ValueError()
-        raw, = struct.unpack(f"!{1 + length}p", self.consume(1 + length))
-        return raw.decode('utf8')
-
-
 class Plate:
     def __init__(self, plate: str, timestamp: int):
         self.plate = plate
         self.timestamp = timestamp
 
-    @classmethod
-    def from_bytes(cls, b: bytes):
-        buf = ByteBuffer(b)
-        if buf.get_u8() != 0x20:
-            raise ValueError()
-        plate = buf.get_pascal_str()
-        timestamp = buf.get_u32()
-        return Plate(plate, timestamp)
-
 
 class WantHeartbeat:
     def __init__(self, interval: int):
         self.interval = interval
 
-    @classmethod
-    def from_bytes(cls, b: bytes):
-        buf = ByteBuffer(b)
-        if buf.get_u8() != 0x40:
-            raise ValueError()
-        interval = buf.get_u32()
-        return WantHeartbeat(interval)
-
 
 class IAmCamera:
     def __init__(self, road: int, mile: int, limit: int):
@@ -121,66 +162,229 @@ class IAmCamera:
         self.mile = mile
         self.limit = limit
 
-    @classmethod
-    def from_bytes(cls, b: bytes):
-        buf = ByteBuffer(b)
-        if buf.get_u8() != 0x80:
-            raise ValueError()
-        road = buf.get_u16()
-        mile = buf.get_u16()
-        limit = buf.get_u16()
-        return IAmCamera(road, mile, limit)
-
 
 class IAmDispatcher:
     def __init__(self, roads):
         self.roads = roads
 
-    @classmethod
-    def from_bytes(cls, b: bytes):
-        buf = ByteBuffer(b)
-        if buf.get_u8() != 0x81:
-            raise ValueError()
-        numroads = buf.get_u8()
-        roads = [buf.get_u16() for _ in range(numroads)]
-        return IAmDispatcher(roads)
-
-
-def msg_from_bytes(b: bytes):
-    if b[0] == 0x20:
-        ...
-    if b[0] == 0x40:
-        ...
-    if b[0] == 0x80:
-        ...
-    if b[0] == 0x81:
-        ...
-        
+
+# Each parser takes the buffer and the offset just past the type byte, and
+# returns the message and the offset past it, or None if the message is not
+# all there yet.
+
+def parse_plate(view, offset):
+    if offset >= len(view):
+        return None
+    end = offset + 1 + view[offset]
+    if end + 4 > len(view):
+        return None
+    return Plate(str(view[offset + 1:end], 'utf8'), U32.unpack_from(view, end)[0]), end + 4
+
+
+def parse_want_heartbeat(view, offset):
+    if offset + 4 > len(view):
+        return None
+    return WantHeartbeat(U32.unpack_from(view, offset)[0]), offset + 4
+
+
+def parse_camera(view, offset):
+    if offset + 6 > len(view):
+        return None
+    return IAmCamera(*CAMERA.unpack_from(view, offset)), offset + 6
+
+
+def parse_dispatcher(view, offset):
+    if offset >= len(view):
+        return None
+    roads = ROADS[view[offset]]
+    if offset + 1 + roads.size > len(view):
+        return None
+    return IAmDispatcher(list(roads.unpack_from(view, offset + 1))), offset + 1 + roads.size
+
+
+PARSERS = {0x20: parse_plate, 0x40: parse_want_heartbeat, 0x80: parse_camera, 0x81: parse_dispatcher}
+
+
+class FrameDecoder:
+    # Received bytes go in through feed, complete messages come out of decode.
+    # A message split across reads stays in the buffer until the rest arrives.
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes):
+        self.buffer += data
+
+    def decode(self) -> list:
+        messages = []
+        offset = 0
+        with memoryview(self.buffer) as view:
+            while offset < len(view):
+                parser = PARSERS.get(view[offset])
+                if parser is None:
+                    # Hand out what came before it first, the next call raises
+                    if messages:
+                        break
+                    raise ValueError()
+                parsed = parser(view, offset + 1)
+                if parsed is None:
+                    break
+                message, offset = parsed
+                messages.append(message)
+        del self.buffer[:offset]
+        return messages
+
+
+class HeartbeatWheel:
+    # A hierarchical timing wheel, as in the classic kernel timers: 256 slots
+    # of one tick, then four levels of 64 slots, each slot spanning all of the
+    # level below. Entries move down a level whenever the level below wraps
+    # around, so adding, changing and removing a client is O(1) and each tick
+    # only touches the clients due on it. One loop callback per tick writes
+    # every heartbeat due, and the callbacks stop while nobody wants any.
+    ROOT_BITS = 8
+    LEVEL_BITS = 6
+    LEVELS = 4
+
+    def __init__(self, tick: float = HEARTBEAT_TICK):
+        self.tick = tick
+        self.root = [{} for _ in range(1 << self.ROOT_BITS)]
+        self.levels = [[{} for _ in range(1 << self.LEVEL_BITS)] for _ in range(self.LEVELS)]
+        # writer -> [due tick, interval, slot]
+        self.entries: Dict[asyncio.StreamWriter, list] = {}
+        self.base = 0
+        self.started = 0.0
+        self.timer = None
+
+    def slot(self, due: int) -> dict:
+        delta = due - self.base
+        if delta < 1 << self.ROOT_BITS:
+            return self.root[due & ((1 << self.ROOT_BITS) - 1)]
+        for level in range(self.LEVELS):
+            shift = self.ROOT_BITS + level * self.LEVEL_BITS
+            if delta < 1 << (shift + self.LEVEL_BITS) or level == self.LEVELS - 1:
+                return self.levels[level][(due >> shift) & ((1 << self.LEVEL_BITS) - 1)]
+
+    def place(self, w: asyncio.StreamWriter, entry: list):
+        entry[2] = self.slot(entry[0])
+        entry[2][w] = entry
+
+    def add(self, w: asyncio.StreamWriter, interval: int):
+        self.remove(w)
+        if not interval:
+            return
+        if self.timer is None:
+            loop = asyncio.get_running_loop()
+            self.started = loop.time() - self.base * self.tick
+            self.timer = loop.call_at(self.started + (self.base + 1) * self.tick, self.advance)
+        entry = self.entries[w] = [self.base + interval, interval, None]
+        self.place(w, entry)
+
+    def remove(self, w: asyncio.StreamWriter):
+        entry = self.entries.pop(w, None)
+        if entry is not None:
+            del entry[2][w]
+
+    def cascade(self, level: int) -> int:
+        shift = self.ROOT_BITS + level * self.LEVEL_BITS
+        index = (self.base >> shift) & ((1 << self.LEVEL_BITS) - 1)
+        slot = self.levels[level][index]
+        self.levels[level][index] = {}
+        for w, entry in slot.items():
+            self.place(w, entry)
+        return index
+
+    def advance(self):
+        loop = asyncio.get_running_loop()
+        # Catch up on ticks missed while the loop was busy
+        now = int((loop.time() - self.started) / self.tick)
+        while self.base < now:
+            self.base += 1
+            index = self.base & ((1 << self.ROOT_BITS) - 1)
+            if not index:
+                for level in range(self.LEVELS):
+                    if self.cascade(level):
+                        break
+            due = self.root[index]
+            if due:
+                self.root[index] = {}
+                self.fire(due)
+        if self.entries:
+            self.timer = loop.call_at(self.started + (self.base + 1) * self.tick, self.advance)
+        else:
+            self.timer = None
+
+    def fire(self, due: dict):
+        beat = HEARTBEAT
+        for w, entry in due.items():
+            if w.is_closing():
+                del self.entries[w]
+                continue
+            w.write(beat)
+            entry[0] = self.base + entry[1]
+            self.place(w, entry)
+
+
+HEARTBEAT = Heartbeat().to_bytes()
+
 STATE = State()
+HEARTBEATS = HeartbeatWheel()
+
+PLATE = metrics.histogram("speed_plate_seconds", "Time to record a plate and check it for tickets")
+metrics.gauge("speed_observations", "Plates recorded since startup", lambda: STATE.observations)
+metrics.gauge("speed_tickets", "Tickets issued since startup", lambda: STATE.tickets)
+metrics.gauge("speed_cameras", "Cameras connected", lambda: len(STATE.cameras))
+metrics.gauge("speed_dispatchers", "Dispatchers connected", lambda: sum(map(len, STATE.dispatchers.values())))
+metrics.gauge("speed_held_tickets", "Tickets waiting for a dispatcher for their road",
+              lambda: sum(map(len, STATE.held.values())))
+metrics.gauge("speed_heartbeat_clients", "Clients being sent heartbeats", lambda: len(HEARTBEATS.entries))
 
-async def heartbeat(ds: int, w: asyncio.StreamWriter):
-    while True:
-        asyncio.sleep(ds * 0.1)
-        w.write(Heartbeat().to_bytes())
 
 async def handle(r: asyncio.StreamReader, w: asyncio.StreamWriter):
     clientid = uuid.uuid4()
-    while not r.at_eof():
-        try:
-            pass
-        except (ValueError, asyncio.IncompleteReadError):
-            pass
-    await w.drain()
+    camera = dispatcher = None
+    wants_heartbeat = False
+    decoder = FrameDecoder()
+    try:
+        while data := await r.read(READ_SIZE):
+            decoder.feed(data)
+            while messages := decoder.decode():
+                for msg in messages:
+                    if isinstance(msg, Plate) and camera is not None:
+                        t = time.perf_counter_ns()
+                        STATE.register(clientid, msg.plate, msg.timestamp)
+                        PLATE.record(time.perf_counter_ns() - t)
+                    elif isinstance(msg, WantHeartbeat) and not wants_heartbeat:
+                        wants_heartbeat = True
+                        HEARTBEATS.add(w, msg.interval)
+                    elif isinstance(msg, IAmCamera) and camera is None and dispatcher is None:
+                        camera = msg
+                        STATE.add_camera(clientid, msg.road, msg.mile, msg.limit)
+                    elif isinstance(msg, IAmDispatcher) and camera is None and dispatcher is None:
+                        dispatcher = msg
+                        STATE.add_dispatcher(clientid, msg.roads, lambda ticket: w.write(ticket.to_bytes()))
+                    else:
+                        raise ValueError()
+            await w.drain()
+    except ValueError:
+        w.write(Error("illegal msg").to_bytes())
+    except ConnectionError:
+        pass
+    finally:
+        HEARTBEATS.remove(w)
+        if camera is not None:
+            STATE.remove_camera(clientid)
+        if dispatcher is not None:
+            STATE.remove_dispatcher(clientid, dispatcher.roads)
     w.close()
 
 
 async def main():
     logging.basicConfig(level=logging.DEBUG)
-    server = await asyncio.start_server(handle, HOST, PORT)
+    server = await runtime.start_server(handle)
     logging.info("Server Ready.")
-    async with server:
-        await server.serve_forever()
+    await runtime.serve(server)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # Cameras and dispatchers for a road have to meet in one process
+    runtime.run(main, workers=1)
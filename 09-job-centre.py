@@ -1,13 +1,37 @@
 import asyncio
+import gc
 import json
 import logging
-from collections import defaultdict
+import os
+import time
+from collections import OrderedDict, defaultdict, deque
 from dataclasses import dataclass, field
-from typing import List
-from heapq import heappush, heappop
+from typing import Deque, Dict, List, Optional, Tuple
+from heapq import heapify, heappush, heappop
 
-HOST = "0.0.0.0"
-PORT = 40000
+import metrics
+import runtime
+
+# Gets over at least INDEX_MIN_QUEUES queues go through a tournament tree over
+# the heads of those queues, kept for the INDEX_CACHE most recent queue lists.
+INDEX_MIN_QUEUES = 16
+INDEX_CACHE = 1024
+
+# Requests are read CHUNK_SIZE bytes at a time and every complete line is
+# answered in one write, draining once HIGH_WATER bytes are waiting to be sent.
+CHUNK_SIZE = 1 << 16
+LINE_LIMIT = 1 << 16
+HIGH_WATER = 1 << 18
+
+# With JOB_WAL set, every change is logged to JOB_WAL.log before it is
+# acknowledged, and the queues are recovered from it on startup. Records are
+# fsynced in groups of up to WAL_BATCH, collected for WAL_DELAY seconds
+# after the first. Every SNAPSHOT_EVERY records the jobs are written to
+# JOB_WAL.snap and the log starts over.
+JOB_WAL = os.getenv("JOB_WAL")
+WAL_BATCH = int(os.getenv("WAL_BATCH", 256))
+WAL_DELAY = float(os.getenv("WAL_DELAY", 0))
+SNAPSHOT_EVERY = int(os.getenv("SNAPSHOT_EVERY", 1 << 20))
 
 @dataclass(order=True)
 class Job:
@@ -15,130 +39,587 @@ class Job:
     jid: int = field(compare=False)
     queue: str = field(compare=False)
     task: dict = field(compare=False)
+    owner: Optional[int] = field(default=None, compare=False)
+
+
+class QueueIndex:
+    # Tournament tree over the heads of a fixed list of heaps. tree[node] is
+    # the leaf with the best head below node, or -1 if they are all empty.
+    def __init__(self, heaps: List[list]):
+        self.heaps = heaps
+        self.size = 1
+        while self.size < len(heaps):
+            self.size *= 2
+        self.tree = [-1] * (2 * self.size)
+        self.tree[self.size:self.size + len(heaps)] = range(len(heaps))
+        for node in range(self.size - 1, 0, -1):
+            self.tree[node] = self.better(self.tree[2 * node], self.tree[2 * node + 1])
+
+    def better(self, a: int, b: int) -> int:
+        if a < 0 or not self.heaps[a]:
+            return b if b >= 0 and self.heaps[b] else -1
+        if b < 0 or not self.heaps[b]:
+            return a
+        return a if self.heaps[a][0] <= self.heaps[b][0] else b
+
+    def update(self, leaf: int):
+        node = (self.size + leaf) >> 1
+        while node:
+            self.tree[node] = self.better(self.tree[2 * node], self.tree[2 * node + 1])
+            node >>= 1
+
+    def best(self) -> int:
+        return self.tree[1]
+
+
+class Waiter:
+    def __init__(self, client: int, queues: Tuple[str, ...]):
+        self.client = client
+        self.queues = queues
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class JobLog:
+    # The log and the snapshot both start with a header naming their
+    # generation. Taking a snapshot bumps it, so after a crash between writing
+    # the snapshot and starting the new log the old log is recognised as
+    # already contained in the snapshot.
+    def __init__(self, path: str, batch: int = WAL_BATCH, delay: float = WAL_DELAY,
+                 snapshot_every: int = SNAPSHOT_EVERY):
+        self.log_path = path + ".log"
+        self.snapshot_path = path + ".snap"
+        self.batch = batch
+        self.delay = delay
+        self.snapshot_every = snapshot_every
+        self.generation = 0
+        self.records = 0
+        self.file = None
+        # Groups of encoded records, each with the future of its fsync
+        self.batches: Deque[Tuple[List[bytes], asyncio.Future]] = deque()
+        self.wakeup = None
+        self.task = None
+
+    @staticmethod
+    def read(path: str) -> Tuple[Optional[dict], list]:
+        # Decodes every record in one go, falling back to a line at a time to
+        # find where a crash cut the file short
+        try:
+            with open(path, "rb") as f:
+                header, *lines = f.read().split(b"\n")
+        except FileNotFoundError:
+            return None, []
+        if not header:
+            return None, []
+        if lines and not lines[-1]:
+            lines.pop()
+        try:
+            return json.loads(header), json.loads(b"[" + b",".join(lines) + b"]")
+        except ValueError:
+            records = []
+            for line in lines:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # Nothing after it was acknowledged
+                    break
+            return json.loads(header), records
+
+    def load(self, context: 'Context'):
+        # Recovery builds millions of objects that all survive, which only
+        # makes the cyclic collector run over and over
+        gc.disable()
+        try:
+            self.recover(context)
+        finally:
+            gc.enable()
+
+    def recover(self, context: 'Context'):
+        jobs = {}
+        next_jid = 1
+        header, lines = self.read(self.snapshot_path)
+        if header is not None:
+            self.generation, next_jid = header["generation"], header["jid"]
+            for jid, queue, pri, task in lines[0]:
+                jobs[jid] = [queue, pri, task]
+        header, records = self.read(self.log_path)
+        if header is not None and header["generation"] == self.generation:
+            self.records = len(records)
+            for record in records:
+                if record[0] == "put":
+                    jobs[record[1]] = record[2:]
+                    next_jid = max(next_jid, record[1])
+                elif record[0] == "delete":
+                    jobs.pop(record[1], None)
+        # Gets and aborts need no replaying: the clients that held jobs are
+        # gone, so every job that was in progress goes back on its queue
+        context.restore(jobs, next_jid)
+        # Start from a snapshot of what was recovered, which also drops a torn record
+        self.write_snapshot(context.snapshot(self.generation + 1))
+
+    def write_snapshot(self, lines: List[bytes]):
+        self.generation += 1
+        tmp = self.snapshot_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.log_path, "wb")
+        self.file.write(json.dumps({"generation": self.generation}).encode() + b"\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.records = 0
+
+    def write(self, records: List[bytes]):
+        self.file.writelines(records)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def append(self, *record):
+        if not self.batches or len(self.batches[-1][0]) >= self.batch:
+            self.batches.append(([], asyncio.get_running_loop().create_future()))
+            self.wakeup.set()
+        self.batches[-1][0].append(json.dumps(record).encode() + b"\n")
+
+    def commit(self) -> asyncio.Future:
+        # Resolves once everything appended so far is on disk
+        if self.batches:
+            return self.batches[-1][1]
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(None)
+        return future
+
+    async def run(self, context: 'Context'):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.wakeup.wait()
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            while self.batches:
+                if self.records + len(self.batches[0][0]) >= self.snapshot_every:
+                    # The jobs as they are now include every pending record
+                    batches, self.batches = self.batches, deque()
+                    await loop.run_in_executor(None, self.write_snapshot, context.snapshot(self.generation + 1))
+                else:
+                    batches = [self.batches.popleft()]
+                    self.records += len(batches[0][0])
+                    await loop.run_in_executor(None, self.write, batches[0][0])
+                for _, future in batches:
+                    future.set_result(None)
+            self.wakeup.clear()
+
+    def start(self, context: 'Context'):
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run(context))
 
 
 class Context:
+    # Each queue is a heap of (pri, jid) entries. Deleting a queued job only
+    # drops its record from self.jobs; its entry is skipped when it reaches
+    # the head of its heap, or goes when the heap is compacted.
+    #
+    # A get only blocks when all of its queues are empty, so a job arriving
+    # on one of them is the best it could have: it is handed straight to the
+    # longest waiting get on that queue, without touching the heap.
     def __init__(self):
-        self.queues = defaultdict(list)
-        self.cond = asyncio.Condition()
+        self.queues: Dict[str, List[Tuple[int, int]]] = {}
+        self.stale: Dict[str, int] = defaultdict(int)
+        self.jobs: Dict[int, Job] = {}
+        self.indexes: OrderedDict[Tuple[str, ...], QueueIndex] = OrderedDict()
+        self.watchers: Dict[str, List[Tuple[QueueIndex, int]]] = defaultdict(list)
+        # Blocked gets, in the order they started, for each queue they wait on
+        self.waiters: Dict[str, Deque[Waiter]] = {}
+        self.dead_waiters: Dict[str, int] = defaultdict(int)
         self.jid = 1
         self.clientid = 1
-        self.working = defaultdict(dict)
-        self.deleted = set()
-        self.posted = set()
+        self.working: Dict[int, Dict[int, Job]] = defaultdict(dict)
+        self.log: Optional[JobLog] = None
 
     def is_live(self, jid):
-        return jid in self.posted and jid not in self.deleted
-    
+        return jid in self.jobs
+
+    def restore(self, jobs: Dict[int, list], next_jid: int):
+        for jid, (queue, pri, task) in jobs.items():
+            self.jobs[jid] = Job(pri, jid, queue, task)
+            self.queues.setdefault(queue, []).append((pri, jid))
+        for heap in self.queues.values():
+            heapify(heap)
+        self.jid = max(self.jid, next_jid)
+
+    def snapshot(self, generation: int) -> List[bytes]:
+        # One array of jobs, which encodes far faster than a line per job
+        jobs = [[job.jid, job.queue, job.pri, job.task] for job in self.jobs.values()]
+        return [json.dumps({"generation": generation, "jid": self.jid}).encode() + b"\n",
+                json.dumps(jobs).encode() + b"\n"]
+
+    async def durable(self):
+        if self.log is not None:
+            await self.log.commit()
+
     async def get_client_id(self) -> int:
-        async with self.cond:
-            self.clientid += 1
-            return self.clientid
+        self.clientid += 1
+        return self.clientid
 
-    async def put(self, queue: str, task: dict, pri: int) -> int:
-        async with self.cond:
-            self.jid += 1
-            heappush(self.queues[queue], Job(-pri, self.jid, queue, task))
-            self.posted.add(self.jid)
-            self.cond.notify()
-            return self.jid
-        
-    async def get(self, client: int, queues: List[str], wait: bool) -> Job | None:
-        def jobs_available() -> bool:
-            return any(self.queues[q] for q in queues)
-        
-        def pop_job() -> Job:
-            def min_pri(queue: str) -> int:
-                if self.queues[queue]:
-                    return self.queues[queue][0].pri
-                else:
-                    return 1
+    def head_changed(self, queue: str):
+        for index, leaf in self.watchers.get(queue, ()):
+            index.update(leaf)
+
+    def push(self, job: Job):
+        heap = self.queues.get(job.queue)
+        if heap is None:
+            heap = self.queues[job.queue] = []
+        heappush(heap, (job.pri, job.jid))
+        if heap[0][1] == job.jid:
+            self.head_changed(job.queue)
+
+    def clean(self, queue: str) -> bool:
+        # Drops deleted jobs from the head of the queue, says whether any were
+        heap = self.queues[queue]
+        if not heap or heap[0][1] in self.jobs:
+            return False
+        while heap and heap[0][1] not in self.jobs:
+            heappop(heap)
+            self.stale[queue] -= 1
+        self.head_changed(queue)
+        return True
+
+    def compact(self, queue: str):
+        heap = self.queues[queue]
+        # In place, the queue indexes hold on to the list
+        heap[:] = [entry for entry in heap if entry[1] in self.jobs]
+        heapify(heap)
+        del self.stale[queue]
+        self.head_changed(queue)
+        self.release(queue)
+
+    def release(self, queue: str):
+        # Forgets an empty queue that no index refers to
+        if not self.queues[queue] and queue not in self.watchers:
+            del self.queues[queue]
+            self.stale.pop(queue, None)
+
+    def index_for(self, queues: Tuple[str, ...]) -> QueueIndex:
+        index = self.indexes.get(queues)
+        if index is not None:
+            self.indexes.move_to_end(queues)
+            return index
+        for q in queues:
+            self.queues.setdefault(q, [])
+        index = self.indexes[queues] = QueueIndex([self.queues[q] for q in queues])
+        for leaf, q in enumerate(queues):
+            self.watchers[q].append((index, leaf))
+        if len(self.indexes) > INDEX_CACHE:
+            old_queues, old = self.indexes.popitem(last=False)
+            for q in old_queues:
+                watchers = self.watchers[q]
+                watchers[:] = [w for w in watchers if w[0] is not old]
+                if not watchers:
+                    del self.watchers[q]
+                    self.release(q)
+        return index
 
-            to_pop = min((q for q in queues), key=min_pri)
-            return heappop(self.queues[to_pop])
-        
-        async with self.cond:
+    def best_queue(self, queues: Tuple[str, ...]) -> Optional[str]:
+        if len(queues) >= INDEX_MIN_QUEUES:
+            index = self.index_for(queues)
             while True:
-                if not jobs_available() and not wait:
+                leaf = index.best()
+                if leaf < 0:
                     return None
-                if wait:
-                    await self.cond.wait_for(jobs_available)
-
-                job = pop_job()
-                self.working[client][job.jid] = job
-                if self.is_live(job.jid):
-                    return job
-        
-    async def delete(self, jid: int) -> bool:
-        async with self.cond:
-            if self.is_live(jid):
-                self.deleted.add(jid)
-                return True
+                if not self.clean(queues[leaf]):
+                    return queues[leaf]
+
+        best = None
+        for q in queues:
+            if q in self.queues:
+                self.clean(q)
+                heap = self.queues[q]
+                if heap and (best is None or heap[0] < self.queues[best][0]):
+                    best = q
+        return best
+
+    def pop_best(self, queues: Tuple[str, ...]) -> Optional[Job]:
+        queue = self.best_queue(queues)
+        if queue is None:
+            return None
+        _, jid = heappop(self.queues[queue])
+        self.head_changed(queue)
+        self.release(queue)
+        return self.jobs[jid]
+
+    def retire(self, waiter: Waiter, popped: Optional[str] = None):
+        # The waiter's entries in the queues it waited on are dead now, apart
+        # from the one just popped. Dead entries are skipped, and a deque is
+        # rebuilt once they are more than half of it.
+        queues = list(waiter.queues)
+        if popped is not None:
+            queues.remove(popped)
+        for q in queues:
+            waiters = self.waiters.get(q)
+            if waiters is None:
+                continue
+            self.dead_waiters[q] += 1
+            if 2 * self.dead_waiters[q] > len(waiters):
+                del self.dead_waiters[q]
+                waiters = deque(w for w in waiters if not w.future.done())
+                if waiters:
+                    self.waiters[q] = waiters
+                else:
+                    del self.waiters[q]
+
+    def hand_off(self, job: Job) -> bool:
+        waiters = self.waiters.get(job.queue)
+        waiter = None
+        while waiters and waiter is None:
+            waiter = waiters.popleft()
+            if waiter.future.done():
+                self.dead_waiters[job.queue] -= 1
+                waiter = None
+        if waiters is not None and not waiters and self.waiters.get(job.queue) is waiters:
+            del self.waiters[job.queue]
+            self.dead_waiters.pop(job.queue, None)
+        if waiter is None:
+            return False
+        self.assign(job, waiter.client)
+        waiter.future.set_result(job)
+        self.retire(waiter, job.queue)
+        return True
+
+    def enqueue(self, job: Job):
+        if not self.hand_off(job):
+            self.push(job)
+
+    def assign(self, job: Job, client: int):
+        job.owner = client
+        self.working[client][job.jid] = job
+        if self.log is not None:
+            self.log.append("get", job.jid, client)
+
+    def unassign(self, job: Job):
+        del self.working[job.owner][job.jid]
+        job.owner = None
+        if self.log is not None:
+            self.log.append("abort", job.jid)
+        self.enqueue(job)
+
+    # The _nowait operations change the queues without waiting for the log,
+    # so that a batch of them can share one durable()
+
+    def put_nowait(self, queue: str, task: dict, pri: int) -> int:
+        # Checked before anything is stored or logged, as a job that cannot
+        # be queued would stay in the log and fail every recovery
+        if type(queue) != str or type(pri) != int:
+            raise ValueError()
+        self.jid += 1
+        job = self.jobs[self.jid] = Job(-pri, self.jid, queue, task)
+        if self.log is not None:
+            self.log.append("put", job.jid, queue, job.pri, task)
+        self.enqueue(job)
+        return job.jid
+
+    def get_nowait(self, client: int, queues: Tuple[str, ...]) -> Job | None:
+        # A queue listed twice just gets two leaves in its index
+        job = self.pop_best(queues)
+        if job is not None:
+            self.assign(job, client)
+        return job
+
+    def delete_nowait(self, jid: int) -> bool:
+        job = self.jobs.pop(jid, None)
+        if job is None:
+            return False
+        if self.log is not None:
+            self.log.append("delete", jid)
+        if job.owner is not None:
+            del self.working[job.owner][jid]
+        else:
+            self.stale[job.queue] += 1
+            # Rebuilding once half the heap is deleted jobs keeps it
+            # amortised O(1) per delete
+            if 2 * self.stale[job.queue] > len(self.queues[job.queue]):
+                self.compact(job.queue)
+        return True
+
+    def abort_nowait(self, jid: int, client: int) -> bool:
+        job = self.working[client].get(jid)
+        if job is None:
+            return False
+        self.unassign(job)
+        return True
+
+    async def put(self, queue: str, task: dict, pri: int) -> int:
+        jid = self.put_nowait(queue, task, pri)
+        await self.durable()
+        return jid
+
+    async def get(self, client: int, queues: List[str], wait: bool) -> Job | None:
+        queues = tuple(queues)
+        job = self.get_nowait(client, queues)
+        if job is not None:
+            await self.durable()
+            return job
+        if not wait or not queues:
+            return None
+
+        waiter = Waiter(client, queues)
+        for q in queues:
+            self.waiters.setdefault(q, deque()).append(waiter)
+        try:
+            job = await waiter.future
+            await self.durable()
+            return job
+        except asyncio.CancelledError:
+            if waiter.future.cancelled():
+                self.retire(waiter)
             else:
-                return False
-        
+                # Cancelled just after a job was handed over: pass it on
+                job = waiter.future.result()
+                if self.jobs.get(job.jid) is job and job.owner == client:
+                    self.unassign(job)
+            raise
+
+    async def delete(self, jid: int) -> bool:
+        deleted = self.delete_nowait(jid)
+        await self.durable()
+        return deleted
+
     async def abort(self, jid: int, client: int) -> bool:
-        async with self.cond:
-            job = self.working[client].get(jid)
-            if job is None or not self.is_live(jid):
-                return False
-            heappush(self.queues[job.queue], job)
-            del self.working[client][jid]
-            self.cond.notify()
-            return True
+        aborted = self.abort_nowait(jid, client)
+        await self.durable()
+        return aborted
 
     async def disconnect(self, client: int):
-        for jid in set(self.working[client].keys()):
-            await self.abort(jid, client)
+        for job in list(self.working[client].values()):
+            self.unassign(job)
+        del self.working[client]
+        await self.durable()
 
-        async with self.cond:
-            del self.working[client]
-            
 
 context = Context()
 
+# Time spent answering each type of request; a waiting get that finds nothing
+# is recorded as "wait", from when it starts waiting to when it gets a job
+LATENCY = {request: metrics.histogram("job_request_seconds", "Time to answer a request", request=request)
+           for request in ("put", "get", "delete", "abort", "wait")}
+metrics.gauge("job_queue_pending", "Jobs waiting in each queue",
+              lambda: {q: len(heap) - context.stale.get(q, 0) for q, heap in context.queues.items()}, label="queue")
+metrics.gauge("job_working", "Jobs handed out and not yet deleted or aborted",
+              lambda: sum(map(len, context.working.values())))
+metrics.gauge("job_queue_waiters", "Gets waiting on each queue",
+              lambda: {q: len(w) - context.dead_waiters.get(q, 0) for q, w in context.waiters.items()}, label="queue")
+
+
+def job_reply(job: Job) -> bytes:
+    return runtime.dumps({"status": "ok", "id": job.jid, "job": job.task, "pri": -job.pri, "queue": job.queue})
+
+
+def respond(clientid: int, o: dict) -> bytes | None:
+    # Answers any request that needs no waiting, or None for a waiting get
+    # that found nothing
+    match o['request']:
+        case "get":
+            queues = o['queues']
+            if type(queues) != list or not all(type(q) == str for q in queues):
+                raise ValueError()
+            job = context.get_nowait(clientid, tuple(queues))
+            if job:
+                return job_reply(job)
+            if o.get('wait', False):
+                return None
+        case "put":
+            if type(o['job']) != dict:
+                raise ValueError()
+            return runtime.dumps({"status": "ok", "id": context.put_nowait(o['queue'], o['job'], o['pri'])})
+        case "delete":
+            if context.delete_nowait(o['id']):
+                return OK
+        case "abort":
+            if context.abort_nowait(o['id'], clientid):
+                return OK
+        case _:
+            raise ValueError()
+    return NO_JOB
+
+
+OK = runtime.dumps({"status": "ok"})
+NO_JOB = runtime.dumps({"status": "no-job"})
+INVALID = runtime.dumps({"status": "error", "error": "invalid-json"})
+
+
 async def handle(r: asyncio.StreamReader, w: asyncio.StreamWriter):
-    def write_json(d):
-        w.write(json.dumps(d).encode("utf8"))
-        w.write(b"\n")
+    async def wait_for_job(queues, pipelined: bool):
+        # The next request is read while the get waits, so that a client that
+        # hangs up stops waiting and nothing is handed to it
+        nonlocal reading
+        getting = asyncio.create_task(context.get(clientid, queues, True))
+        if pipelined:
+            # It already sent more, so it was still there
+            return await getting
+        reading = asyncio.create_task(r.read(CHUNK_SIZE))
+        await asyncio.wait([getting, reading], return_when=asyncio.FIRST_COMPLETED)
+        if not getting.done() and (reading.exception() is not None or not reading.result()):
+            getting.cancel()
+            await asyncio.gather(getting, return_exceptions=True)
+            raise ConnectionError()
+        return await getting
+
+    async def flush(replies: List[bytes]):
+        # Everything the replies report has to be logged before they go out
+        await context.durable()
+        replies.append(b"")
+        w.write(b"\n".join(replies))
+        replies.clear()
+        if w.transport.get_write_buffer_size() > HIGH_WATER:
+            await w.drain()
 
     clientid = await context.get_client_id()
+    reading = None
+    tail = b""
+    skipping = False
 
-    while not r.at_eof():
-        try:
-            o = json.loads((await r.readline()).decode("utf8"))
-            match o['request']:
-                case "get":
-                    wait = o.get('wait', False)
-                    job = await context.get(clientid, o['queues'], wait)
-                    if job:
-                        write_json({
-                            "status": "ok", 
-                            "id": job.jid, 
-                            "job": job.task, 
-                            "pri": -job.pri, 
-                            "queue": job.queue})
-                    else:
-                        write_json({"status": "no-job"})
-                case "put":
-                    jid = await context.put(o['queue'], o['job'], o['pri'])
-                    write_json({"status": "ok", "id": jid})
-                case "delete":
-                    success = await context.delete(o['id'])
-                    if success:
-                        write_json({"status": "ok"})
-                    else:
-                        write_json({"status": "no-job"})
-                case "abort":
-                    success = await context.abort(o['id'], clientid)
-                    if success:
-                        write_json({"status": "ok"})
+    try:
+        while True:
+            if reading is not None:
+                chunk, reading = await reading, None
+            else:
+                chunk = await r.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if skipping:
+                # The rest of an over-long line is dropped, up to its end
+                end = chunk.find(b"\n")
+                if end < 0:
+                    continue
+                chunk, skipping = chunk[end + 1:], False
+            # Every complete request that has arrived is answered in one batch
+            lines = (tail + chunk).split(b"\n")
+            tail = lines.pop()
+            replies = []
+            for i, line in enumerate(lines):
+                try:
+                    o = runtime.loads(line)
+                    t = time.perf_counter_ns()
+                    reply = respond(clientid, o)
+                    if reply is not None:
+                        LATENCY[o['request']].record(time.perf_counter_ns() - t)
                     else:
-                        write_json({"status": "no-job"})
-        except (ValueError, KeyError):
-            write_json({"status": "error", "error": "invalid-json"})
-        except ConnectionError:
-            break
+                        await flush(replies)
+                        t = time.perf_counter_ns()
+                        job = await wait_for_job(o['queues'], i + 1 < len(lines) or bool(tail))
+                        LATENCY["wait"].record(time.perf_counter_ns() - t)
+                        reply = job_reply(job)
+                except (ValueError, KeyError, TypeError):
+                    reply = INVALID
+                replies.append(reply)
+            if len(tail) > LINE_LIMIT:
+                replies.append(INVALID)
+                tail, skipping = b"", True
+            await flush(replies)
+    except ConnectionError:
+        pass
+    if reading is not None:
+        reading.cancel()
     await context.disconnect(clientid)
     await w.drain()
     w.close()
@@ -146,11 +627,16 @@ async def handle(r: asyncio.StreamReader, w: asyncio.StreamWriter):
 
 async def main():
     logging.basicConfig(level=logging.DEBUG)
-    server = await asyncio.start_server(handle, HOST, PORT)
+    if JOB_WAL:
+        context.log = JobLog(JOB_WAL)
+        context.log.load(context)
+        context.log.start(context)
+        logging.info(f"Recovered {len(context.jobs)} jobs from {JOB_WAL}")
+    server = await runtime.start_server(handle)
     logging.info("Server Ready.")
-    async with server:
-        await server.serve_forever()
+    await runtime.serve(server)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # The queues live in this process
+    runtime.run(main, workers=1)
@@ -0,0 +1,112 @@
+# Loopback echo throughput of the original handler, which reads the whole
+# stream before writing it back, the chunked stream handler and EchoProtocol,
+# for payloads from 1 KB to 1 GB. Small payloads are sent over enough
+# connections, one after another, to move at least --min-bytes. Every server
+# runs in a fresh process so that its peak RSS belongs to that payload.
+#
+#   python bench/00-smoke-test.py --sizes 1024 1048576 1073741824
+import argparse
+import asyncio
+import socket
+import time
+
+from common import load_server, spawn_server, print_table
+
+smoke = load_server("00-smoke-test.py")
+
+SEND_CHUNK = 1 << 20
+
+
+async def legacy_handle(r, w):
+    data = await r.read()
+    w.write(data)
+    await w.drain()
+    w.close()
+
+
+async def legacy_stream_handle(r, w):
+    # Echoed as it arrives, so a connection holds at most a chunk plus the
+    # write buffer rather than everything it sent
+    while data := await r.read(smoke.CHUNK_SIZE):
+        w.write(data)
+        await w.drain()
+    w.close()
+
+
+async def start(kind: str):
+    if kind == "read":
+        return await asyncio.start_server(legacy_handle, "127.0.0.1", 0)
+    if kind == "stream":
+        return await asyncio.start_server(legacy_stream_handle, "127.0.0.1", 0)
+    loop = asyncio.get_running_loop()
+    return await loop.create_server(smoke.EchoProtocol, "127.0.0.1", 0)
+
+
+def peak_rss_kb(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return 0
+
+
+async def echo(port: int, size: int, chunk: memoryview, buffer: memoryview):
+    loop = asyncio.get_running_loop()
+    sock = socket.socket()
+    sock.setblocking(False)
+    await loop.sock_connect(sock, ("127.0.0.1", port))
+
+    async def send():
+        left = size
+        while left:
+            n = min(left, len(chunk))
+            await loop.sock_sendall(sock, chunk[:n])
+            left -= n
+        sock.shutdown(socket.SHUT_WR)
+
+    sender = asyncio.create_task(send())
+    received = 0
+    while n := await loop.sock_recv_into(sock, buffer):
+        received += n
+    await sender
+    sock.close()
+    if received != size:
+        raise ValueError()
+
+
+async def load(port: int, size: int, connections: int) -> float:
+    chunk = memoryview(bytes(range(256)) * (SEND_CHUNK // 256))
+    buffer = memoryview(bytearray(SEND_CHUNK))
+    t = time.perf_counter()
+    for _ in range(connections):
+        await echo(port, size, chunk, buffer)
+    return size * connections / (time.perf_counter() - t)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1 << 10, 1 << 16, 1 << 20, 1 << 24, 1 << 28, 1 << 30])
+    parser.add_argument("--min-bytes", type=int, default=1 << 24, help="bytes to move per measurement at least")
+    parser.add_argument("--read-max", type=int, default=1 << 28,
+                        help="largest payload to run the read-everything handler at")
+    args = parser.parse_args()
+
+    rows = []
+    for size in args.sizes:
+        connections = max(1, args.min_bytes // size)
+        for kind in ("read", "stream", "protocol"):
+            if kind == "read" and size > args.read_max:
+                continue
+            process, port = spawn_server(start, kind)
+            try:
+                rate = asyncio.run(load(port, size, connections))
+                rss = peak_rss_kb(process.pid)
+            finally:
+                process.terminate()
+            rows.append([kind, f"{size:,}", connections, f"{rate / 1e9:.3f}", f"{rss:,}"])
+    print_table(["server", "payload bytes", "connections", "GB/s", "peak RSS kB"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# Requests/sec of the prime-time server with pipelining clients, comparing the
+# per-line handler with stdlib json against the streaming handler.
+#
+#   python bench/01-prime-time.py --connections 8 --requests 20000
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from common import load_server, spawn_server, print_table
+
+import runtime
+
+pt = load_server("01-prime-time.py")
+
+CONFIGS = {
+    "lines/json": (pt.handle_lines, False),
+    "stream/json": (pt.handle_stream, False),
+    "stream/orjson": (pt.handle_stream, True),
+}
+
+
+async def start(handler, use_orjson):
+    if not use_orjson:
+        runtime.orjson = None
+    return await asyncio.start_server(handler, "127.0.0.1", 0)
+
+
+def make_payload(n: int) -> bytes:
+    rng = random.Random(1)
+    numbers = [rng.randrange(1, 1 << 62) for _ in range(n)]
+    return b"".join(json.dumps({"method": "isPrime", "number": x}).encode() + b"\n" for x in numbers)
+
+
+async def client(port: int, payload: bytes, n: int):
+    r, w = await asyncio.open_connection("127.0.0.1", port)
+    w.write(payload)
+    await w.drain()
+    for _ in range(n):
+        await r.readline()
+    w.close()
+
+
+async def run(port: int, connections: int, n: int) -> float:
+    payload = make_payload(n)
+    t = time.perf_counter()
+    await asyncio.gather(*(client(port, payload, n) for _ in range(connections)))
+    return connections * n / (time.perf_counter() - t)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+
+    rows = []
+    for name, (handler, use_orjson) in CONFIGS.items():
+        if use_orjson and runtime.orjson is None:
+            continue
+        process, port = spawn_server(start, handler, use_orjson)
+        try:
+            rate = asyncio.run(run(port, args.connections, args.requests))
+        finally:
+            process.terminate()
+        rows.append([name, f"{rate:,.0f}"])
+    print_table(["handler", "requests/sec"], rows)
+
+
+if __name__ == "__main__":
+    main()
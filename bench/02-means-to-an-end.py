@@ -0,0 +1,176 @@
+# Insert and query rates of PriceHistory for large sessions, against the
+# original list + dict implementation, message rates of the eager and lazy
+# stores on nearly increasing timestamps for several insert-to-query ratios,
+# and a loopback load generator comparing the per-frame stream handler with the
+# bulk-decoding MeansProtocol.
+#
+#   python bench/02-means-to-an-end.py --sizes 100000 1000000 --ratios 1 10 100 1000
+import argparse
+import asyncio
+import bisect
+import random
+import statistics
+import struct
+import time
+from itertools import takewhile, islice
+from statistics import mean
+
+from common import load_server, spawn_server, print_table
+
+means = load_server("02-means-to-an-end.py")
+
+
+class LegacyPriceHistory:
+    def __init__(self):
+        self.times = []
+        self.values = {}
+
+    def insert_value(self, time, value):
+        bisect.insort_right(self.times, time)
+        self.values[time] = value
+
+    def mean_value_between(self, lo, hi):
+        try:
+            j = bisect.bisect_left(self.times, lo)
+            V = takewhile(lambda u: lo <= u <= hi, islice(self.times, j, None))
+            return mean(map(lambda u: self.values[u], V))
+        except statistics.StatisticsError:
+            return 0
+
+
+def run(cls, n: int, queries: int, span: int):
+    rng = random.Random(n)
+    inserts = [(rng.randrange(-2**31, 2**31), rng.randrange(-2**20, 2**20)) for _ in range(n)]
+    ranges = []
+    for _ in range(queries):
+        lo = rng.randrange(-2**31, 2**31 - span)
+        ranges.append((lo, lo + span))
+
+    h = cls()
+    t = time.perf_counter()
+    for a, b in inserts:
+        h.insert_value(a, b)
+    insert_rate = n / (time.perf_counter() - t)
+
+    t = time.perf_counter()
+    for lo, hi in ranges:
+        h.mean_value_between(lo, hi)
+    query_rate = queries / (time.perf_counter() - t)
+    return insert_rate, query_rate
+
+
+def run_mixed(cls, n: int, ratio: int, jitter: int) -> float:
+    # Timestamps mostly increase, occasionally landing up to `jitter` back
+    rng = random.Random(ratio)
+    messages = []
+    t = 0
+    for i in range(n):
+        t += rng.randrange(1, 10)
+        if i % (ratio + 1) == ratio:
+            lo = rng.randrange(0, t)
+            messages.append((b'Q', lo, t))
+        else:
+            messages.append((b'I', t - rng.randrange(jitter), rng.randrange(100)))
+
+    h = cls()
+    start = time.perf_counter()
+    for what, a, b in messages:
+        if what == b'I':
+            h.insert_value(a, b)
+        else:
+            h.mean_value_between(a, b)
+    return n / (time.perf_counter() - start)
+
+
+async def legacy_handle(r: asyncio.StreamReader, w: asyncio.StreamWriter):
+    # The original handler: one readexactly per frame
+    H = means.HISTORIES[means.PRICE_HISTORY]()
+    while not r.at_eof():
+        try:
+            what, a, b = means.request.unpack(await r.readexactly(9))
+            if what == b'I':
+                H.insert_value(a, b)
+            elif what == b'Q':
+                w.write(means.response.pack(int(H.mean_value_between(a, b))))
+        except (ValueError, asyncio.IncompleteReadError):
+            w.write(means.response.pack(-1))
+    await w.drain()
+    w.close()
+
+
+async def start(kind: str):
+    if kind == "stream":
+        return await asyncio.start_server(legacy_handle, "127.0.0.1", 0)
+    loop = asyncio.get_running_loop()
+    return await loop.create_server(means.MeansProtocol, "127.0.0.1", 0)
+
+
+async def load(port: int, connections: int, frames: int, ratio: int) -> float:
+    rng = random.Random(0)
+    payload = bytearray()
+    queries = 0
+    for i in range(frames):
+        if i % (ratio + 1) == ratio:
+            payload += struct.pack("!cii", b'Q', 0, i)
+            queries += 1
+        else:
+            payload += struct.pack("!cii", b'I', i, rng.randrange(100))
+
+    async def client():
+        r, w = await asyncio.open_connection("127.0.0.1", port)
+        w.write(payload)
+        await r.readexactly(4 * queries)
+        w.close()
+
+    t = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(connections)))
+    return frames / (time.perf_counter() - t)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--queries", type=int, default=10000)
+    parser.add_argument("--span", type=int, default=2**30, help="width of each queried range")
+    parser.add_argument("--legacy-max", type=int, default=100000, help="largest size to run the legacy store at")
+    parser.add_argument("--ratios", type=int, nargs="+", default=[1, 10, 100, 1000], help="inserts per query")
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--jitter", type=int, default=50)
+    parser.add_argument("--connections", type=int, default=1)
+    parser.add_argument("--frames", type=int, default=200000, help="frames sent per connection")
+    args = parser.parse_args()
+
+    rows = []
+    for n in args.sizes:
+        stores = [("columnar", means.PriceHistory)]
+        if n <= args.legacy_max:
+            stores.append(("legacy", LegacyPriceHistory))
+        for name, cls in stores:
+            insert_rate, query_rate = run(cls, n, args.queries, args.span)
+            rows.append([name, n, f"{insert_rate:,.0f}", f"{query_rate:,.0f}"])
+    print_table(["store", "inserts", "inserts/sec", "queries/sec"], rows)
+    print()
+
+    rows = []
+    for ratio in args.ratios:
+        row = [ratio]
+        for cls in (means.PriceHistory, means.LazyPriceHistory):
+            row.append(f"{run_mixed(cls, args.messages, ratio, args.jitter):,.0f}")
+        rows.append(row)
+    print_table(["inserts/query", "eager msgs/sec", "lazy msgs/sec"], rows)
+    print()
+
+    rows = []
+    for kind in ("stream", "protocol"):
+        process, port = spawn_server(start, kind)
+        try:
+            for ratio in args.ratios:
+                rate = asyncio.run(load(port, args.connections, args.frames, ratio))
+                rows.append([kind, ratio, f"{rate:,.0f}"])
+        finally:
+            process.terminate()
+    print_table(["server", "inserts/query", "msgs/sec per connection"], rows)
+
+
+if __name__ == "__main__":
+    main()
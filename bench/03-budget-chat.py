@@ -0,0 +1,111 @@
+# Connected-user and message throughput of budget chat as the number of worker
+# processes grows. Every user sends --messages lines and waits until it has
+# received everyone else's.
+#
+#   python bench/03-budget-chat.py --workers 0 1 2 4 --users 200 --messages 20
+import argparse
+import asyncio
+import multiprocessing
+import socket
+import time
+
+from common import load_server, print_table
+
+chat = load_server("03-budget-chat.py")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_listening(port: int):
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    raise TimeoutError()
+
+
+async def clients(port: int, names, total: int, messages: int, barrier):
+    loop = asyncio.get_running_loop()
+
+    async def join(name):
+        r, w = await asyncio.open_connection("127.0.0.1", port)
+        await r.readline()
+        w.write(f"{name}\n".encode())
+        await r.readline()
+        return r, w
+
+    t = time.perf_counter()
+    users = await asyncio.gather(*(join(name) for name in names))
+    connect_time = time.perf_counter() - t
+    await loop.run_in_executor(None, barrier.wait)
+
+    async def talk(r, w):
+        w.writelines(b"hello there\n" for _ in range(messages))
+        expected = (total - 1) * messages
+        while expected:
+            if (await r.readline()).startswith(b"["):
+                expected -= 1
+
+    t = time.perf_counter()
+    await asyncio.gather(*(talk(r, w) for r, w in users))
+    message_time = time.perf_counter() - t
+    for _, w in users:
+        w.close()
+    return connect_time, message_time
+
+
+def client_process(port, names, total, messages, barrier, results):
+    results.put(asyncio.run(clients(port, names, total, messages, barrier)))
+
+
+def run(workers: int, users: int, messages: int, processes: int):
+    ctx = multiprocessing.get_context("fork")
+    port = free_port()
+    # Not a daemon, as it starts worker processes of its own
+    server = ctx.Process(target=chat.serve, args=(workers, "127.0.0.1", port))
+    server.start()
+    barrier = ctx.Barrier(processes)
+    results = ctx.Queue()
+    names = [f"user{i}" for i in range(users)]
+    procs = [ctx.Process(target=client_process, args=(port, names[i::processes], users, messages, barrier, results))
+             for i in range(processes)]
+    try:
+        # The clients start once the server is up, so joins/sec leaves out its startup
+        wait_listening(port)
+        for p in procs:
+            p.start()
+        timings = [results.get() for _ in procs]
+    finally:
+        for p in procs:
+            if p.pid is not None:
+                p.join()
+        server.terminate()
+        server.join()
+    connect_time = max(c for c, _ in timings)
+    message_time = max(m for _, m in timings)
+    return users / connect_time, users * (users - 1) * messages / message_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=20, help="messages sent by each user")
+    parser.add_argument("--client-processes", type=int, default=2)
+    args = parser.parse_args()
+
+    rows = []
+    for workers in args.workers:
+        joins, deliveries = run(workers, args.users, args.messages, args.client_processes)
+        rows.append([workers, f"{joins:,.0f}", f"{deliveries:,.0f}"])
+    print_table(["workers", "joins/sec", "deliveries/sec"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+# Packets/sec of the UDP key-value store: the original str-decoding protocol,
+# the bytes protocol on one event loop, and the batched multi-worker engine.
+# Each client keeps --window retrieves in flight and sends a new one per reply.
+# Then, for every store backend, the RSS after loading --keys keys, get rates
+# for present and missing keys, and for the log store the time and RSS of a
+# restart.
+#
+#   python bench/04-unusual-database-program.py --workers 1 2 4 --clients 4 --keys 1000000
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
+from collections import defaultdict
+
+from common import load_server, print_table
+
+kv = load_server("04-unusual-database-program.py")
+
+
+class LegacyStore:
+    def __init__(self):
+        self.d = defaultdict(str)
+
+    def get(self, key):
+        if key == 'version':
+            return 'udp keystore 1.0'
+        else:
+            return self.d[key]
+
+    def set(self, key, value):
+        if key == 'version':
+            pass
+        else:
+            self.d[key] = value
+
+
+class LegacyProtocol(asyncio.DatagramProtocol):
+    store = LegacyStore()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        message = data.decode('utf8')
+        parts = message.split('=')
+        if len(parts) == 1:
+            key = parts[0]
+            value = self.store.get(parts[0])
+            response = f'{key}={value}'.encode('utf8')
+            self.transport.sendto(response, addr)
+        else:
+            key = parts[0]
+            value = '='.join(parts[1:])
+            self.store.set(key, value)
+
+
+def serve_legacy(host: str, port: int):
+    async def run():
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(LegacyProtocol, local_addr=(host, port))
+        await loop.create_future()
+
+    asyncio.run(run())
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def client(port: int, index: int, window: int, duration: float, results):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect(("127.0.0.1", port))
+    sock.settimeout(0.2)
+    keys = [f"key{index}-{i}".encode() for i in range(window)]
+    for key in keys:
+        sock.send(key + b"=some value")
+    replies = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        for key in keys:
+            sock.send(key)
+        # Top the window up as replies come in, resend it all after a loss
+        try:
+            while time.perf_counter() < deadline:
+                reply = sock.recv(2048)
+                replies += 1
+                sock.send(reply.partition(b"=")[0])
+        except socket.timeout:
+            pass
+    results.put(replies)
+
+
+def run(target, args_, clients: int, window: int, duration: float) -> float:
+    ctx = multiprocessing.get_context("fork")
+    server = ctx.Process(target=target, args=args_)
+    server.start()
+    time.sleep(0.5)
+    results = ctx.Queue()
+    procs = [ctx.Process(target=client, args=(args_[-1], i, window, duration, results)) for i in range(clients)]
+    try:
+        for p in procs:
+            p.start()
+        total = sum(results.get() for _ in procs)
+    finally:
+        for p in procs:
+            p.join()
+        server.terminate()
+        server.join()
+    return total / duration
+
+
+def rss_kb() -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+
+
+def get_rate(store, keys) -> float:
+    start = time.perf_counter()
+    for key in keys:
+        store.get(key)
+    return len(keys) / (time.perf_counter() - start)
+
+
+def measure_store(conn, name: str, keys: int, path: str):
+    # Runs in a fresh process so the RSS belongs to this store alone
+    before = rss_kb()
+    store = kv.LogStore(path) if name == "log" else kv.STORES[name]()
+    start = time.perf_counter()
+    for i in range(keys):
+        store.set(b"key%d" % i, b"value %d" % i)
+    store.flush()
+    load = time.perf_counter() - start
+    present = [b"key%d" % i for i in range(0, keys, 7)]
+    missing = [b"nokey%d" % i for i in range(0, keys, 7)]
+    row = [name, f"{keys / load:,.0f}", f"{rss_kb() - before:,}", f"{get_rate(store, present):,.0f}",
+           f"{get_rate(store, missing):,.0f}"]
+    store.close()
+    conn.send(row)
+
+
+def measure_restart(conn, path: str):
+    before = rss_kb()
+    start = time.perf_counter()
+    store = kv.LogStore(path)
+    elapsed = time.perf_counter() - start
+    conn.send([f"{elapsed * 1000:.1f}", f"{rss_kb() - before:,}", len(store.recent)])
+    store.close()
+
+
+def in_child(target, *args):
+    ctx = multiprocessing.get_context("fork")
+    parent, child = ctx.Pipe()
+    process = ctx.Process(target=target, args=(child,) + args)
+    process.start()
+    result = parent.recv()
+    process.join()
+    return result
+
+
+def bench_stores(keys: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "kv")
+        rows = [in_child(measure_store, name, keys, path) for name in kv.STORES]
+        print_table(["store", "sets/sec", "RSS kB", "hits/sec", "misses/sec"], rows)
+        print()
+        rows = [["log, after load"] + in_child(measure_restart, path)]
+        # A compaction leaves nothing to replay
+        store = kv.LogStore(path)
+        store.compact()
+        store.close()
+        rows.append(["log, after compaction"] + in_child(measure_restart, path))
+        print_table(["restart", "ms", "RSS kB", "replayed keys"], rows)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=4, help="client processes")
+    parser.add_argument("--window", type=int, default=32, help="retrieves in flight per client")
+    parser.add_argument("--duration", type=float, default=3)
+    parser.add_argument("--keys", type=int, default=1_000_000, help="keys loaded into each store")
+    args = parser.parse_args()
+
+    servers = [("legacy", serve_legacy, ("127.0.0.1",)), ("protocol", kv.serve, (0, "127.0.0.1"))]
+    servers += [(f"engine x{n}", kv.serve, (n, "127.0.0.1")) for n in args.workers]
+    rows = []
+    for name, target, args_ in servers:
+        rate = run(target, args_ + (free_port(),), args.clients, args.window, args.duration)
+        rows.append([name, f"{rate:,.0f}"])
+    print_table(["server", "replies/sec"], rows)
+    print()
+    bench_stores(args.keys)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+# Throughput of one proxied connection, in MB/s, for the original line-by-line
+# proxy and the chunked one. A local echo server stands in for the chat server,
+# so every byte is rewritten on the way up and again on the way back.
+# --addresses is the fraction of messages that carry a Boguscoin address.
+# Then the time to first byte of new sessions, with upstream connections opened
+# per session and taken from pools of several sizes, against an upstream that
+# greets clients --upstream-delay ms after they connect.
+#
+#   python bench/05-mob-in-the-middle.py --megabytes 64 --addresses 0 0.1 1 --pools 0 16 64
+import argparse
+import asyncio
+import random
+import re
+import statistics
+import time
+from typing import List
+
+from common import load_server, spawn_server, print_table
+
+mob = load_server("05-mob-in-the-middle.py")
+
+LEGACY_PATTERN = re.compile(r"(^|\s)(7[a-zA-Z0-9]{25,34})(?=($|\s))")
+
+
+class ConnectionDropped(Exception):
+    ...
+
+
+def legacy_replace(s: bytes):
+    def f(m):
+        TARGET_ADDR = "7YWHMfk9JZe0LM0g1ZauHuiSxhI"
+        return f"{m.group(1)}{TARGET_ADDR}"
+
+    return re.sub(LEGACY_PATTERN, f, s.decode('utf8')).encode('utf8')
+
+
+async def legacy_handle(r: asyncio.StreamReader, w: asyncio.StreamWriter):
+    ur, uw = None, None
+
+    async def upstream():
+        while not r.at_eof():
+            content = await r.readline()
+            uw.write(legacy_replace(content))
+        raise ConnectionDropped()
+
+    async def downstream():
+        while not ur.at_eof():
+            content = await ur.readline()
+            w.write(legacy_replace(content))
+        raise ConnectionDropped()
+
+    async def cleanup():
+        await uw.drain()
+        uw.close()
+        await uw.wait_closed()
+        await w.drain()
+        w.close()
+
+    try:
+        ur, uw = await asyncio.open_connection(mob.UPSTREAM_HOST, mob.UPSTREAM_PORT)
+        upstream_task = asyncio.create_task(upstream())
+        downstream_task = asyncio.create_task(downstream())
+        await asyncio.gather(upstream_task, downstream_task)
+    except ConnectionDropped:
+        await cleanup()
+
+
+async def echo(r: asyncio.StreamReader, w: asyncio.StreamWriter):
+    while data := await r.read(1 << 16):
+        w.write(data)
+        await w.drain()
+    w.close()
+
+
+async def start_echo(delay: float = 0):
+    async def greet(r: asyncio.StreamReader, w: asyncio.StreamWriter):
+        await asyncio.sleep(delay)
+        w.write(b"Welcome to budgetchat! What shall I call you?\n")
+        await echo(r, w)
+
+    return await asyncio.start_server(greet if delay else echo, "127.0.0.1", 0)
+
+
+async def start_proxy(handler, upstream_port: int, pool_size: int = 0):
+    # The name lookup is part of what the pool saves
+    mob.UPSTREAM_HOST, mob.UPSTREAM_PORT = "localhost", upstream_port
+    mob.pool = mob.UpstreamPool(mob.UPSTREAM_HOST, mob.UPSTREAM_PORT, size=pool_size)
+    mob.pool.start()
+    return await asyncio.start_server(handler, "127.0.0.1", 0)
+
+
+def make_payload(megabytes: int, addresses: float) -> bytes:
+    rng = random.Random(0)
+    plain = [b"[alice] Hi bob, how is the weather today?\n",
+             b"[bob] Lovely, thanks. Shall we meet at 7 tomorrow?\n"]
+    bogus = [b"[alice] Please send the payment to 7F1u3wSD5RbOHQmupo9nx4TnhQ\n",
+             b"[bob] 7iKDZEwPZSqIvDnHvVN2r0hUWXD5rHX is mine, not yours\n"]
+    lines = []
+    size = 0
+    while size < megabytes << 20:
+        line = rng.choice(bogus if rng.random() < addresses else plain)
+        lines.append(line)
+        size += len(line)
+    return b"".join(lines)
+
+
+async def transfer(port: int, payload: bytes, expected: int) -> float:
+    r, w = await asyncio.open_connection("127.0.0.1", port)
+
+    async def send():
+        view = memoryview(payload)
+        for i in range(0, len(payload), 1 << 16):
+            w.write(view[i:i + (1 << 16)])
+            await w.drain()
+
+    start = time.perf_counter()
+    sender = asyncio.create_task(send())
+    received = 0
+    while received < expected:
+        data = await r.read(1 << 16)
+        if not data:
+            raise ValueError()
+        received += len(data)
+    elapsed = time.perf_counter() - start
+    await sender
+    w.close()
+    return len(payload) / elapsed / 1e6
+
+
+async def first_bytes(port: int, sessions: int, concurrency: int) -> List[float]:
+    ttfb = []
+
+    async def session():
+        start = time.perf_counter()
+        r, w = await asyncio.open_connection("127.0.0.1", port)
+        await r.readline()
+        ttfb.append(time.perf_counter() - start)
+        w.close()
+
+    async def client(n: int):
+        for _ in range(n):
+            await session()
+            # Give the pool a moment to top itself up, as real clients would
+            await asyncio.sleep(0.005)
+
+    await asyncio.gather(*(client(sessions // concurrency) for _ in range(concurrency)))
+    return sorted(ttfb)
+
+
+def bench_pool(pools: List[int], sessions: int, concurrency: int, delay: float):
+    upstream, upstream_port = spawn_server(start_echo, delay)
+    rows = []
+    for size in pools:
+        process, port = spawn_server(start_proxy, mob.handle, upstream_port, size)
+        # Let the pool fill up before the first client arrives
+        time.sleep(0.5)
+        ttfb = asyncio.run(first_bytes(port, sessions, concurrency))
+        process.terminate()
+        rows.append([size, f"{statistics.median(ttfb) * 1000:.2f}", f"{ttfb[int(0.99 * (len(ttfb) - 1))] * 1000:.2f}",
+                     f"{ttfb[-1] * 1000:.2f}"])
+    upstream.terminate()
+    print_table(["pool size", "TTFB p50 ms", "TTFB p99 ms", "TTFB max ms"], rows)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--megabytes", type=int, default=64, help="sent through each proxy")
+    parser.add_argument("--addresses", type=float, nargs="+", default=[0, 0.1, 1])
+    parser.add_argument("--pools", type=int, nargs="+", default=[0, 16, 64])
+    parser.add_argument("--sessions", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8, help="sessions opened at once")
+    parser.add_argument("--upstream-delay", type=float, default=5, help="ms before the upstream greets")
+    args = parser.parse_args()
+
+    upstream, upstream_port = spawn_server(start_echo)
+    proxies = {"legacy": spawn_server(start_proxy, legacy_handle, upstream_port),
+               "chunked": spawn_server(start_proxy, mob.handle, upstream_port)}
+    rows = []
+    for addresses in args.addresses:
+        payload = make_payload(args.megabytes, addresses)
+        # Rewriting an address again leaves it as it is
+        expected = len(mob.replace(payload))
+        rates = {name: asyncio.run(transfer(port, payload, expected)) for name, (_, port) in proxies.items()}
+        rows.append([f"{addresses:g}", f"{rates['legacy']:,.1f}", f"{rates['chunked']:,.1f}",
+                     f"{rates['chunked'] / rates['legacy']:.1f}x"])
+    print_table(["addresses", "legacy MB/s", "chunked MB/s", "speedup"], rows)
+    for process, _ in proxies.values():
+        process.terminate()
+    upstream.terminate()
+    print()
+    bench_pool(args.pools, args.sessions, args.concurrency, args.upstream_delay / 1000)
+
+
+if __name__ == "__main__":
+    main()
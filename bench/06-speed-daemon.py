@@ -0,0 +1,266 @@
+# Load test of the speed daemon's ticketing engine, without sockets: --cameras
+# cameras spread over --roads roads report --plates cars driving past them,
+# some of them too fast, with sightings arriving slightly out of order.
+# Reports sightings/sec, tickets/sec and the memory held per sighting.
+# Then the parse rate of FrameDecoder against the original ByteBuffer on a
+# stream of mixed client messages, and the rate of encoding tickets. Last, the
+# CPU time and memory spent on heartbeats for growing numbers of clients, with
+# one sleeping task per client against the shared HeartbeatWheel.
+#
+#   python bench/06-speed-daemon.py --cameras 5000 --plates 100000 --roads 100 --messages 10000 1000000 \
+#       --heartbeat-clients 100 10000 100000
+import argparse
+import asyncio
+import random
+import struct
+import time
+import tracemalloc
+
+from common import load_server, print_table
+
+sd = load_server("06-speed-daemon.py")
+
+
+def make_sightings(cameras: int, plates: int, roads: int, trips: int, seed: int = 0):
+    rng = random.Random(seed)
+    per_road = max(2, cameras // roads)
+    layout = {road: sorted(rng.sample(range(1, 60000), per_road)) for road in range(roads)}
+    limits = {road: rng.choice([30, 50, 60, 70]) for road in range(roads)}
+    sightings = []
+    for i in range(plates):
+        plate = f"P{i:07d}"
+        start = rng.randrange(10 * sd.DAY)
+        for _ in range(trips):
+            road = rng.randrange(roads)
+            # One car in ten speeds
+            speed = limits[road] * (rng.uniform(1.1, 1.5) if rng.random() < 0.1 else rng.uniform(0.5, 1))
+            t = start
+            previous = layout[road][0]
+            for j, mile in enumerate(layout[road][:8]):
+                t += int((mile - previous) * 3600 / speed)
+                previous = mile
+                sightings.append((t + rng.randrange(-5, 5), road * per_road + j, plate, t))
+            start = t + rng.randrange(3600, sd.DAY)
+    # Roughly in arrival order, with some jitter between cameras
+    sightings.sort()
+    return layout, limits, per_road, [(camera, plate, t) for _, camera, plate, t in sightings]
+
+
+def replay(layout, limits, per_road: int, roads: int, sightings):
+    state = sd.State()
+    for road, miles in layout.items():
+        for j, mile in enumerate(miles):
+            state.add_camera(road * per_road + j, road, mile, limits[road])
+    received = []
+    # Half the roads have a dispatcher from the start, the rest get theirs at the end
+    state.add_dispatcher("early", range(0, roads, 2), received.append)
+    start = time.perf_counter()
+    for camera, plate, t in sightings:
+        state.register(camera, plate, t)
+    elapsed = time.perf_counter() - start
+    state.add_dispatcher("late", range(1, roads, 2), received.append)
+    if len(received) != state.tickets:
+        raise ValueError()
+    return state, elapsed
+
+
+def run(cameras: int, plates: int, roads: int, trips: int):
+    layout, limits, per_road, sightings = make_sightings(cameras, plates, roads, trips)
+    state, elapsed = replay(layout, limits, per_road, roads, sightings)
+    # Tracing slows everything down, so memory is measured on a second run
+    del state
+    tracemalloc.start()
+    state, _ = replay(layout, limits, per_road, roads, sightings)
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return [f"{cameras:,}", f"{plates:,}", f"{len(sightings):,}", f"{len(sightings) / elapsed:,.0f}",
+            f"{state.tickets:,}", f"{state.tickets / elapsed:,.0f}", f"{used / len(sightings):.1f}"]
+
+
+class LegacyByteBuffer:
+    def __init__(self, b: bytes):
+        self.b = b
+
+    def consume(self, n):
+        if len(self.b) < n:
+            raise ValueError()
+        sl, self.b = self.b[:n], self.b[n:]
+        return sl
+
+    def get_u8(self):
+        return int(self.consume(1)[0])
+
+    def get_u16(self):
+        u16, = struct.unpack(f"!H", self.consume(2))
+        return u16
+
+    def get_u32(self):
+        u32, = struct.unpack(f"!I", self.consume(4))
+        return u32
+
+    def get_pascal_str(self):
+        length = int(self.b[0])
+        if not 0 <= length <= 256:
+            raise ValueError()
+        raw, = struct.unpack(f"!{1 + length}p", self.consume(1 + length))
+        return raw.decode('utf8')
+
+
+def legacy_parse(data: bytes) -> int:
+    buf = LegacyByteBuffer(data)
+    n = 0
+    while buf.b:
+        kind = buf.get_u8()
+        if kind == 0x20:
+            sd.Plate(buf.get_pascal_str(), buf.get_u32())
+        elif kind == 0x40:
+            sd.WantHeartbeat(buf.get_u32())
+        elif kind == 0x80:
+            sd.IAmCamera(buf.get_u16(), buf.get_u16(), buf.get_u16())
+        else:
+            sd.IAmDispatcher([buf.get_u16() for _ in range(buf.get_u8())])
+        n += 1
+    return n
+
+
+def decoder_parse(data: bytes, chunk: int) -> int:
+    decoder = sd.FrameDecoder()
+    n = 0
+    for i in range(0, len(data), chunk):
+        decoder.feed(data[i:i + chunk])
+        while messages := decoder.decode():
+            n += len(messages)
+    return n
+
+
+def legacy_ticket(t) -> bytes:
+    return b"\x21" + struct.pack(f"!{len(t.plate) + 1}pHHIHIH", t.plate, t.road, t.mile1, t.timestamp1,
+                                  t.mile2, t.timestamp2, t.speed)
+
+
+def make_messages(n: int) -> bytes:
+    rng = random.Random(0)
+    frames = []
+    for _ in range(n):
+        kind = rng.random()
+        if kind < 0.9:
+            plate = f"P{rng.randrange(10 ** 6):07d}".encode()
+            frames.append(b"\x20" + bytes([len(plate)]) + plate + struct.pack("!I", rng.randrange(1 << 32)))
+        elif kind < 0.95:
+            frames.append(b"\x80" + struct.pack("!HHH", rng.randrange(1 << 16), rng.randrange(1 << 16), 60))
+        elif kind < 0.98:
+            roads = rng.sample(range(1 << 16), rng.randrange(1, 8))
+            frames.append(b"\x81" + bytes([len(roads)]) + struct.pack(f"!{len(roads)}H", *roads))
+        else:
+            frames.append(b"\x40" + struct.pack("!I", rng.randrange(100)))
+    return b"".join(frames)
+
+
+def rate(f, *args) -> str:
+    start = time.perf_counter()
+    n = f(*args)
+    return f"{n / (time.perf_counter() - start):,.0f}"
+
+
+def bench_codec(sizes, chunk: int, legacy_max: int):
+    rows = []
+    for n in sizes:
+        data = make_messages(n)
+        legacy = rate(legacy_parse, data) if n <= legacy_max else "-"
+        rows.append([f"{n:,}", legacy, rate(decoder_parse, data, chunk)])
+    print_table(["messages", "ByteBuffer msgs/sec", "FrameDecoder msgs/sec"], rows)
+    print()
+
+    tickets = [sd.Ticket(f"P{i:07d}", i % 1000, 10, i, 20, i + 300, 9000) for i in range(100000)]
+
+    def encode_legacy():
+        for t in tickets:
+            legacy_ticket(t)
+        return len(tickets)
+
+    def encode_to_bytes():
+        for t in tickets:
+            t.to_bytes()
+        return len(tickets)
+
+    print_table(["ticket encoding", "tickets/sec"],
+                [["struct.pack with format string", rate(encode_legacy)],
+                 ["Ticket.to_bytes", rate(encode_to_bytes)]])
+
+
+class CountingWriter:
+    written = 0
+
+    def write(self, data: bytes):
+        CountingWriter.written += 1
+
+    def is_closing(self) -> bool:
+        return False
+
+
+async def task_heartbeat(ds: int, w):
+    while True:
+        await asyncio.sleep(ds * 0.1)
+        w.write(b"\x41")
+
+
+async def run_heartbeats(kind: str, clients: int, duration: float):
+    rng = random.Random(0)
+    writers = [CountingWriter() for _ in range(clients)]
+    intervals = [rng.randrange(1, 51) for _ in range(clients)]
+    tracemalloc.start()
+    if kind == "tasks":
+        tasks = [asyncio.create_task(task_heartbeat(ds, w)) for ds, w in zip(intervals, writers)]
+    else:
+        wheel = sd.HeartbeatWheel()
+        for ds, w in zip(intervals, writers):
+            wheel.add(w, ds)
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # Let the clients settle in before measuring
+    await asyncio.sleep(1)
+    CountingWriter.written = 0
+    cpu = time.process_time()
+    await asyncio.sleep(duration)
+    cpu = time.process_time() - cpu
+    written = CountingWriter.written
+    if kind == "tasks":
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    else:
+        for w in writers:
+            wheel.remove(w)
+    return [kind, f"{clients:,}", f"{written / duration:,.0f}", f"{100 * cpu / duration:.1f}",
+            f"{cpu / written * 1e6:.2f}" if written else "-", f"{used / clients:.0f}"]
+
+
+def bench_heartbeats(sizes, duration: float):
+    rows = [asyncio.run(run_heartbeats(kind, n, duration)) for n in sizes for kind in ("tasks", "wheel")]
+    print_table(["scheduler", "clients", "heartbeats/sec", "CPU %", "CPU us/heartbeat", "bytes/client"], rows)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cameras", type=int, nargs="+", default=[1000, 5000])
+    parser.add_argument("--plates", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--roads", type=int, default=100)
+    parser.add_argument("--trips", type=int, default=3, help="roads driven per car")
+    parser.add_argument("--messages", type=int, nargs="+", default=[10000, 1000000])
+    parser.add_argument("--chunk", type=int, default=4096, help="bytes fed to the decoder at a time")
+    parser.add_argument("--legacy-max", type=int, default=50000,
+                        help="largest stream given to ByteBuffer, which is quadratic")
+    parser.add_argument("--heartbeat-clients", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    parser.add_argument("--heartbeat-duration", type=float, default=5)
+    args = parser.parse_args()
+    rows = [run(c, p, args.roads, args.trips) for c in args.cameras for p in args.plates]
+    print_table(["cameras", "plates", "sightings", "sightings/sec", "tickets", "tickets/sec", "bytes/sighting"],
+                rows)
+    print()
+    bench_codec(args.messages, args.chunk, args.legacy_max)
+    print()
+    bench_heartbeats(args.heartbeat_clients, args.heartbeat_duration)
+
+
+if __name__ == "__main__":
+    main()
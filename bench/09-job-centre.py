@@ -0,0 +1,369 @@
+# Put and get rates of the job centre's Context against the original one, with
+# --jobs jobs spread over --queues queues and --workers workers that each get
+# from their own fixed list of queues and delete what they get. Then the memory
+# still held once every job has been deleted. Last, --waiters clients block in
+# a waiting get before as many jobs are put, all on one queue and spread over
+# many, reporting how long the jobs take to reach them. Then the rate at which
+# --durable-clients clients each put, get and delete jobs with no write-ahead
+# log and with one fsynced in groups of each of --wal-batch records, and how
+# long recovering from logs of --recover-records records takes, from the log
+# alone and from a snapshot. Last, puts/sec from --pipeline-connections
+# clients that each send --pipeline-puts puts before reading any reply, against
+# the original line-at-a-time handler and the batched one, with and without
+# the write-ahead log.
+#
+#   python bench/09-job-centre.py --jobs 1000000 --queues 10000 --get-queues 1 16 256 --waiters 10000
+#   python bench/09-job-centre.py --wal-batch 1 16 256 --recover-records 10000 100000 1000000
+#   python bench/09-job-centre.py --pipeline-connections 8 --pipeline-puts 20000
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from dataclasses import dataclass, field
+from heapq import heappush, heappop
+from typing import List
+
+from common import load_server, spawn_server, print_table
+
+import runtime
+
+jc = load_server("09-job-centre.py")
+
+
+@dataclass(order=True)
+class LegacyJob:
+    pri: int
+    jid: int = field(compare=False)
+    queue: str = field(compare=False)
+    task: dict = field(compare=False)
+
+
+class LegacyContext:
+    def __init__(self):
+        self.queues = defaultdict(list)
+        self.cond = asyncio.Condition()
+        self.jid = 1
+        self.clientid = 1
+        self.working = defaultdict(dict)
+        self.deleted = set()
+        self.posted = set()
+
+    def is_live(self, jid):
+        return jid in self.posted and jid not in self.deleted
+
+    async def put(self, queue: str, task: dict, pri: int) -> int:
+        async with self.cond:
+            self.jid += 1
+            heappush(self.queues[queue], LegacyJob(-pri, self.jid, queue, task))
+            self.posted.add(self.jid)
+            self.cond.notify()
+            return self.jid
+
+    async def get(self, client: int, queues: List[str], wait: bool) -> LegacyJob | None:
+        def jobs_available() -> bool:
+            return any(self.queues[q] for q in queues)
+
+        def pop_job() -> LegacyJob:
+            def min_pri(queue: str) -> int:
+                if self.queues[queue]:
+                    return self.queues[queue][0].pri
+                else:
+                    return 1
+
+            to_pop = min((q for q in queues), key=min_pri)
+            return heappop(self.queues[to_pop])
+
+        async with self.cond:
+            while True:
+                if not jobs_available() and not wait:
+                    return None
+                if wait:
+                    await self.cond.wait_for(jobs_available)
+
+                job = pop_job()
+                self.working[client][job.jid] = job
+                if self.is_live(job.jid):
+                    return job
+
+    async def delete(self, jid: int) -> bool:
+        async with self.cond:
+            if self.is_live(jid):
+                self.deleted.add(jid)
+                return True
+            else:
+                return False
+
+
+def workload(jobs: int, queues: int, workers: int, get_queues: int, seed: int = 0):
+    rng = random.Random(seed)
+    names = [f"queue-{i}" for i in range(queues)]
+    puts = [(rng.choice(names), rng.randrange(1000)) for _ in range(jobs)]
+    lists = [rng.sample(names, get_queues) for _ in range(workers)]
+    return puts, lists
+
+
+async def run(context, puts, lists, gets: int):
+    start = time.perf_counter()
+    for queue, pri in puts:
+        await context.put(queue, {"pri": pri}, pri)
+    put_rate = len(puts) / (time.perf_counter() - start)
+
+    got = 0
+    start = time.perf_counter()
+    for i in range(gets):
+        job = await context.get(i % len(lists), lists[i % len(lists)], False)
+        if job is not None:
+            got += 1
+            await context.delete(job.jid)
+    get_rate = gets / (time.perf_counter() - start)
+    return put_rate, get_rate, got
+
+
+async def retained(cls, puts) -> int:
+    # Everything put is deleted again: whatever is still allocated stays for good
+    tracemalloc.start()
+    context = cls()
+    jids = [await context.put(queue, {"pri": pri}, pri) for queue, pri in puts]
+    for jid in jids:
+        await context.delete(jid)
+    del jids
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return used
+
+
+async def serve_waiters(cls, waiters: int, queues: int, per_waiter: int, seed: int = 0):
+    rng = random.Random(seed)
+    context = cls()
+    names = [f"queue-{i}" for i in range(queues)]
+    put_at = {}
+    latencies = []
+    order = []
+    last = 0.0
+
+    async def waiter(client: int, listening: List[str]):
+        nonlocal last
+        job = await context.get(client, listening, True)
+        last = time.perf_counter()
+        latencies.append(last - put_at[job.jid])
+        order.append(client)
+
+    tasks = [asyncio.create_task(waiter(i, rng.sample(names, per_waiter))) for i in range(waiters)]
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    for i in range(waiters):
+        jid = await context.put(rng.choice(names), {"n": i}, rng.randrange(10))
+        put_at[jid] = time.perf_counter()
+        if i % 100 == 99:
+            await asyncio.sleep(0)
+    # Jobs put on queues nobody is waiting on stay queued, the rest are served
+    while len(latencies) < waiters and time.perf_counter() - start < 60:
+        done = len(latencies)
+        await asyncio.sleep(0.01)
+        if len(latencies) == done and done and per_waiter > 1:
+            break
+    elapsed = last - start
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    latencies.sort()
+    return [len(latencies), len(latencies) / elapsed, latencies[len(latencies) // 2] * 1000,
+            latencies[int(0.99 * (len(latencies) - 1))] * 1000, order == sorted(order) if queues == 1 else None]
+
+
+def bench_waiters(waiters: int, queues: int):
+    rows = []
+    for name, cls, q, per_waiter in (("legacy", LegacyContext, 1, 1), ("registry", jc.Context, 1, 1),
+                                     ("registry", jc.Context, queues, 4)):
+        served, rate, p50, p99, fifo = asyncio.run(serve_waiters(cls, waiters, q, per_waiter))
+        rows.append([name, f"{waiters:,}", f"{q:,}", per_waiter, f"{served:,}", f"{rate:,.0f}", f"{p50:.2f}",
+                     f"{p99:.2f}", "-" if fifo is None else "yes" if fifo else "no"])
+    print_table(["context", "waiters", "queues", "queues/waiter", "served", "served/sec", "p50 ms", "p99 ms",
+                 "in arrival order"], rows)
+
+
+async def durable_clients(log, clients: int, seconds: float) -> float:
+    context = jc.Context()
+    if log is not None:
+        context.log = log
+        log.load(context)
+        log.start(context)
+    done = 0
+    deadline = time.perf_counter() + seconds
+
+    async def client(i: int):
+        nonlocal done
+        clientid = await context.get_client_id()
+        queue = f"q{i}"
+        while time.perf_counter() < deadline:
+            await context.put(queue, {"n": done}, random.randrange(100))
+            job = await context.get(clientid, [queue], False)
+            await context.delete(job.jid)
+            done += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(clients)))
+    elapsed = time.perf_counter() - start
+    if log is not None:
+        log.task.cancel()
+    return done / elapsed
+
+
+def recover(records: int, snapshot: bool) -> float:
+    # A log of puts where one job in four is later deleted
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "jobs")
+        log = jc.JobLog(path)
+        log.load(jc.Context())
+        lines, jid = [], 1
+        while len(lines) < records:
+            jid += 1
+            lines.append(f'["put", {jid}, "q{jid % 1000}", {-jid % 100}, {{"n": {jid}}}]\n'.encode())
+            if jid % 4 == 0:
+                lines.append(f'["delete", {jid - 1}]\n'.encode())
+        log.write(lines)
+        if snapshot:
+            context = jc.Context()
+            jc.JobLog(path).load(context)
+        start = time.perf_counter()
+        context = jc.Context()
+        jc.JobLog(path).load(context)
+        return time.perf_counter() - start
+
+
+def bench_durability(clients: int, seconds: float, batches: List[int], records: List[int]):
+    rows = [["off", "-", f"{asyncio.run(durable_clients(None, clients, seconds)):,.0f}"]]
+    for batch in batches:
+        with tempfile.TemporaryDirectory() as d:
+            log = jc.JobLog(os.path.join(d, "jobs"), batch=batch)
+            rows.append(["wal", batch, f"{asyncio.run(durable_clients(log, clients, seconds)):,.0f}"])
+    print_table(["durability", "records/fsync", "put+get+delete/sec"], rows)
+    print()
+
+    rows = [[f"{n:,}", f"{recover(n, False):.2f}", f"{recover(n, True):.2f}"] for n in records]
+    print_table(["log records", "recovery from log s", "recovery from snapshot s"], rows)
+
+
+async def legacy_handle(r: asyncio.StreamReader, w: asyncio.StreamWriter):
+    # The original loop: one line, one json.loads, one operation and its own
+    # wait for the log, then two writes
+    def write_json(d):
+        w.write(json.dumps(d).encode("utf8"))
+        w.write(b"\n")
+
+    context = jc.context
+    clientid = await context.get_client_id()
+    while line := await r.readline():
+        try:
+            o = json.loads(line.decode("utf8"))
+            match o['request']:
+                case "get":
+                    job = await context.get(clientid, o['queues'], False)
+                    if job:
+                        write_json({"status": "ok", "id": job.jid, "job": job.task, "pri": -job.pri,
+                                    "queue": job.queue})
+                    else:
+                        write_json({"status": "no-job"})
+                case "put":
+                    write_json({"status": "ok", "id": await context.put(o['queue'], o['job'], o['pri'])})
+                case "delete":
+                    write_json({"status": "ok" if await context.delete(o['id']) else "no-job"})
+        except (ValueError, KeyError):
+            write_json({"status": "error", "error": "invalid-json"})
+    await context.disconnect(clientid)
+    await w.drain()
+    w.close()
+
+
+async def start_pipeline(handler, use_orjson: bool, wal: str | None):
+    if not use_orjson:
+        runtime.orjson = None
+    if wal is not None:
+        jc.context.log = jc.JobLog(wal)
+        jc.context.log.load(jc.context)
+        jc.context.log.start(jc.context)
+    return await asyncio.start_server(handler, "127.0.0.1", 0)
+
+
+async def put_client(port: int, payload: bytes, n: int):
+    r, w = await asyncio.open_connection("127.0.0.1", port)
+    w.write(payload)
+    await w.drain()
+    for _ in range(n):
+        await r.readline()
+    w.close()
+
+
+async def pipelined_puts(port: int, connections: int, n: int) -> float:
+    payloads = [b"".join(json.dumps({"request": "put", "queue": f"q{c}", "job": {"n": i}, "pri": i % 100}).encode()
+                         + b"\n" for i in range(n)) for c in range(connections)]
+    t = time.perf_counter()
+    await asyncio.gather(*(put_client(port, payload, n) for payload in payloads))
+    return connections * n / (time.perf_counter() - t)
+
+
+def bench_pipeline(connections: int, n: int):
+    rows = []
+    for name, handler, use_orjson in (("legacy/json", legacy_handle, False), ("batched/json", jc.handle, False),
+                                      ("batched/orjson", jc.handle, True)):
+        if use_orjson and runtime.orjson is None:
+            continue
+        for durable in (False, True):
+            with tempfile.TemporaryDirectory() as d:
+                process, port = spawn_server(start_pipeline, handler, use_orjson,
+                                             os.path.join(d, "jobs") if durable else None)
+                try:
+                    rate = asyncio.run(pipelined_puts(port, connections, n))
+                finally:
+                    process.terminate()
+                    process.join()
+            rows.append([name, "on" if durable else "off", f"{rate:,.0f}"])
+    print_table(["handler", "write-ahead log", "puts/sec"], rows)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=1_000_000)
+    parser.add_argument("--queues", type=int, default=10_000)
+    parser.add_argument("--workers", type=int, default=64)
+    parser.add_argument("--get-queues", type=int, nargs="+", default=[1, 16, 256], help="queues per get")
+    parser.add_argument("--legacy-gets", type=int, default=20_000,
+                        help="gets run against the original Context, which scans every queue")
+    parser.add_argument("--memory-jobs", type=int, default=100_000)
+    parser.add_argument("--waiters", type=int, default=10_000)
+    parser.add_argument("--durable-clients", type=int, default=256)
+    parser.add_argument("--durable-seconds", type=float, default=3)
+    parser.add_argument("--wal-batch", type=int, nargs="+", default=[1, 16, 256], help="records per fsync")
+    parser.add_argument("--recover-records", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--pipeline-connections", type=int, default=8)
+    parser.add_argument("--pipeline-puts", type=int, default=20_000)
+    args = parser.parse_args()
+
+    rows = []
+    for k in args.get_queues:
+        puts, lists = workload(args.jobs, args.queues, args.workers, k)
+        for name, cls, gets in (("legacy", LegacyContext, args.legacy_gets), ("indexed", jc.Context, args.jobs)):
+            put_rate, get_rate, got = asyncio.run(run(cls(), puts, lists, gets))
+            rows.append([name, k, f"{put_rate:,.0f}", f"{gets:,}", f"{got:,}", f"{get_rate:,.0f}"])
+    print_table(["context", "queues/get", "puts/sec", "gets", "jobs got", "gets/sec"], rows)
+    print()
+
+    puts, _ = workload(args.memory_jobs, args.queues, 1, 1)
+    rows = [[name, f"{args.memory_jobs:,}", f"{asyncio.run(retained(cls, puts)):,}"]
+            for name, cls in (("legacy", LegacyContext), ("indexed", jc.Context))]
+    print_table(["context", "jobs put and deleted", "bytes still held"], rows)
+    print()
+    bench_waiters(args.waiters, 1000)
+    print()
+    bench_durability(args.durable_clients, args.durable_seconds, args.wal_batch, args.recover_records)
+    print()
+    bench_pipeline(args.pipeline_connections, args.pipeline_puts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+# Helpers shared by the benchmark scripts in this directory.
+import asyncio
+import importlib.util
+import multiprocessing
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+def load_server(script: str):
+    # The server scripts are not importable by name because of the dashes.
+    name = script.removesuffix(".py").replace("-", "_")
+    spec = importlib.util.spec_from_file_location(name, ROOT / script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _serve(conn, factory, args):
+    async def run():
+        server = await factory(*args)
+        conn.send(server.sockets[0].getsockname()[1])
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(run())
+
+
+def spawn_server(factory, *args):
+    # Runs `await factory(*args)`, which must return a started asyncio server,
+    # in a forked child process. Returns the process and the port it listens on.
+    ctx = multiprocessing.get_context("fork")
+    parent, child = ctx.Pipe()
+    process = ctx.Process(target=_serve, args=(child, factory, args), daemon=True)
+    process.start()
+    return process, parent.recv()
+
+
+def print_table(headers, rows):
+    rows = [[str(c) for c in row] for row in rows]
+    widths = [max(len(h), *(len(r[i]) for r in rows)) for i, h in enumerate(headers)]
+    print("  ".join(h.ljust(n) for h, n in zip(headers, widths)))
+    for row in rows:
+        print("  ".join(c.ljust(n) for c, n in zip(row, widths)))
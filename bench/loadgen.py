@@ -0,0 +1,325 @@
+# Load generator for the protocol servers. Ramps the number of concurrent
+# clients and reports throughput, latency percentiles and the server's RSS for
+# every step. Everything runs against localhost.
+#
+#   python bench/loadgen.py prime --spawn --concurrency 1 4 16 64 --duration 5
+#   python bench/loadgen.py jobs --json > jobs.json
+#   python bench/loadgen.py jobs --baseline jobs.json
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import time
+from abc import ABC, abstractmethod
+
+from common import ROOT, print_table
+
+TIMEOUT = 5
+
+
+class Driver(ABC):
+    # One virtual client. `request` performs one timed operation.
+    def __init__(self, host: str, port: int, name: str):
+        self.host = host
+        self.port = port
+        self.name = name
+
+    async def open(self):
+        pass
+
+    @abstractmethod
+    async def request(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class StreamDriver(Driver):
+    async def open(self):
+        self.r, self.w = await asyncio.open_connection(self.host, self.port)
+
+    async def close(self):
+        self.w.close()
+
+
+class EchoDriver(Driver):
+    # One connection per request, sending the payload and reading the echo to EOF
+    payload = os.urandom(1024)
+
+    async def request(self):
+        r, w = await asyncio.open_connection(self.host, self.port)
+        w.write(self.payload)
+        w.write_eof()
+        data = await r.read()
+        w.close()
+        if data != self.payload:
+            raise ValueError()
+
+
+class PrimeDriver(StreamDriver):
+    async def request(self):
+        n = random.randrange(1 << 40)
+        self.w.write(json.dumps({"method": "isPrime", "number": n}).encode() + b"\n")
+        if b"prime" not in await self.r.readline():
+            raise ValueError()
+
+
+class MeansDriver(StreamDriver):
+    frame = struct.Struct("!cii")
+
+    async def open(self):
+        await super().open()
+        self.t = itertools.count()
+
+    async def request(self):
+        t = next(self.t)
+        self.w.write(self.frame.pack(b"I", t, random.randrange(100)) + self.frame.pack(b"Q", 0, t))
+        await self.r.readexactly(4)
+
+
+class ChatDriver(Driver):
+    # Each virtual client is a sender and a receiver in the same room; a
+    # request is one message making it from the first to the second.
+    async def join(self, name: str):
+        r, w = await asyncio.open_connection(self.host, self.port)
+        await r.readline()
+        w.write(f"{name}\n".encode())
+        if not (await r.readline()).startswith(b"*"):
+            raise ValueError()
+        return r, w
+
+    async def open(self):
+        # Reconnects after an error join under new names, as the server may
+        # not have seen the old connections go yet
+        self.opens = getattr(self, "opens", 0) + 1
+        self.sender = f"s{self.name}x{self.opens}"
+        self.sr, self.sw = await self.join(self.sender)
+        self.rr, self.rw = await self.join(f"r{self.name}x{self.opens}")
+        self.waiting = None
+        self.tasks = [asyncio.create_task(self.discard()), asyncio.create_task(self.receive())]
+
+    async def discard(self):
+        while await self.sr.readline():
+            pass
+
+    async def receive(self):
+        prefix = f"[{self.sender}] ".encode()
+        while line := await self.rr.readline():
+            if line.startswith(prefix) and self.waiting is not None and not self.waiting.done():
+                self.waiting.set_result(None)
+
+    async def request(self):
+        self.waiting = asyncio.get_running_loop().create_future()
+        self.sw.write(b"load test message\n")
+        await self.waiting
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        self.sw.close()
+        self.rw.close()
+
+
+class KVDriver(Driver):
+    class Protocol(asyncio.DatagramProtocol):
+        def __init__(self):
+            self.waiting = None
+
+        def datagram_received(self, data, addr):
+            if self.waiting is not None and not self.waiting.done():
+                self.waiting.set_result(data)
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        self.transport, self.protocol = await loop.create_datagram_endpoint(
+            self.Protocol, remote_addr=(self.host, self.port))
+        self.n = itertools.count()
+
+    async def request(self):
+        key = f"k{self.name}".encode()
+        value = str(next(self.n)).encode()
+        self.protocol.waiting = asyncio.get_running_loop().create_future()
+        self.transport.sendto(key + b"=" + value)
+        self.transport.sendto(key)
+        # UDP gives no ordering guarantee, so only wait for the key to come back
+        if not (await self.protocol.waiting).startswith(key + b"="):
+            raise ValueError()
+
+    async def close(self):
+        self.transport.close()
+
+
+class JobsDriver(StreamDriver):
+    async def call(self, o: dict) -> dict:
+        self.w.write(json.dumps(o).encode() + b"\n")
+        reply = json.loads(await self.r.readline())
+        if reply.get("status") == "error":
+            raise ValueError()
+        return reply
+
+    async def request(self):
+        queue = f"q{self.name}"
+        await self.call({"request": "put", "queue": queue, "job": {"n": 1}, "pri": random.randrange(100)})
+        job = await self.call({"request": "get", "queues": [queue]})
+        await self.call({"request": "delete", "id": job["id"]})
+
+
+DRIVERS = {
+    "echo": (EchoDriver, "00-smoke-test.py"),
+    "prime": (PrimeDriver, "01-prime-time.py"),
+    "means": (MeansDriver, "02-means-to-an-end.py"),
+    "chat": (ChatDriver, "03-budget-chat.py"),
+    "kv": (KVDriver, "04-unusual-database-program.py"),
+    "jobs": (JobsDriver, "09-job-centre.py"),
+}
+
+
+def rss_kb(pid: int) -> int | None:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def percentile(sorted_values, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[int(q * (len(sorted_values) - 1))]
+
+
+async def run_step(driver_cls, host: str, port: int, concurrency: int, duration: float,
+                   step: int, pid: int | None, sample_interval: float) -> dict:
+    clients = [driver_cls(host, port, f"{os.getpid()}x{step}x{i}") for i in range(concurrency)]
+    await asyncio.gather(*(c.open() for c in clients))
+    latencies = []
+    errors = 0
+    rss = []
+    start = time.perf_counter()
+    deadline = start + duration
+
+    async def drive(c: Driver):
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            t = time.perf_counter_ns()
+            try:
+                await asyncio.wait_for(c.request(), TIMEOUT)
+                latencies.append(time.perf_counter_ns() - t)
+            except (OSError, ValueError, KeyError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                errors += 1
+                await c.close()
+                await c.open()
+
+    async def sample():
+        while True:
+            if pid is not None:
+                rss.append([round(time.perf_counter() - start, 2), rss_kb(pid)])
+            await asyncio.sleep(sample_interval)
+
+    sampler = asyncio.create_task(sample())
+    await asyncio.gather(*(drive(c) for c in clients))
+    elapsed = time.perf_counter() - start
+    sampler.cancel()
+    await asyncio.gather(*(c.close() for c in clients))
+
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.5) / 1e6,
+        "p99_ms": percentile(latencies, 0.99) / 1e6,
+        "p999_ms": percentile(latencies, 0.999) / 1e6,
+        "rss_kb": rss,
+    }
+
+
+def wait_for_port(host: str, port: int, udp: bool):
+    for _ in range(100):
+        if udp:
+            return time.sleep(1)
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{host}:{port} never came up")
+
+
+def compare(results, baseline_path: str):
+    with open(baseline_path) as f:
+        baseline = {(o["server"], o["concurrency"]): o for o in map(json.loads, f)}
+    rows = []
+    for o in results:
+        old = baseline.get((o["server"], o["concurrency"]))
+        if old is None:
+            continue
+        throughput = o["throughput"] / old["throughput"] if old["throughput"] else 0
+        p99 = o["p99_ms"] / old["p99_ms"] if old["p99_ms"] else 0
+        rows.append([o["server"], o["concurrency"], f"{throughput:.2f}x", f"{p99:.2f}x"])
+    print_table(["server", "concurrency", "throughput vs baseline", "p99 vs baseline"], rows)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("server", choices=DRIVERS)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=40000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--duration", type=float, default=5, help="seconds per step")
+    parser.add_argument("--spawn", action="store_true", help="start the server script for the run")
+    parser.add_argument("--pid", type=int, help="server process to sample RSS from")
+    parser.add_argument("--sample-interval", type=float, default=0.5)
+    parser.add_argument("--json", action="store_true", help="print one JSON object per step")
+    parser.add_argument("--baseline", help="JSON output of an earlier run to compare against")
+    args = parser.parse_args()
+
+    driver_cls, script = DRIVERS[args.server]
+    server = None
+    pid = args.pid
+    if args.spawn:
+        env = dict(os.environ, HOST=args.host, PORT=str(args.port))
+        server = subprocess.Popen([sys.executable, str(ROOT / script)], cwd=ROOT, env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        pid = server.pid
+        wait_for_port(args.host, args.port, args.server == "kv")
+
+    results = []
+    try:
+        for step, concurrency in enumerate(args.concurrency):
+            result = asyncio.run(run_step(driver_cls, args.host, args.port, concurrency,
+                                          args.duration, step, pid, args.sample_interval))
+            result["server"] = args.server
+            results.append(result)
+            if args.json:
+                print(json.dumps(result), flush=True)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.baseline:
+        compare(results, args.baseline)
+    elif not args.json:
+        rows = []
+        for o in results:
+            rss = [kb for _, kb in o["rss_kb"] if kb is not None]
+            rows.append([o["concurrency"], o["requests"], o["errors"], f"{o['throughput']:,.0f}",
+                         f"{o['p50_ms']:.3f}", f"{o['p99_ms']:.3f}", f"{o['p999_ms']:.3f}",
+                         f"{max(rss):,}" if rss else "-"])
+        print_table(["concurrency", "requests", "errors", "req/sec", "p50 ms", "p99 ms", "p999 ms",
+                     "max RSS kB"], rows)
+
+
+if __name__ == "__main__":
+    main()
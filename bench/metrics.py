@@ -0,0 +1,80 @@
+# Cost of recording into the metrics module: nanoseconds per counter
+# increment, histogram record and timed histogram record, against an empty
+# loop. Then how far the histogram's quantiles are from the exact ones, and
+# how long rendering the endpoint takes with --series gauge series.
+#
+#   python bench/metrics.py --ops 1000000 --series 10000
+import argparse
+import random
+import time
+
+from common import print_table
+
+import metrics
+
+
+def per_op(fn, n: int) -> float:
+    t = time.perf_counter_ns()
+    fn(n)
+    return (time.perf_counter_ns() - t) / n
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ops", type=int, default=1_000_000)
+    parser.add_argument("--series", type=int, default=10_000, help="labelled gauge series to render")
+    args = parser.parse_args()
+
+    c = metrics.counter("bench_total", "Benchmark counter")
+    h = metrics.histogram("bench_seconds", "Benchmark histogram")
+    values = [random.randrange(1, 10 ** 7) for _ in range(args.ops)]
+    clock = time.perf_counter_ns
+
+    def empty(n):
+        for v in values:
+            pass
+
+    def inc(n):
+        for v in values:
+            c.value += 1
+
+    def record(n):
+        r = h.record
+        for v in values:
+            r(v)
+
+    def timed(n):
+        r = h.record
+        for v in values:
+            t = clock()
+            r(clock() - t)
+
+    base = per_op(empty, args.ops)
+    rows = [[name, f"{per_op(fn, args.ops) - base:.0f}"]
+            for name, fn in (("counter.value += 1", inc), ("histogram.record", record),
+                             ("clock + record", timed))]
+    print_table(["operation", "ns/op"], rows)
+    print()
+
+    h = metrics.Histogram()
+    for v in values:
+        h.record(v)
+    values.sort()
+    _, estimates = h.quantiles()
+    rows = []
+    for q, estimate in zip(metrics.QUANTILES, estimates):
+        exact = values[int(q * (len(values) - 1))]
+        rows.append([q, f"{exact:,}", f"{estimate * 1e9:,.0f}", f"{abs(estimate * 1e9 - exact) / exact:.2%}"])
+    print_table(["quantile", "exact ns", "histogram ns", "error"], rows)
+    print()
+
+    gauges = {f"q{i}": i for i in range(args.series)}
+    metrics.gauge("bench_queue_pending", "Benchmark gauge", lambda: gauges, label="queue")
+    t = time.perf_counter()
+    body = metrics.render()
+    print_table(["series", "render ms", "bytes"],
+                [[f"{args.series:,}", f"{(time.perf_counter() - t) * 1000:.1f}", f"{len(body):,}"]])
+
+
+if __name__ == "__main__":
+    main()
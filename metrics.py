@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+
+# With METRICS_PORT set, every metric is served in the Prometheus text format
+# at http://METRICS_HOST:METRICS_PORT/metrics (METRICS_PORT + i for worker i).
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+
+# The event loop is asked to wake up every LAG_INTERVAL seconds, and how late
+# it does is recorded as its lag.
+LAG_INTERVAL = float(os.getenv("LAG_INTERVAL", 0.1))
+
+# Histograms keep 2 ** (SUB_BITS - 1) buckets for every power of two, so the
+# quantiles they report are within 1 / 2 ** (SUB_BITS - 1) of the truth.
+SUB_BITS = 5
+BUCKETS = (64 - SUB_BITS + 2) << (SUB_BITS - 1)
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+Labels = Tuple[Tuple[str, str], ...]
+NAN = float("nan")
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n: int = 1):
+        self.value += n
+
+
+class Histogram:
+    # Records integers, nanoseconds for latencies. Values below 2 ** SUB_BITS
+    # have a bucket each; above that the top SUB_BITS bits of a value pick
+    # its bucket, like HdrHistogram's sub-buckets.
+    __slots__ = ("counts", "sum", "scale")
+
+    def __init__(self, scale: float = 1e-9):
+        self.counts = [0] * BUCKETS
+        self.sum = 0
+        # Multiplies recorded values into the unit they are reported in
+        self.scale = scale
+
+    def record(self, v: int):
+        e = v.bit_length() - SUB_BITS
+        if e > 0:
+            self.counts[(e << (SUB_BITS - 1)) + (v >> e)] += 1
+        else:
+            self.counts[v] += 1
+        self.sum += v
+
+    @staticmethod
+    def bounds(i: int) -> Tuple[int, int]:
+        if i < 1 << SUB_BITS:
+            return i, i + 1
+        e = (i >> (SUB_BITS - 1)) - 1
+        m = i - (e << (SUB_BITS - 1))
+        return m << e, (m + 1) << e
+
+    def quantiles(self, qs=QUANTILES) -> Tuple[int, List[float]]:
+        total = sum(self.counts)
+        if not total:
+            return 0, [NAN] * len(qs)
+        values = []
+        seen, i = 0, 0
+        for q in qs:
+            rank = q * total
+            while i < BUCKETS and seen + self.counts[i] < rank:
+                seen += self.counts[i]
+                i += 1
+            low, high = self.bounds(min(i, BUCKETS - 1))
+            values.append((low + high - 1) / 2 * self.scale)
+        return total, values
+
+
+# name -> (type, help, series by labels). A series is a Counter, a Histogram,
+# or for gauges a function that is only called when the metrics are read,
+# along with the label its results are keyed by.
+METRICS: Dict[str, Tuple[str, str, Dict[Labels, object]]] = {}
+
+
+def series(kind: str, name: str, help: str, labels: dict, factory):
+    _, _, by_labels = METRICS.setdefault(name, (kind, help, {}))
+    key = tuple(sorted(labels.items()))
+    if key not in by_labels:
+        by_labels[key] = factory()
+    return by_labels[key]
+
+
+def counter(name: str, help: str, **labels) -> Counter:
+    return series("counter", name, help, labels, Counter)
+
+
+def histogram(name: str, help: str, scale: float = 1e-9, **labels) -> Histogram:
+    return series("summary", name, help, labels, lambda: Histogram(scale))
+
+
+def gauge(name: str, help: str, fn: Callable[[], object], label: Optional[str] = None):
+    # fn returns a number, or with `label` a dict from that label's values to numbers
+    METRICS[name] = ("gauge", help, {(): (fn, label)})
+
+
+def escape(v) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+
+
+def number(v: float) -> str:
+    return "NaN" if v != v else f"{v:.9g}"
+
+
+def render() -> str:
+    lines = []
+    for name, (kind, help, by_labels) in METRICS.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, s in by_labels.items():
+            if kind == "counter":
+                lines.append(f"{name}{format_labels(labels)} {s.value}")
+            elif kind == "summary":
+                total, values = s.quantiles()
+                for q, v in zip(QUANTILES, values):
+                    lines.append(f"{name}{format_labels(labels + (('quantile', q),))} {number(v)}")
+                lines.append(f"{name}_sum{format_labels(labels)} {number(s.sum * s.scale)}")
+                lines.append(f"{name}_count{format_labels(labels)} {total}")
+            else:
+                fn, label = s
+                try:
+                    value = fn()
+                except Exception:
+                    logging.exception(f"Gauge {name} failed")
+                    continue
+                if label:
+                    lines += [f"{name}{format_labels(((label, k),))} {v}" for k, v in value.items()]
+                else:
+                    lines.append(f"{name} {value}")
+    lines.append("")
+    return "\n".join(lines)
+
+
+# Seconds the event loop was late by at its last sample
+loop_lag = 0.0
+
+LAG = histogram("event_loop_lag_seconds", "How late the event loop wakes up")
+gauge("event_loop_lag_last_seconds", "Event loop lag at the last sample", lambda: loop_lag)
+
+
+async def sample_lag(interval: float = LAG_INTERVAL):
+    global loop_lag
+    loop = asyncio.get_running_loop()
+    while True:
+        t = loop.time()
+        await asyncio.sleep(interval)
+        loop_lag = max(0.0, loop.time() - t - interval)
+        LAG.record(int(loop_lag * 1e9))
+
+
+async def handle_scrape(r: asyncio.StreamReader, w: asyncio.StreamWriter):
+    try:
+        request = (await r.readline()).split()
+        while (await r.readline()).strip():
+            pass
+        if len(request) > 1 and request[1] == b"/metrics":
+            status, body = "200 OK", render().encode("utf8")
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        w.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("utf8") + body)
+        await w.drain()
+    except (ConnectionError, ValueError):
+        pass
+    w.close()
+
+
+tasks = set()
+
+
+async def start(offset: int = 0):
+    # Samples the loop lag and serves the endpoint, once per process
+    if tasks:
+        return
+    tasks.add(asyncio.create_task(sample_lag()))
+    if METRICS_PORT:
+        server = await asyncio.start_server(handle_scrape, METRICS_HOST, METRICS_PORT + offset)
+        tasks.add(asyncio.create_task(server.serve_forever()))
+        logging.info(f"Metrics on http://{METRICS_HOST}:{METRICS_PORT + offset}/metrics")
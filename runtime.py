@@ -0,0 +1,370 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import re
+import signal
+import socket
+import sys
+import time
+from collections import Counter
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+import metrics
+
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", 40000))
+
+# LOOP is "asyncio" or "uvloop", falling back to asyncio if uvloop is not
+# installed.
+LOOP = os.getenv("LOOP", "asyncio")
+
+# With WORKERS > 1 that many processes are forked, each listening on the port
+# through SO_REUSEPORT so that the kernel spreads connections between them.
+# With PIN_CPUS set, worker i only runs on the i-th CPU it is allowed.
+WORKERS = int(os.getenv("WORKERS", 1))
+PIN_CPUS = os.getenv("PIN_CPUS", "0") == "1"
+
+# Options for the listening socket, which accepted connections inherit.
+# Buffer sizes of 0 leave the kernel defaults.
+BACKLOG = int(os.getenv("BACKLOG", 1024))
+TCP_NODELAY = os.getenv("TCP_NODELAY", "1") == "1"
+RCVBUF = int(os.getenv("RCVBUF", 0))
+SNDBUF = int(os.getenv("SNDBUF", 0))
+
+# On SIGTERM or SIGINT a server stops accepting, then gives its connections
+# up to DRAIN_TIMEOUT seconds to finish before closing them.
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", 10))
+
+# Admission limits, each off at 0. A server accepts at most MAX_CONNECTIONS
+# connections, and at most MAX_PER_IP from one address. While the event loop
+# lags by more than SHED_LAG seconds new connections are turned away, so the
+# ones already open are served first.
+MAX_CONNECTIONS = int(os.getenv("MAX_CONNECTIONS", 0))
+MAX_PER_IP = int(os.getenv("MAX_PER_IP", 0))
+SHED_LAG = float(os.getenv("SHED_LAG", 0))
+
+# A connection is closed when nothing has arrived on it for IDLE_TIMEOUT
+# seconds, or when it has not read its replies for SLOW_READ_TIMEOUT seconds
+# after its write buffer went over WRITE_BUFFER bytes, or at once when that
+# buffer goes over MAX_WRITE_BUFFER. Stream readers hold up to READ_BUFFER
+# bytes of a line and stop reading from the socket at twice that.
+IDLE_TIMEOUT = float(os.getenv("IDLE_TIMEOUT", 0))
+SLOW_READ_TIMEOUT = float(os.getenv("SLOW_READ_TIMEOUT", 0))
+WRITE_BUFFER = int(os.getenv("WRITE_BUFFER", 1 << 16))
+MAX_WRITE_BUFFER = int(os.getenv("MAX_WRITE_BUFFER", 0))
+READ_BUFFER = int(os.getenv("READ_BUFFER", 1 << 16))
+SWEEP_INTERVAL = 1
+
+# Index of this worker, or None when the server runs in a single process
+worker: Optional[int] = None
+
+
+def use_loop():
+    if LOOP == "uvloop":
+        if uvloop is None:
+            # Not logging.warning, which would configure the root logger before
+            # the server does
+            logging.getLogger(__name__).warning("uvloop is not installed, using asyncio")
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+def listen(host: str = HOST, port: int = PORT, reuse_port: bool = False,
+           type: int = socket.SOCK_STREAM) -> socket.socket:
+    family, _, _, _, address = socket.getaddrinfo(host, port, type=type, flags=socket.AI_PASSIVE)[0]
+    sock = socket.socket(family, type)
+    if type == socket.SOCK_STREAM:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if RCVBUF:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF)
+    if SNDBUF:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SNDBUF)
+    sock.bind(address)
+    if type == socket.SOCK_STREAM:
+        sock.listen(BACKLOG)
+    sock.setblocking(False)
+    return sock
+
+
+# orjson reads integers wider than 64 bits as floats and will not write them,
+# json keeps them exact. Lines with 19 digits in a row may hold one, so they go
+# to json.
+WIDE_NUMBER = re.compile(rb"[0-9]{19}")
+
+
+def loads(b: bytes):
+    if orjson is not None and not WIDE_NUMBER.search(b):
+        try:
+            return orjson.loads(b)
+        except orjson.JSONDecodeError:
+            # json also takes NaN and Infinity
+            pass
+    return json.loads(b)
+
+
+def dumps(o) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(o)
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(o).encode("utf8")
+
+
+ACCEPTED = metrics.counter("connections_accepted_total", "Connections accepted")
+REJECTED = {reason: metrics.counter("connections_rejected_total", "Connections turned away on accept",
+                                    reason=reason)
+            for reason in ("max_connections", "max_per_ip", "overload")}
+CLOSED = {reason: metrics.counter("connections_closed_total", "Connections closed by the server's limits",
+                                  reason=reason)
+          for reason in ("idle", "slow_read", "write_buffer")}
+
+
+class Connection:
+    __slots__ = ("ip", "last_read", "paused")
+
+    def __init__(self, ip: Optional[str]):
+        self.ip = ip
+        # time.monotonic() of the last data received, and of the write buffer
+        # going over WRITE_BUFFER or None
+        self.last_read = time.monotonic()
+        self.paused: Optional[float] = None
+
+
+class Connections:
+    # The open connections of a server, by transport, and the tasks of its
+    # stream handlers. The protocols are wrapped in place, so without
+    # IDLE_TIMEOUT the data path is untouched.
+    def __init__(self):
+        self.open: Dict[asyncio.BaseTransport, Connection] = {}
+        self.per_ip: Counter = Counter()
+        self.handlers: Set[asyncio.Task] = set()
+        self.empty = asyncio.Event()
+        self.empty.set()
+        self.sweeper: Optional[asyncio.Task] = None
+        if IDLE_TIMEOUT or SLOW_READ_TIMEOUT or MAX_WRITE_BUFFER:
+            self.sweeper = asyncio.create_task(self.sweep())
+
+    def refuse(self, ip: Optional[str]) -> Optional[str]:
+        if MAX_CONNECTIONS and len(self.open) >= MAX_CONNECTIONS:
+            return "max_connections"
+        if MAX_PER_IP and self.per_ip[ip] >= MAX_PER_IP:
+            return "max_per_ip"
+        if SHED_LAG and metrics.loop_lag > SHED_LAG:
+            return "overload"
+        return None
+
+    def track(self, protocol: asyncio.BaseProtocol) -> asyncio.BaseProtocol:
+        connection_made, connection_lost = protocol.connection_made, protocol.connection_lost
+        pause_writing, resume_writing = protocol.pause_writing, protocol.resume_writing
+        transports = []
+        conn = None
+
+        def made(transport):
+            nonlocal conn
+            peer = transport.get_extra_info("peername")
+            ip = peer[0] if isinstance(peer, tuple) else None
+            reason = self.refuse(ip)
+            if reason:
+                REJECTED[reason].value += 1
+                transport.abort()
+                return
+            if not TCP_NODELAY:
+                # asyncio turns it on for every TCP connection
+                transport.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 0)
+            transport.set_write_buffer_limits(WRITE_BUFFER)
+            transports.append(transport)
+            ACCEPTED.value += 1
+            conn = Connection(ip)
+            self.open[transport] = conn
+            self.per_ip[ip] += 1
+            self.empty.clear()
+            connection_made(transport)
+
+        def lost(exc):
+            if conn is None:
+                # Refused, the protocol never saw the connection
+                return
+            for transport in transports:
+                self.open.pop(transport, None)
+            self.per_ip[conn.ip] -= 1
+            if not self.per_ip[conn.ip]:
+                del self.per_ip[conn.ip]
+            if not self.open:
+                self.empty.set()
+            connection_lost(exc)
+
+        def paused():
+            conn.paused = time.monotonic()
+            pause_writing()
+
+        def resumed():
+            conn.paused = None
+            resume_writing()
+
+        protocol.connection_made, protocol.connection_lost = made, lost
+        protocol.pause_writing, protocol.resume_writing = paused, resumed
+        if IDLE_TIMEOUT:
+            # Wrapped here rather than in made(), as uvloop looks the method up
+            # when it creates the transport
+            if isinstance(protocol, asyncio.BufferedProtocol):
+                buffer_updated = protocol.buffer_updated
+
+                def updated(n):
+                    conn.last_read = time.monotonic()
+                    buffer_updated(n)
+
+                protocol.buffer_updated = updated
+            else:
+                data_received = protocol.data_received
+
+                def received(data):
+                    conn.last_read = time.monotonic()
+                    data_received(data)
+
+                protocol.data_received = received
+        return protocol
+
+    async def sweep(self):
+        # Closes the connections past their timeouts or write buffer cap
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            now = time.monotonic()
+            for transport, conn in list(self.open.items()):
+                if IDLE_TIMEOUT and now - conn.last_read > IDLE_TIMEOUT:
+                    reason = "idle"
+                elif SLOW_READ_TIMEOUT and conn.paused is not None and now - conn.paused > SLOW_READ_TIMEOUT:
+                    reason = "slow_read"
+                elif MAX_WRITE_BUFFER and transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+                    reason = "write_buffer"
+                else:
+                    continue
+                CLOSED[reason].value += 1
+                transport.abort()
+
+    async def drain(self, timeout: float = DRAIN_TIMEOUT):
+        try:
+            await asyncio.wait_for(self.empty.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.info(f"Closing {len(self.open)} connections still open")
+            for transport in list(self.open):
+                transport.abort()
+            # Stream handlers see their connection go and return, rather than
+            # being cancelled when the loop stops
+            if self.handlers:
+                await asyncio.wait(self.handlers, timeout=timeout)
+        if self.sweeper:
+            self.sweeper.cancel()
+
+
+SERVERS: List[Connections] = []
+metrics.gauge("connections_open", "Connections currently open", lambda: sum(len(c.open) for c in SERVERS))
+
+
+async def create_server(protocol_factory: Callable[[], asyncio.BaseProtocol], host: str = HOST,
+                        port: int = PORT, reuse_port: bool = False) -> asyncio.Server:
+    connections = Connections()
+    server = await asyncio.get_running_loop().create_server(
+        lambda: connections.track(protocol_factory()),
+        sock=listen(host, port, reuse_port or worker is not None))
+    server.connections = connections
+    SERVERS.append(connections)
+    return server
+
+
+async def start_server(handler, host: str = HOST, port: int = PORT, reuse_port: bool = False,
+                       limit: int = READ_BUFFER) -> asyncio.Server:
+    # asyncio.start_server on top of create_server, so stream handlers get the
+    # same socket options and draining
+    loop = asyncio.get_running_loop()
+    connections = None
+
+    async def tracked(r: asyncio.StreamReader, w: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        connections.handlers.add(task)
+        try:
+            await handler(r, w)
+        except ConnectionError:
+            # Reset by the client or aborted by drain(), nothing to report
+            pass
+        finally:
+            connections.handlers.discard(task)
+
+    def factory():
+        return asyncio.StreamReaderProtocol(asyncio.StreamReader(limit=limit, loop=loop), tracked, loop=loop)
+
+    server = await create_server(factory, host, port, reuse_port)
+    connections = server.connections
+    return server
+
+
+async def wait_for_signal():
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.remove_signal_handler(sig)
+
+
+async def serve(server: asyncio.Server):
+    await metrics.start(worker or 0)
+    async with server:
+        await server.start_serving()
+        await wait_for_signal()
+        server.close()
+        await server.connections.drain()
+
+
+def pin(index: int):
+    cpus = sorted(os.sched_getaffinity(0))
+    os.sched_setaffinity(0, {cpus[index % len(cpus)]})
+
+
+def run_worker(main: Callable[[], Awaitable], index: int):
+    global worker
+    worker = index
+    if PIN_CPUS:
+        pin(index)
+    asyncio.run(main())
+
+
+def run(main: Callable[[], Awaitable], workers: int = WORKERS):
+    # Servers that keep state across connections pass workers=1
+    use_loop()
+    if workers <= 1:
+        if PIN_CPUS:
+            pin(0)
+        asyncio.run(main())
+        return
+
+    ctx = multiprocessing.get_context("fork")
+    processes = [ctx.Process(target=run_worker, args=(main, i)) for i in range(workers)]
+    for p in processes:
+        p.start()
+    # Termination reaches the workers through terminate() below, so they drain
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit())
+    signal.signal(signal.SIGINT, lambda *_: sys.exit())
+    try:
+        for p in processes:
+            p.join()
+    finally:
+        for p in processes:
+            p.terminate()
+        for p in processes:
+            p.join()
@@ -0,0 +1,19 @@
+# Loads the server scripts for the tests, as bench/common.py does for the
+# benchmarks: they are not importable by name because of the dashes.
+import importlib.util
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+def load_server(script: str):
+    name = script.removesuffix(".py").replace("-", "_")
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, ROOT / script)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
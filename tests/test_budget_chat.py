@@ -0,0 +1,192 @@
+import asyncio
+import json
+
+import pytest
+
+from servers import load_server
+
+chat = load_server("03-budget-chat.py")
+
+
+class Writer:
+    def __init__(self):
+        self.data = b""
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    def writelines(self, lines):
+        self.data += b"".join(lines)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def test_room_delivers_everyone_elses_frames_in_order():
+    async def run():
+        room = chat.Room("test")
+        alice, bob = room.add("alice", Writer()), room.add("bob", Writer())
+        tasks = [asyncio.create_task(room.deliver(m)) for m in (alice, bob)]
+        room.publish("alice", b"a1\n")
+        room.publish("bob", b"b1\n")
+        room.publish("alice", b"a2\n")
+        await asyncio.sleep(0)
+        for t in tasks:
+            t.cancel()
+        return alice.w.data, bob.w.data
+
+    assert asyncio.run(run()) == (b"b1\n", b"a1\na2\n")
+
+
+def test_room_skips_frames_a_slow_member_missed(monkeypatch):
+    monkeypatch.setattr(chat, "SLOW_CONSUMER", "drop-oldest")
+
+    async def run():
+        room = chat.Room("test", size=4)
+        member = room.add("slow", Writer())
+        dropped = chat.DROPPED.value
+        for i in range(10):
+            room.publish("other", b"%d\n" % i)
+        task = asyncio.create_task(room.deliver(member))
+        await asyncio.sleep(0)
+        task.cancel()
+        return member.w.data, chat.DROPPED.value - dropped
+
+    assert asyncio.run(run()) == (b"6\n7\n8\n9\n", 6)
+
+
+def test_room_disconnects_a_slow_member(monkeypatch):
+    monkeypatch.setattr(chat, "SLOW_CONSUMER", "disconnect")
+
+    async def run():
+        room = chat.Room("test", size=4)
+        member = room.add("slow", Writer())
+        for i in range(5):
+            room.publish("other", b"%d\n" % i)
+        await asyncio.wait_for(room.deliver(member), 1)
+        return member.w
+
+    w = asyncio.run(run())
+    assert w.closed and w.data == b""
+
+
+def test_registry_drops_empty_rooms():
+    rooms = chat.RoomRegistry(shards=4)
+    room = rooms.get("a")
+    room.members["x"] = None
+    rooms.discard("a")
+    assert rooms.find("a") is room
+    room.members.clear()
+    rooms.discard("a")
+    assert rooms.find("a") is None and list(rooms) == []
+
+
+@pytest.mark.parametrize("line, parsed", [
+    ("bob", ("lobby", "bob")),
+    ("bob@den", ("den", "bob")),
+])
+def test_parse_name(monkeypatch, line, parsed):
+    monkeypatch.setattr(chat, "JOIN_ROOMS", True)
+    assert chat.parse_name(line) == parsed
+
+
+@pytest.mark.parametrize("line", ["", "b o", "bob@", "@den", "bob@d-n"])
+def test_parse_name_rejects(monkeypatch, line):
+    monkeypatch.setattr(chat, "JOIN_ROOMS", True)
+    with pytest.raises(ValueError):
+        chat.parse_name(line)
+
+
+def test_local_chat_session():
+    async def join(port, name):
+        r, w = await asyncio.open_connection("127.0.0.1", port)
+        await r.readline()
+        w.write(f"{name}\n".encode())
+        return r, w, (await r.readline()).decode()
+
+    async def run():
+        server = await asyncio.start_server(chat.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        ra, wa, a_sees = await join(port, "alice")
+        rb, wb, b_sees = await join(port, "bob")
+        lines = [await ra.readline()]
+        wb.write(b"hi\n")
+        lines.append(await ra.readline())
+        wb.close()
+        lines.append(await ra.readline())
+        wa.close()
+        server.close()
+        await server.wait_closed()
+        return a_sees, b_sees, lines
+
+    a_sees, b_sees, lines = asyncio.run(asyncio.wait_for(run(), 5))
+    assert a_sees == "* The room contains: \n"
+    assert b_sees == "* The room contains: alice\n"
+    assert lines == [b"* bob has entered the room\n", b"[bob] hi\n", b"* bob has left the room\n"]
+
+
+def test_hub_orders_rooms_across_workers(tmp_path):
+    path = str(tmp_path / "hub.sock")
+
+    async def send(w, **o):
+        w.write(json.dumps(o).encode() + b"\n")
+
+    async def read(r):
+        return json.loads(await r.readline())
+
+    async def run():
+        hub = chat.Hub()
+        server = await asyncio.start_unix_server(hub.handle, path)
+        (r1, w1), (r2, w2) = [await asyncio.open_unix_connection(path) for _ in range(2)]
+        seen = []
+        await send(w1, op="join", id=0, room="lobby", name="alice")
+        seen += [await read(r1), await read(r1), await read(r2)]
+        # The name is taken in the room, whichever worker asks
+        await send(w2, op="join", id=0, room="lobby", name="alice")
+        seen.append(await read(r2))
+        # Only a member's own worker may speak for it
+        await send(w2, op="say", room="lobby", name="alice", content="spoof")
+        await send(w1, op="say", room="lobby", name="alice", content="hi")
+        seen += [await read(r1), await read(r2)]
+        # A worker going away takes its members with it
+        w1.close()
+        seen.append(await read(r2))
+        assert hub.rooms == {}
+        server.close()
+        await asyncio.wait_for(hub.close(), 1)
+        assert await r2.readline() == b""
+        return seen
+
+    seen = asyncio.run(asyncio.wait_for(run(), 5))
+    assert seen == [
+        {"op": "joined", "id": 0, "ok": True, "members": []},
+        {"op": "enter", "room": "lobby", "name": "alice"},
+        {"op": "enter", "room": "lobby", "name": "alice"},
+        {"op": "joined", "id": 0, "ok": False, "members": ["alice"]},
+        {"op": "say", "room": "lobby", "name": "alice", "content": "hi"},
+        {"op": "say", "room": "lobby", "name": "alice", "content": "hi"},
+        {"op": "leave", "room": "lobby", "name": "alice"},
+    ]
+
+
+def test_hub_close_waits_for_its_handlers(tmp_path):
+    path = str(tmp_path / "hub.sock")
+
+    async def run():
+        hub = chat.Hub()
+        server = await asyncio.start_unix_server(hub.handle, path)
+        conns = [await asyncio.open_unix_connection(path) for _ in range(3)]
+        for _, w in conns:
+            w.write(b'{"op": "join", "id": 0, "room": "lobby", "name": "x%d"}\n' % id(w))
+        for r, _ in conns:
+            await r.readline()
+        server.close()
+        await asyncio.wait_for(hub.close(), 1)
+        return hub, asyncio.all_tasks()
+
+    hub, tasks = asyncio.run(run())
+    assert not hub.handlers and not hub.workers and len(tasks) == 1
@@ -0,0 +1,237 @@
+import asyncio
+import json
+import random
+
+import pytest
+
+from servers import load_server
+
+jc = load_server("09-job-centre.py")
+
+
+def start(path: str, **kwargs):
+    context = jc.Context()
+    context.log = jc.JobLog(path, **kwargs)
+    context.log.load(context)
+    context.log.start(context)
+    return context
+
+
+async def stop(context):
+    context.log.task.cancel()
+    await asyncio.gather(context.log.task, return_exceptions=True)
+    context.log.file.close()
+
+
+def queued(context) -> dict:
+    return {jid: (job.queue, job.pri, job.task) for jid, job in context.jobs.items()}
+
+
+@pytest.mark.parametrize("snapshot_every", [3, 1 << 20])
+def test_wal_recovery(tmp_path, snapshot_every):
+    path = str(tmp_path / "jobs")
+
+    async def first():
+        context = start(path, batch=4, snapshot_every=snapshot_every)
+        rng = random.Random(snapshot_every)
+        jids = [await context.put(f"q{i % 3}", {"n": i}, rng.randrange(100)) for i in range(40)]
+        for jid in jids[::4]:
+            await context.delete(jid)
+        client = await context.get_client_id()
+        held = await context.get(client, ["q0", "q1"], False)
+        aborted = await context.get(client, ["q2"], False)
+        await context.abort(aborted.jid, client)
+        expected = queued(context)
+        await stop(context)
+        return expected, held, context.jid
+
+    async def second():
+        context = start(path)
+        recovered = queued(context)
+        jid = await context.put("q0", {}, 1)
+        await stop(context)
+        return recovered, jid
+
+    expected, held, last_jid = asyncio.run(first())
+    recovered, jid = asyncio.run(second())
+    # The job still held when the server went away is back on its queue
+    assert held.jid in recovered
+    assert recovered == expected
+    assert jid == last_jid + 1
+
+
+def test_wal_drops_a_torn_record(tmp_path):
+    path = str(tmp_path / "jobs")
+
+    async def first():
+        context = start(path)
+        await context.put("q", {"n": 1}, 5)
+        await context.put("q", {"n": 2}, 6)
+        expected = queued(context)
+        await stop(context)
+        return expected
+
+    async def second():
+        context = start(path)
+        recovered = queued(context)
+        await stop(context)
+        return recovered
+
+    expected = asyncio.run(first())
+    with open(path + ".log", "ab") as f:
+        f.write(b'["put", 99, "q", -1, {"n"')
+    assert asyncio.run(second()) == expected
+    # Recovery rewrote the snapshot, so the torn record is gone for good
+    assert asyncio.run(second()) == expected
+
+
+def test_get_prefers_the_highest_priority_across_queues():
+    async def run():
+        context = jc.Context()
+        client = await context.get_client_id()
+        for i, (queue, pri) in enumerate([("a", 1), ("b", 5), ("c", 3), ("b", 2)] + [(f"x{i}", 0) for i in range(20)]):
+            await context.put(queue, {"i": i}, pri)
+        queues = ["a", "b", "c"] + [f"x{i}" for i in range(20)]
+        order = []
+        while (job := await context.get(client, queues, False)) is not None:
+            order.append(-job.pri)
+        return order
+
+    order = asyncio.run(run())
+    assert order[:4] == [5, 3, 2, 1] and len(order) == 24
+
+
+@pytest.mark.parametrize("request_", [
+    {"request": "put", "queue": ["x"], "job": {}, "pri": 1},
+    {"request": "put", "queue": "x", "job": {}, "pri": "1"},
+    {"request": "put", "queue": "x", "job": {}, "pri": 1.5},
+    {"request": "put", "queue": "x", "job": [], "pri": 1},
+    {"request": "get", "queues": "x"},
+    {"request": "get", "queues": [["x"]]},
+])
+def test_malformed_requests_leave_no_trace(tmp_path, monkeypatch, request_):
+    path = str(tmp_path / "jobs")
+
+    async def first():
+        context = start(path)
+        monkeypatch.setattr(jc, "context", context)
+        await context.put("x", {"n": 1}, 1)
+        with pytest.raises((ValueError, TypeError, KeyError)):
+            jc.respond(await context.get_client_id(), request_)
+        await context.durable()
+        expected = queued(context)
+        await stop(context)
+        return expected
+
+    async def second():
+        context = start(path)
+        recovered = queued(context)
+        await stop(context)
+        return recovered
+
+    expected = asyncio.run(first())
+    assert list(expected.values()) == [("x", -1, {"n": 1})]
+    assert asyncio.run(second()) == expected
+
+
+async def session(lines: bytes, replies: int) -> list:
+    # Sends every request in one write and reads back that many replies
+    server = await asyncio.start_server(jc.handle, "127.0.0.1", 0)
+    r, w = await asyncio.open_connection(*server.sockets[0].getsockname())
+    w.write(lines)
+    got = [json.loads(await r.readline()) for _ in range(replies)]
+    w.close()
+    server.close()
+    await server.wait_closed()
+    return got
+
+
+def test_pipelined_requests_are_answered_in_order(monkeypatch):
+    monkeypatch.setattr(jc, "context", jc.Context())
+    lines = b"\n".join([
+        b'{"request": "put", "queue": "q", "job": {"n": 1}, "pri": 3}',
+        b'not json',
+        b'{"request": "put", "queue": "q", "job": {"n": 2}, "pri": 9}',
+        b'{"request": "nope"}',
+        b'{"request": "get", "queues": ["q"]}',
+        b'{"request": "delete", "id": 3}',
+        b'{"request": "delete", "id": 3}',
+        b'{"request": "get", "queues": ["q"]}',
+        b'{"request": "get", "queues": ["empty"]}',
+        b'{"request": "abort", "id": 2}',
+    ]) + b"\n"
+    invalid = {"status": "error", "error": "invalid-json"}
+    assert asyncio.run(asyncio.wait_for(session(lines, 10), 5)) == [
+        {"status": "ok", "id": 2},
+        invalid,
+        {"status": "ok", "id": 3},
+        invalid,
+        {"status": "ok", "id": 3, "job": {"n": 2}, "pri": 9, "queue": "q"},
+        {"status": "ok"},
+        {"status": "no-job"},
+        {"status": "ok", "id": 2, "job": {"n": 1}, "pri": 3, "queue": "q"},
+        {"status": "no-job"},
+        {"status": "ok"},
+    ]
+
+
+def test_an_over_long_line_is_answered_once(monkeypatch):
+    monkeypatch.setattr(jc, "context", jc.Context())
+    lines = b"x" * (jc.LINE_LIMIT + 3 * jc.CHUNK_SIZE) + b"\n" + b'{"request": "put", "queue": "q", "job": {}, "pri": 1}\n'
+    assert asyncio.run(asyncio.wait_for(session(lines, 2), 5)) == [
+        {"status": "error", "error": "invalid-json"},
+        {"status": "ok", "id": 2},
+    ]
+
+
+def test_a_new_job_goes_to_the_longest_waiting_get():
+    async def run():
+        context = jc.Context()
+        clients = [await context.get_client_id() for _ in range(3)]
+        gets = [asyncio.create_task(context.get(c, queues, True))
+                for c, queues in zip(clients, (["a", "b"], ["b"], ["a"]))]
+        await asyncio.sleep(0)
+        first = await context.put("b", {"n": 1}, 1)
+        second = await context.put("a", {"n": 2}, 1)
+        third = await context.put("b", {"n": 3}, 1)
+        jobs = await asyncio.gather(*gets)
+        return context, clients, [job.jid for job in jobs], [job.owner for job in jobs], (first, third, second)
+
+    context, clients, got, owners, expected = asyncio.run(asyncio.wait_for(run(), 5))
+    # The first get took the job on b, so the job on a skips its dead entry
+    assert got == list(expected) and owners == clients
+    assert context.waiters == {} and not any(context.queues.values())
+
+
+def test_a_cancelled_get_is_skipped():
+    async def run():
+        context = jc.Context()
+        client = await context.get_client_id()
+        get = asyncio.create_task(context.get(client, ["q"], True))
+        await asyncio.sleep(0)
+        get.cancel()
+        await asyncio.gather(get, return_exceptions=True)
+        jid = await context.put("q", {}, 1)
+        return context, jid
+
+    context, jid = asyncio.run(asyncio.wait_for(run(), 5))
+    assert context.queues["q"] == [(-1, jid)] and context.waiters == {}
+
+
+def test_a_get_cancelled_after_the_hand_off_passes_the_job_on():
+    async def run():
+        context = jc.Context()
+        first, second = await context.get_client_id(), await context.get_client_id()
+        gets = [asyncio.create_task(context.get(c, ["q"], True)) for c in (first, second)]
+        await asyncio.sleep(0)
+        jid = context.put_nowait("q", {}, 1)
+        # The job is handed to the first get, which is cancelled before it
+        # gets to run
+        gets[0].cancel()
+        cancelled, job = await asyncio.gather(*gets, return_exceptions=True)
+        return context, first, second, jid, cancelled, job
+
+    context, first, second, jid, cancelled, job = asyncio.run(asyncio.wait_for(run(), 5))
+    assert isinstance(cancelled, asyncio.CancelledError)
+    assert job.jid == jid and job.owner == second
+    assert not context.working[first] and list(context.working[second]) == [jid]
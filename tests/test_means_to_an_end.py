@@ -0,0 +1,66 @@
+import random
+from array import array
+
+import pytest
+
+from servers import load_server
+
+means = load_server("02-means-to-an-end.py")
+
+
+def model_mean(prices: dict, lo: int, hi: int) -> int:
+    values = [p for t, p in prices.items() if lo <= t <= hi]
+    if not values:
+        return 0
+    total = sum(values)
+    m = abs(total) // len(values)
+    return m if total >= 0 else -m
+
+
+def test_fenwick():
+    rng = random.Random(0)
+    values = [rng.randrange(-100, 100) for _ in range(50)]
+    tree = means.Fenwick(values[:30])
+    for v in values[30:]:
+        tree.append(v)
+    for _ in range(200):
+        i = rng.randrange(len(values))
+        delta = rng.randrange(-100, 100)
+        tree.add(i, delta)
+        values[i] += delta
+        j = rng.randrange(len(values) + 1)
+        assert tree.prefix(j) == sum(values[:j])
+
+
+@pytest.mark.parametrize("cls", [means.PriceHistory, means.LazyPriceHistory])
+@pytest.mark.parametrize("span", [50, 5000])
+def test_history_against_model(monkeypatch, cls, span):
+    # Tiny blocks, so that blocks split and queries span many of them
+    monkeypatch.setattr(means, "BLOCK_SIZE", 4)
+    rng = random.Random(span)
+    history = cls()
+    prices = {}
+    clock = 0
+    for _ in range(3000):
+        if rng.random() < 0.7:
+            # Mostly increasing timestamps, some late, some repeated
+            clock += rng.randrange(0, 10)
+            t = clock - rng.randrange(span) if rng.random() < 0.2 else clock
+            p = rng.randrange(-1000, 1000)
+            history.insert_value(t, p)
+            prices[t] = p
+        else:
+            lo = rng.randrange(-10, clock + 10)
+            hi = lo + rng.randrange(-5, span)
+            assert history.mean_value_between(lo, hi) == model_mean(prices, lo, hi)
+
+
+def test_lazy_history_rebuilds_on_a_large_out_of_order_tail():
+    history = means.LazyPriceHistory()
+    history.extend_sorted(array('i', range(0, 100, 10)), array('i', range(10)))
+    for t in range(95, -5, -1):
+        history.insert_value(t, t)
+    prices = {t: p for t, p in zip(range(0, 100, 10), range(10))}
+    prices.update({t: t for t in range(-4, 96)})
+    assert history.mean_value_between(-10, 200) == model_mean(prices, -10, 200)
+    assert len(history) == len(prices)
@@ -0,0 +1,61 @@
+import random
+
+import pytest
+
+from servers import load_server
+
+metrics = load_server("metrics.py")
+
+
+def test_buckets_cover_every_value_once():
+    # Each bucket starts where the one before it ends
+    end = 0
+    for i in range(metrics.BUCKETS):
+        low, high = metrics.Histogram.bounds(i)
+        assert low == end and high > low
+        end = high
+    assert end == 1 << 64
+
+
+@pytest.mark.parametrize("v", [0, 1, 31, 32, 33, 63, 64, 1000, 123456789, (1 << 63) + 5, (1 << 64) - 1])
+def test_record_lands_in_its_bucket(v):
+    h = metrics.Histogram()
+    h.record(v)
+    [i] = [i for i, n in enumerate(h.counts) if n]
+    low, high = metrics.Histogram.bounds(i)
+    assert low <= v < high
+    # Within the promised relative error
+    assert high - low <= max(1, low >> (metrics.SUB_BITS - 1))
+
+
+def test_quantiles_against_sorted_values():
+    rng = random.Random(1)
+    values = [int(rng.lognormvariate(13, 2)) for _ in range(10000)]
+    h = metrics.Histogram(scale=1)
+    for v in values:
+        h.record(v)
+    total, got = h.quantiles()
+    assert total == len(values) and h.sum == sum(values)
+    values.sort()
+    for q, v in zip(metrics.QUANTILES, got):
+        exact = values[int(q * len(values)) - 1]
+        assert abs(v - exact) <= exact / (1 << (metrics.SUB_BITS - 1))
+
+
+def test_quantiles_of_nothing():
+    total, values = metrics.Histogram().quantiles()
+    assert total == 0 and all(v != v for v in values)
+
+
+def test_render():
+    c = metrics.counter("test_events_total", "Events", kind="a")
+    c.inc(3)
+    h = metrics.histogram("test_seconds", "Seconds")
+    h.record(2_000_000_000)
+    metrics.gauge("test_sizes", "Sizes", lambda: {'x"y': 2}, label="name")
+    lines = metrics.render().splitlines()
+    assert 'test_events_total{kind="a"} 3' in lines
+    assert "test_seconds_count 1" in lines and "test_seconds_sum 2" in lines
+    [median] = [line for line in lines if line.startswith('test_seconds{quantile="0.5"}')]
+    assert abs(float(median.split()[1]) - 2) <= 2 / (1 << (metrics.SUB_BITS - 1))
+    assert 'test_sizes{name="x\\"y"} 2' in lines
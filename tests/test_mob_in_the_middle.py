@@ -0,0 +1,158 @@
+import asyncio
+
+import pytest
+
+from servers import load_server
+
+mob = load_server("05-mob-in-the-middle.py")
+
+TONY = b"7YWHMfk9JZe0LM0g1ZauHuiSxhI"
+
+
+class Writer:
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+
+def pump(*chunks: bytes) -> bytes:
+    async def run():
+        r = asyncio.StreamReader()
+        for chunk in chunks:
+            r.feed_data(chunk)
+        r.feed_eof()
+        w = Writer()
+        await mob.pump(r, w)
+        return bytes(w.data)
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("line, rewritten", [
+    (b"Hi alice\n", b"Hi alice\n"),
+    (b"Send to 7F1u3wSD5RbOHQmupo9nx4TnhQ please\n", b"Send to " + TONY + b" please\n"),
+    (b"7iKDZEwPZSqIvDnHvVN2r0hUWXD5rHX 7LOrwbDlS8NujgjddyogWgIM93MV5N2VR\n", TONY + b" " + TONY + b"\n"),
+    # Too short, too long, and not a whole word
+    (b"7F1u3wSD5RbOHQmupo9nx4Tnh 7F1u3wSD5RbOHQmupo9nx4TnhQ7F1u3wSD5Rb x7F1u3wSD5RbOHQmupo9nx4TnhQ\n",
+     b"7F1u3wSD5RbOHQmupo9nx4Tnh 7F1u3wSD5RbOHQmupo9nx4TnhQ7F1u3wSD5Rb x7F1u3wSD5RbOHQmupo9nx4TnhQ\n"),
+])
+def test_rewrite(line, rewritten):
+    assert pump(line) == rewritten
+
+
+def test_line_split_across_reads():
+    line = b"pay 7F1u3wSD5RbOHQmupo9nx4TnhQ now\nnext\n"
+    assert pump(*(line[i:i + 3] for i in range(0, len(line), 3))) == b"pay " + TONY + b" now\nnext\n"
+
+
+def test_line_past_the_read_limit_ends_the_session():
+    assert pump(*[b"x" * mob.CHUNK_SIZE] * 4, b"\n") == b""
+
+
+async def upstream():
+    # Greets every connection and echoes its lines back, as the chat server would
+    accepted = []
+
+    async def handle(r, w):
+        accepted.append(w)
+        w.write(b"Welcome\n")
+        while line := await r.readline():
+            w.write(b"echo " + line)
+        w.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    return server, server.sockets[0].getsockname()[1], accepted
+
+
+def events() -> dict:
+    return {event: c.value for event, c in mob.POOL_EVENTS.items()}
+
+
+def counted(before: dict) -> dict:
+    return {event: n - before[event] for event, n in events().items() if n != before[event]}
+
+
+async def until(condition):
+    for _ in range(100):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+
+
+def test_pool_hands_out_warm_connections_and_refills():
+    async def run():
+        before = events()
+        server, port, accepted = await upstream()
+        pool = mob.UpstreamPool("127.0.0.1", port, size=2)
+        pool.start()
+        await until(lambda: len(pool.idle) == 2)
+        (r, w), warm = await pool.acquire()
+        greeting = await r.readline()
+        # The connection taken is replaced
+        await until(lambda: len(accepted) == 3 and len(pool.idle) == 2)
+        idle = len(pool.idle)
+        w.close()
+        pool.close()
+        server.close()
+        return warm, greeting, idle, len(accepted), counted(before)
+
+    assert asyncio.run(run()) == (True, b"Welcome\n", 2, 3, {"warm": 1, "connects": 3})
+
+
+def test_pool_replaces_stale_connections():
+    async def run():
+        before = events()
+        server, port, accepted = await upstream()
+        # Every idle connection is too old by the time it is wanted
+        pool = mob.UpstreamPool("127.0.0.1", port, size=1, max_idle=0)
+        pool.refill()
+        await until(lambda: pool.idle)
+        (_, w), warm = await pool.acquire()
+        w.close()
+        await until(lambda: not pool.opening)
+        pool.idle.popleft()[2].close()
+        server.close()
+        return warm, counted(before)
+
+    assert asyncio.run(run()) == (False, {"discarded": 1, "cold": 1, "connects": 3})
+
+
+def test_pool_reports_an_unreachable_upstream():
+    async def run():
+        before = events()
+        server, port, _ = await upstream()
+        server.close()
+        await server.wait_closed()
+        pool = mob.UpstreamPool("127.0.0.1", port, size=0)
+        with pytest.raises(OSError):
+            await pool.acquire()
+        return pool.addresses, counted(before)
+
+    assert asyncio.run(run()) == ([], {"cold": 1, "failures": 1})
+
+
+def test_session_through_the_pool(monkeypatch):
+    async def run():
+        server, port, _ = await upstream()
+        pool = mob.UpstreamPool("127.0.0.1", port, size=1)
+        monkeypatch.setattr(mob, "pool", pool)
+        pool.refill()
+        await until(lambda: pool.idle)
+        proxy = await asyncio.start_server(mob.handle, "127.0.0.1", 0)
+        r, w = await asyncio.open_connection(*proxy.sockets[0].getsockname())
+        lines = [await r.readline()]
+        w.write(b"send to 7F1u3wSD5RbOHQmupo9nx4TnhQ\n")
+        lines.append(await r.readline())
+        w.close()
+        await until(lambda: not pool.opening)
+        pool.idle.popleft()[2].close()
+        proxy.close()
+        server.close()
+        return lines
+
+    assert asyncio.run(asyncio.wait_for(run(), 5)) == [b"Welcome\n", b"echo send to " + TONY + b"\n"]
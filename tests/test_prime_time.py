@@ -0,0 +1,117 @@
+import asyncio
+import json
+import random
+
+import pytest
+
+from servers import load_server
+
+pt = load_server("01-prime-time.py")
+
+
+def trial_division(n: int) -> bool:
+    return n > 1 and all(n % d for d in range(2, int(n ** 0.5) + 1))
+
+
+@pytest.mark.parametrize("limit", [0, 1, 2, 3, 9, 10, 48, 100, 1000, 10007])
+def test_segmented_sieve(limit):
+    # Small segments, so that multiples cross segment boundaries
+    flags = pt.segmented_sieve(limit, segment=7)
+    assert [2 * i + 1 for i, f in enumerate(flags) if f] == [n for n in range(3, limit + 1, 2) if trial_division(n)]
+
+
+@pytest.mark.parametrize("sieve_limit", [0, 10, 47, 48, 1000])
+def test_is_prime_small(sieve_limit):
+    test = pt.PrimeTest(sieve_limit)
+    assert [n for n in range(-10, 3000) if test.is_prime(n)] == [n for n in range(3000) if trial_division(n)]
+
+
+@pytest.mark.parametrize("n, prime", [
+    (2 ** 61 - 1, True),
+    (2 ** 89 - 1, True),
+    (2 ** 127 - 1, True),
+    # Strong pseudoprimes to base 2 and Carmichael numbers
+    (2047, False),
+    (3215031751, False),
+    (3825123056546413051, False),
+    (41041, False),
+    ((2 ** 61 - 1) * (2 ** 89 - 1), False),
+    # Either side of the deterministic witnesses
+    (2 ** 64 - 59, True),
+    (2 ** 64 + 13, True),
+])
+def test_is_prime_large(n, prime):
+    assert pt.PrimeTest(1000).is_prime(n) == prime
+
+
+@pytest.mark.parametrize("cls", [pt.LRUCache, pt.ARCCache])
+def test_cache_against_model(cls):
+    rng = random.Random(1)
+    capacity = 16
+    cache = cls(capacity)
+    model = {}
+    for _ in range(20000):
+        n = int(rng.paretovariate(1.2)) % 200
+        if rng.random() < 0.5:
+            prime = rng.random() < 0.5
+            cache.put(n, prime)
+            model[n] = prime
+        else:
+            got = cache.get(n)
+            # A cache may forget, but never answers wrongly
+            assert got is None or got == model[n]
+        assert len(dict(cache.items())) <= capacity
+    assert cache.hits and cache.misses and cache.evictions
+
+
+def test_arc_keeps_hot_entries_through_a_scan():
+    cache = pt.ARCCache(8)
+    for n in range(4):
+        cache.put(n, True)
+        cache.get(n)
+    for n in range(100, 200):
+        cache.put(n, False)
+    assert [cache.get(n) for n in range(4)] == [True] * 4
+
+
+def test_cache_dump_and_load(tmp_path):
+    cache = pt.ARCCache(8)
+    for n in range(12):
+        cache.put(n, trial_division(n))
+    path = str(tmp_path / "cache.json")
+    cache.dump(path)
+    loaded = pt.ARCCache(8)
+    loaded.load(path)
+    assert dict(loaded.items()) == dict(cache.items())
+
+
+class ResetWriter:
+    # A client that stopped reading and then reset the connection
+    class transport:
+        @staticmethod
+        def get_write_buffer_size():
+            return 1 << 30
+
+    def write(self, data):
+        pass
+
+    async def drain(self):
+        raise ConnectionResetError()
+
+    def close(self):
+        pass
+
+
+@pytest.mark.parametrize("handler", [pt.handle_stream, pt.handle_lines])
+def test_handler_stops_when_the_writer_fails(handler):
+    async def run():
+        r = asyncio.StreamReader()
+        line = json.dumps({"method": "isPrime", "number": 7}).encode() + b"\n"
+        # More batches than the reply queue holds
+        r.feed_data(line * ((pt.PIPELINE_DEPTH + 2) * pt.CHUNK_SIZE // len(line)))
+        r.feed_eof()
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(handler(r, ResetWriter()), 5)
+        assert len(asyncio.all_tasks()) == 1
+
+    asyncio.run(run())
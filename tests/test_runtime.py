@@ -0,0 +1,143 @@
+import asyncio
+
+import pytest
+
+from servers import load_server
+
+runtime = load_server("runtime.py")
+metrics = load_server("metrics.py")
+
+
+async def echo(r, w):
+    while data := await r.read(1 << 16):
+        w.write(data)
+        await w.drain()
+    w.close()
+
+
+async def flood(r, w):
+    # Writes without waiting for the client to read
+    w.write(b"x" * (1 << 26))
+    await r.read()
+
+
+async def serve(handler):
+    server = await runtime.start_server(handler, "127.0.0.1", 0)
+    await server.start_serving()
+    return server, server.sockets[0].getsockname()[1]
+
+
+async def is_open(conn) -> bool:
+    r, w = conn
+    w.write(b"ping")
+    try:
+        return await asyncio.wait_for(r.read(4), 1) == b"ping"
+    except ConnectionError:
+        return False
+
+
+async def until(condition, timeout: float = 2):
+    for _ in range(int(timeout / 0.02)):
+        if condition():
+            return True
+        await asyncio.sleep(0.02)
+    return False
+
+
+@pytest.mark.parametrize("limit, reason", [("MAX_CONNECTIONS", "max_connections"), ("MAX_PER_IP", "max_per_ip")])
+def test_connections_over_the_limit_are_refused(monkeypatch, limit, reason):
+    monkeypatch.setattr(runtime, limit, 2)
+
+    async def run():
+        rejected = runtime.REJECTED[reason].value
+        server, port = await serve(echo)
+        conns = [await asyncio.open_connection("127.0.0.1", port) for _ in range(3)]
+        states = [await is_open(c) for c in conns]
+        conns[0][1].close()
+        await until(lambda: len(server.connections.open) == 1)
+        again = await asyncio.open_connection("127.0.0.1", port)
+        states.append(await is_open(again))
+        for _, w in conns[1:] + [again]:
+            w.close()
+        server.close()
+        await server.connections.drain(1)
+        return states, runtime.REJECTED[reason].value - rejected
+
+    assert asyncio.run(run()) == ([True, True, False, True], 1)
+
+
+def test_connections_are_shed_while_the_loop_lags(monkeypatch):
+    monkeypatch.setattr(runtime, "SHED_LAG", 0.5)
+
+    async def run():
+        rejected = runtime.REJECTED["overload"].value
+        server, port = await serve(echo)
+        states = []
+        for lag in (1.0, 0.1):
+            monkeypatch.setattr(metrics, "loop_lag", lag)
+            conn = await asyncio.open_connection("127.0.0.1", port)
+            states.append(await is_open(conn))
+            conn[1].close()
+        server.close()
+        await server.connections.drain(1)
+        return states, runtime.REJECTED["overload"].value - rejected
+
+    assert asyncio.run(run()) == ([False, True], 1)
+
+
+def test_idle_connections_are_closed(monkeypatch):
+    monkeypatch.setattr(runtime, "IDLE_TIMEOUT", 0.3)
+    monkeypatch.setattr(runtime, "SWEEP_INTERVAL", 0.05)
+
+    async def run():
+        closed = runtime.CLOSED["idle"].value
+        server, port = await serve(echo)
+        busy = await asyncio.open_connection("127.0.0.1", port)
+        idle = await asyncio.open_connection("127.0.0.1", port)
+        for _ in range(6):
+            assert await is_open(busy)
+            await asyncio.sleep(0.1)
+        states = [await is_open(busy), await is_open(idle)]
+        busy[1].close()
+        server.close()
+        await server.connections.drain(1)
+        return states, runtime.CLOSED["idle"].value - closed
+
+    assert asyncio.run(run()) == ([True, False], 1)
+
+
+@pytest.mark.parametrize("limit, value, reason", [
+    ("SLOW_READ_TIMEOUT", 0.2, "slow_read"),
+    ("MAX_WRITE_BUFFER", 1 << 20, "write_buffer"),
+])
+def test_clients_that_do_not_read_are_closed(monkeypatch, limit, value, reason):
+    monkeypatch.setattr(runtime, limit, value)
+    monkeypatch.setattr(runtime, "SWEEP_INTERVAL", 0.05)
+
+    async def run():
+        closed = runtime.CLOSED[reason].value
+        server, port = await serve(flood)
+        _, w = await asyncio.open_connection("127.0.0.1", port)
+        aborted = await until(lambda: runtime.CLOSED[reason].value > closed)
+        w.close()
+        server.close()
+        await server.connections.drain(1)
+        return aborted, not server.connections.open
+
+    assert asyncio.run(run()) == (True, True)
+
+
+def test_drain_closes_what_is_left_and_waits_for_the_handlers():
+    async def run():
+        server, port = await serve(echo)
+        conns = [await asyncio.open_connection("127.0.0.1", port) for _ in range(3)]
+        await until(lambda: len(server.connections.handlers) == 3)
+        server.close()
+        await server.connections.drain(0.2)
+        states = [await is_open(c) for c in conns]
+        for _, w in conns:
+            w.close()
+        return states, server.connections
+
+    states, connections = asyncio.run(run())
+    assert states == [False] * 3 and not connections.open and not connections.handlers
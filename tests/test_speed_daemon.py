@@ -0,0 +1,129 @@
+import asyncio
+import random
+import struct
+
+import pytest
+
+from servers import load_server
+
+sd = load_server("06-speed-daemon.py")
+
+
+def decode_ticket(b: bytes) -> tuple:
+    n = b[1]
+    return (b[2:2 + n].decode(),) + struct.unpack("!HHIHIH", b[2 + n:])
+
+
+def state_with_road(limit: int = 60):
+    tickets = []
+    state = sd.State()
+    state.add_camera("a", 1, 0, limit)
+    state.add_camera("b", 1, 10, limit)
+    state.add_dispatcher("d", [1], lambda ticket: tickets.append(decode_ticket(ticket.to_bytes())))
+    return state, tickets
+
+
+def test_ticket_for_speeding():
+    state, tickets = state_with_road()
+    # 10 miles in 500 seconds is 72 mph
+    state.register("b", "UN1X", 1000 + 500)
+    state.register("a", "UN1X", 1000)
+    assert tickets == [("UN1X", 1, 0, 1000, 10, 1500, 7200)]
+
+
+def test_one_ticket_per_day():
+    state, tickets = state_with_road()
+    for timestamp in (0, 300, 600, 900):
+        state.register("a" if timestamp % 600 == 0 else "b", "UN1X", timestamp)
+    assert len(tickets) == 1
+    state.register("a", "UN1X", sd.DAY)
+    state.register("b", "UN1X", sd.DAY + 300)
+    assert len(tickets) == 2
+
+
+def test_speed_past_u16_is_clamped():
+    state, tickets = state_with_road()
+    state.register("a", "UN1X", 0)
+    state.register("b", "UN1X", 1)
+    assert tickets[0][-1] == 0xFFFF
+
+
+def test_tickets_held_until_a_dispatcher_connects():
+    state = sd.State()
+    state.add_camera("a", 7, 0, 60)
+    state.add_camera("b", 7, 10, 60)
+    state.register("a", "UN1X", 0)
+    state.register("b", "UN1X", 100)
+    tickets = []
+    state.add_dispatcher("d", [7], tickets.append)
+    assert len(tickets) == 1
+
+
+def test_frame_decoder_split_anywhere():
+    stream = (b"\x80\x00\x01\x00\x0a\x00\x3c"  # IAmCamera
+              b"\x40\x00\x00\x00\x19"  # WantHeartbeat
+              b"\x20\x04UN1X\x00\x00\x03\xe8"  # Plate
+              b"\x81\x02\x00\x01\x00\x07")  # IAmDispatcher
+    rng = random.Random(0)
+    for _ in range(50):
+        decoder = sd.FrameDecoder()
+        messages = []
+        i = 0
+        while i < len(stream):
+            j = i + rng.randrange(1, 6)
+            decoder.feed(stream[i:j])
+            messages += decoder.decode()
+            i = j
+        assert [type(m) for m in messages] == [sd.IAmCamera, sd.WantHeartbeat, sd.Plate, sd.IAmDispatcher]
+        assert messages[2].plate == "UN1X" and messages[2].timestamp == 1000
+        assert messages[3].roads == [1, 7]
+        assert not decoder.buffer
+
+
+def test_frame_decoder_rejects_unknown_type():
+    decoder = sd.FrameDecoder()
+    decoder.feed(b"\x40\x00\x00\x00\x01\x99")
+    assert len(decoder.decode()) == 1
+    with pytest.raises(ValueError):
+        decoder.decode()
+
+
+class Writer:
+    def __init__(self, wheel):
+        self.wheel = wheel
+        self.beats = []
+
+    def is_closing(self):
+        return False
+
+    def write(self, data):
+        self.beats.append(self.wheel.base)
+
+
+def test_heartbeat_wheel():
+    async def run():
+        loop = asyncio.get_running_loop()
+        wheel = sd.HeartbeatWheel(tick=1.0)
+        # Intervals in the root wheel and in each of the levels above it
+        writers = {interval: Writer(wheel) for interval in (1, 7, 255, 256, 1000, 20000, 300000)}
+        for interval, w in writers.items():
+            wheel.add(w, interval)
+        removed = Writer(wheel)
+        wheel.add(removed, 3)
+        wheel.remove(removed)
+
+        rng = random.Random(0)
+        end = 700000
+        while wheel.base < end:
+            # Pretend the loop was late by a few ticks, as advance() catches up
+            ticks = min(rng.randrange(1, 5000), end - wheel.base)
+            wheel.started = loop.time() - (wheel.base + ticks) * wheel.tick - 0.5
+            wheel.timer.cancel()
+            wheel.advance()
+        wheel.timer.cancel()
+        return writers, removed
+
+    writers, removed = asyncio.run(run())
+    for interval, w in writers.items():
+        assert w.beats == list(range(interval, 700001, interval))
+    assert removed.beats == []
@@ -0,0 +1,137 @@
+import asyncio
+import os
+import random
+import select
+import socket
+
+import pytest
+
+from servers import load_server
+
+kv = load_server("04-unusual-database-program.py")
+
+
+def check(store, model: dict):
+    for key, value in model.items():
+        assert store.get(key) == value
+    assert store.get(b"missing") == b""
+    assert store.get(b"version") == kv.VERSION
+
+
+def test_log_store_compaction_and_reopen(tmp_path):
+    path = str(tmp_path / "kv")
+    rng = random.Random(0)
+    model = {}
+    store = kv.LogStore(path)
+    # Due for compaction as soon as there is anything new
+    store.COMPACT_MIN = 1
+    generations = set()
+    for i in range(2000):
+        key = b"k%d" % rng.randrange(300)
+        value = os.urandom(rng.randrange(0, 40))
+        store.set(key, value)
+        model[key] = value
+        if i % 97 == 0:
+            store.flush()
+            if store.compaction_due():
+                store.compact()
+            generations.add(store.generation)
+            check(store, model)
+    store.close()
+    assert len(generations) > 5
+
+    store = kv.LogStore(path)
+    check(store, model)
+    assert dict(store.items()) == model
+    store.close()
+
+
+def test_log_store_drops_a_torn_record(tmp_path):
+    path = str(tmp_path / "kv")
+    store = kv.LogStore(path)
+    store.set(b"a", b"1")
+    store.set(b"b", b"2")
+    store.close()
+    with open(path + ".log", "ab") as f:
+        f.write(store.RECORD.pack(1, 10) + b"c12")
+
+    store = kv.LogStore(path)
+    check(store, {b"a": b"1", b"b": b"2"})
+    assert store.get(b"c") == b""
+    store.set(b"c", b"3")
+    store.close()
+    store = kv.LogStore(path)
+    check(store, {b"a": b"1", b"b": b"2", b"c": b"3"})
+    store.close()
+
+
+def test_log_store_background_compaction_keeps_concurrent_sets(tmp_path):
+    path = str(tmp_path / "kv")
+    model = {}
+
+    async def run():
+        store = kv.LogStore(path)
+        for i in range(5000):
+            store.set(b"k%d" % (i % 1000), b"v%d" % i)
+            model[b"k%d" % (i % 1000)] = b"v%d" % i
+        compaction = asyncio.create_task(store.compact_in_background())
+        while not compaction.done():
+            # Sets and gets while the rewrite runs in a thread
+            for i in range(100):
+                key, value = b"k%d" % random.randrange(1200), os.urandom(8)
+                store.set(key, value)
+                model[key] = value
+            check(store, model)
+            await asyncio.sleep(0)
+        await compaction
+        check(store, model)
+        store.close()
+
+    asyncio.run(run())
+    store = kv.LogStore(path)
+    check(store, model)
+    assert store.generation == 1
+    store.close()
+
+
+@pytest.mark.parametrize("batch_socket", [kv.PlainSocket, kv.MMsgSocket])
+def test_workers_forward_keys_to_their_owner(monkeypatch, batch_socket):
+    monkeypatch.setattr(kv, "STORE", "dict")
+    monkeypatch.setattr(kv, "batch_socket", batch_socket)
+    pairs = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(2)]
+    inboxes, outboxes = [b for _, b in pairs], [a for a, _ in pairs]
+    for sock in inboxes + outboxes:
+        sock.setblocking(False)
+    workers = [kv.Worker(i, kv.runtime.listen("127.0.0.1", 0, type=socket.SOCK_DGRAM), inboxes, outboxes)
+               for i in range(2)]
+    ports = [w.sock.sock.getsockname()[1] for w in workers]
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.bind(("127.0.0.1", 0))
+    client.settimeout(1)
+
+    def step(sent_to: int):
+        select.select([workers[sent_to].sock.sock], [], [], 1)
+        workers[sent_to].on_packets()
+        other = workers[1 - sent_to]
+        if select.select([other.inbox], [], [], 0.1)[0]:
+            other.on_forwarded()
+
+    keys = [b"k%d" % i for i in range(50)]
+    for key in keys:
+        client.sendto(key + b"=" + key[::-1], ("127.0.0.1", ports[0]))
+    step(0)
+    for key in keys + [b"version"]:
+        client.sendto(key, ("127.0.0.1", ports[1]))
+    step(1)
+    replies = {}
+    for _ in range(len(keys) + 1):
+        data, (_, port) = client.recvfrom(kv.MAX_DATAGRAM)
+        key, _, value = data.partition(b"=")
+        replies[key] = value, port
+    owners = {kv.owner(key, 2) for key in keys}
+
+    for sock in inboxes + outboxes + [client] + [w.sock.sock for w in workers]:
+        sock.close()
+    assert owners == {0, 1}
+    assert replies == {key: (key[::-1], ports[kv.owner(key, 2)]) for key in keys} | {
+        b"version": (kv.VERSION, ports[kv.owner(b"version", 2)])}